@@ -2,12 +2,37 @@ def includeme(config):
     """ Activate the forum; usually called via
     ``config.include('pyracms_forum')`` instead of being invoked
     directly. """
+    from pyramid.events import NewRequest
+    from pyramid.interfaces import IApplicationCreated
+    from .lib.counterlib import counters
+    from .lib.pipelinelib import pipeline
+    from .lib.platformlib import platforms
+    from .lib.requestcachelib import request_cache
+    settings = config.registry.settings
+    counters.interval = int(settings.get(
+                                "hypernucleus.counter_flush_interval", 10))
+    pipeline.configure(config.registry,
+                       int(settings.get("hypernucleus.pipeline_workers", 2)),
+                       int(settings.get("hypernucleus.pipeline_timeout",
+                                        3600)),
+                       int(settings.get("hypernucleus.pipeline_sweep_interval",
+                                        300)),
+                       int(settings.get("hypernucleus.pipeline_attempts", 3)))
+    config.add_subscriber(pipeline.start, NewRequest)
+    config.add_subscriber(platforms.preload, IApplicationCreated)
+    config.add_request_method(request_cache, "gamedep_cache", reify=True)
+    config.add_tween("hypernucleusserver.lib.requestcachelib."
+                     "query_count_tween_factory")
     config.include('pyramid_jinja2')
     config.add_jinja2_search_path("hypernucleusserver:templates")
     # Outputs routes
     config.add_route('outputs_xml', '/outputs/xml')
     config.add_route('outputs_file', '/outputs/file/{fileid}')
+    config.add_route('outputs_download', '/outputs/download/{uuid}/{name}')
+    config.add_route('outputs_delta', '/outputs/delta/{from_uuid}/{to_uuid}')
     config.add_route('outputs_json', '/outputs/json')
+    config.add_route('outputs_json_platform', '/outputs/json/{os}/{arch}')
+    config.add_route('outputs_changes', '/outputs/changes')
     
     # Games/Dependency Routes
     config.add_route('gamedep_add_dep', '/gamedep/{type}/adddep/{page_id}')
@@ -1,12 +1,12 @@
-import zipfile
-
 from colander import (MappingSchema, SchemaNode, String, Decimal, OneOf,
                       deferred, Invalid, Regex)
 from deform import FileData
 from deform.widget import (TextAreaWidget, TextInputWidget, RadioChoiceWidget,
                            FileUploadWidget, SelectWidget)
+from pyramid.threadlocal import get_current_registry
 
 from ..lib.gamedeplib import GameDepLib
+from ..lib.ziplib import ZipInvalid, missing_members, read_index, zip_limits
 
 module_type_prefix = "Python module that is initialised with "
 module_type = [["file", module_type_prefix + "(for example) foo.py"],
@@ -20,26 +20,19 @@ def valid_source_file(node, kw):
 
     def validator(node, value):
         req_file_folder = kw.get("req_file_folder")
+        # Only the central directory is read, the index is kept in
+        # value so storing the file doesn't have to read it again.
         try:
-            z = zipfile.ZipFile(value['fp'])
-            count = 0
-            namelist = z.namelist()
-            # Loop through files in required files and folders.
-            for item in req_file_folder:
-                # Make sure they are in the zip
-                if item in namelist:
-                    count += 1
-            # If they are not all there, then...
-            if not count == len(req_file_folder):
-                # Make a list of files and folders for the Invalid exception
-                filelist = ""
-                for item in req_file_folder:
-                    filelist += "%s, " % item
-                filelist = filelist[:-2]
-                raise Invalid(node,
-                              'The zip must have the following files: %s' % filelist)
-        except zipfile.BadZipfile:
-            raise Invalid(node, 'The uploaded file is not a zip.')
+            value['members'] = read_index(value['fp'], **zip_limits(
+                                        get_current_registry().settings))
+        except ZipInvalid as e:
+            raise Invalid(node, str(e))
+        finally:
+            value['fp'].seek(0)
+        if missing_members(value['members'], req_file_folder):
+            raise Invalid(node,
+                          'The zip must have the following files: %s'
+                          % ", ".join(req_file_folder))
 
     return validator
 
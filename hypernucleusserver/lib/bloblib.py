@@ -0,0 +1,197 @@
+from hashlib import sha256
+import json
+
+from pyracms.lib.filelib import FileLib
+from pyracms.models import DBSession
+from sqlalchemy.exc import IntegrityError
+from ..models import GameDepBlob, GameDepSignature
+from .deltalib import signature
+from .downloadlib import DownloadLib, StoredFileNotFound
+from .ziplib import ZipInvalid, read_index, zip_limits
+
+BLOCK_SIZE = 64 * 1024
+
+class BlobNotFound(Exception):
+    pass
+
+def hash_stream(data, output=None):
+    """
+    Read a file object to the end, copying it to output if given.
+    Returns the hex sha256 and the size.
+    """
+    digest = sha256()
+    size = 0
+    while True:
+        chunk = data.read(BLOCK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        size += len(chunk)
+        if output is not None:
+            output.write(chunk)
+    return digest.hexdigest(), size
+
+class BlobLib():
+    """
+    A library to store uploads once per content hash.
+    Each distinct sha256 has one Files row shared by every binary and
+    source code using it, with a count of those users. The file is only
+    deleted when the last one lets go of it. Counts are only changed in
+    SQL, so concurrent requests never overwrite each other's change.
+    Usage examples:
+    b = BlobLib(request)
+    b.store("game.zip", fp, "application/zip")  # Files row for fp's bytes,
+    b.process(file_obj, b.inspect(file_obj))    # deduplicated later by this
+    b.link(sha)                                 # Reuse stored bytes
+    b.release(file_obj)                         # Drop one reference
+    b.members(file_obj)                         # Zip index of a file
+    """
+
+    def __init__(self, request):
+        self.request = request
+
+    def show(self, sha):
+        """
+        Get the blob with a hash, raise BlobNotFound if not stored
+        """
+        blob = DBSession.query(GameDepBlob).filter_by(
+                                            sha256=sha.lower()).first()
+        if not blob:
+            raise BlobNotFound
+        return blob
+
+    def exists(self, sha):
+        try:
+            self.show(sha)
+            return True
+        except BlobNotFound:
+            return False
+
+    def link(self, sha):
+        """
+        Take a reference to stored bytes by hash, returns the Files row
+        """
+        blob = self.show(sha)
+        if not self.change_refcount(blob, 1):
+            # Released by its last user since
+            raise BlobNotFound
+        return blob.file_obj
+
+    def change_refcount(self, blob, change):
+        """
+        Add change to the refcount of blob in one UPDATE, which holds the
+        row until commit. Returns False if the blob is gone.
+        """
+        updated = DBSession.query(GameDepBlob).filter_by(id=blob.id).update(
+                    {"refcount": GameDepBlob.refcount + change},
+                    synchronize_session=False)
+        DBSession.expire(blob, ["refcount"])
+        return updated == 1
+
+    def add(self, sha, file_obj, size, members):
+        """
+        Add the blob of newly stored bytes, returns the Files row to use.
+        If a concurrent upload of the same bytes added it first, that one
+        is linked instead and the caller discards file_obj.
+        """
+        if members is not None:
+            members = json.dumps(members)
+        try:
+            with DBSession.begin_nested():
+                DBSession.add(GameDepBlob(sha, file_obj, size, members))
+                DBSession.flush()
+        except IntegrityError:
+            return self.link(sha)
+        return file_obj
+
+    def store(self, filename, data, mimetype):
+        """
+        Write a file object as is, returns the Files row.
+        It has to go through inspect and process before it is
+        deduplicated.
+        """
+        return FileLib(self.request).write(filename, data, mimetype)
+
+    def inspect(self, file_obj, members=None):
+        """
+        Hash, index and sign a file written by store, without writing to
+        the database, so it can run before any row is locked. Index and
+        signature are skipped when the bytes are already stored.
+        Returns a dictionary for process.
+        """
+        d = DownloadLib(self.request)
+        try:
+            fp = open(d.path(file_obj), "rb")
+        except (IOError, OSError):
+            raise StoredFileNotFound
+        with fp:
+            sha, size = hash_stream(fp)
+            result = {"sha256": sha, "size": size, "members": members,
+                      "block_size": d.block_size, "signature": None}
+            if self.exists(sha):
+                return result
+            if members is None:
+                try:
+                    result["members"] = read_index(fp, **zip_limits(
+                                            self.request.registry.settings))
+                except ZipInvalid:
+                    pass
+            # Ready for delta downloads from the next version
+            fp.seek(0)
+            result["signature"] = signature(fp, d.block_size)
+        return result
+
+    def process(self, file_obj, inspected):
+        """
+        Deduplicate a file read by inspect, returns the Files row to use
+        instead of it. When the same bytes were already stored that row
+        gets the reference, the caller moves its users over and discards
+        file_obj.
+        """
+        sha = inspected["sha256"]
+        blob = DBSession.query(GameDepBlob).filter_by(sha256=sha).first()
+        if blob and blob.file_id == file_obj.id:
+            return file_obj
+        if blob and self.change_refcount(blob, 1):
+            return blob.file_obj
+        signed = DBSession.query(GameDepSignature.id).filter_by(
+                                            file_id=file_obj.id).first()
+        if inspected["signature"] is not None and not signed:
+            DBSession.add(GameDepSignature(file_obj.id,
+                                           inspected["block_size"],
+                                           inspected["signature"]))
+        return self.add(sha, file_obj, inspected["size"],
+                        inspected["members"])
+
+    def discard(self, file_obj):
+        """
+        Delete a file nothing uses any more
+        """
+        DownloadLib(self.request).forget(file_obj)
+        FileLib(self.request).delete(file_obj)
+
+    def members(self, file_obj):
+        """
+        Get the stored zip index of a file, None if it was not a zip
+        or was stored before deduplication
+        """
+        blob = DBSession.query(GameDepBlob).filter_by(
+                                            file_id=file_obj.id).first()
+        if blob and blob.members:
+            return json.loads(blob.members)
+
+    def release(self, file_obj):
+        """
+        Drop a reference to a Files row, deleting it with the last one.
+        Files stored before deduplication have no blob and are deleted
+        straight away.
+        """
+        blob = DBSession.query(GameDepBlob).filter_by(
+                                            file_id=file_obj.id).first()
+        if blob:
+            self.change_refcount(blob, -1)
+            if blob.refcount > 0:
+                return
+            DBSession.delete(blob)
+            DBSession.flush()
+        self.discard(file_obj)
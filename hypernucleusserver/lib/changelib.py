@@ -0,0 +1,75 @@
+from datetime import datetime
+
+from pyracms.models import DBSession
+import transaction
+
+from ..models import GameDepChange, GameDepChangeLock
+
+class ChangeLockMissing(Exception):
+    pass
+
+def write_changes(changes):
+    """
+    Before commit hook inserting the changes of a transaction
+    """
+    ChangeLib().lock()
+    DBSession.add_all(changes)
+    DBSession.flush()
+
+class ChangeLib():
+    """
+    A library to record and read back catalog changes.
+    Every GameDepLib mutation adds a row, the row id is a monotonically
+    increasing sequence number clients can resume from.
+    Rows are inserted just before the transaction commits, under a lock
+    held until it has committed. Ids are therefore visible in the order
+    they were given out, and a reader that has seen id n will never see
+    a lower id turn up later.
+    Usage examples:
+    c = ChangeLib()
+    c.record("create_revision", page, rev.id)   # Log a change
+    c.since(120)                                # Changes after number 120
+    """
+
+    def record(self, action, page, revision_id=None, binary_id=None):
+        """
+        Log a change to page and bump its updated time,
+        page must have been flushed. The row is written on commit.
+        """
+        page.updated = datetime.now()
+        change = GameDepChange(action, page, revision_id, binary_id)
+        txn = transaction.get()
+        for hook, args, kws in txn.getBeforeCommitHooks():
+            if hook == write_changes:
+                args[0].append(change)
+                return
+        txn.addBeforeCommitHook(write_changes, ([change],))
+
+    def lock(self):
+        """
+        Lock the change log until the current transaction ends, call it
+        right before inserting changes and committing. The row is made by
+        initializedb and upgradedb, inserting it here would race.
+        """
+        lock = DBSession.query(GameDepChangeLock).filter_by(
+                                            id=1).with_for_update().first()
+        if not lock:
+            raise ChangeLockMissing("The change log lock row is missing, "
+                                    "run upgrade_hypernucleus-server_db.")
+
+    def since(self, cursor, limit=500):
+        """
+        Get up to limit changes with a sequence number above cursor,
+        oldest first.
+        """
+        return DBSession.query(GameDepChange).filter(
+                        GameDepChange.id > int(cursor)).order_by(
+                        GameDepChange.id).limit(limit).all()
+
+    def latest(self):
+        """
+        Get the sequence number of the newest change, 0 if there is none
+        """
+        change = DBSession.query(GameDepChange.id).order_by(
+                        GameDepChange.id.desc()).first()
+        return change[0] if change else 0
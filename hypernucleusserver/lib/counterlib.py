@@ -0,0 +1,104 @@
+from collections import Counter
+import atexit
+import logging
+import threading
+
+from pyracms.models import DBSession
+from sqlalchemy import func
+from zope.sqlalchemy import mark_changed
+import transaction
+
+from ..models import GameDepBinary, GameDepPage
+
+log = logging.getLogger(__name__)
+
+# Counter kind -> model and column it is flushed to
+COUNTERS = {"view": (GameDepPage, "view_count"),
+            "download": (GameDepBinary, "download_count")}
+
+class CounterBuffer():
+    """
+    In process buffer of counter increments.
+    Increments are summed in memory and written by a background thread
+    every interval seconds, one UPDATE per distinct delta, so busy rows
+    are not locked by every request. Whatever is pending is also
+    written when the process exits, a crash loses at most one interval.
+    Usage examples:
+    counters.increment("view", page.id)         # Count a page view
+    counters.pending("download", binary.id)     # Not yet written
+    counters.flush()                            # Write now
+    """
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.deltas = dict((kind, Counter()) for kind in COUNTERS)
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def increment(self, kind, row_id, amount=1):
+        with self.lock:
+            self.deltas[kind][int(row_id)] += amount
+            if self.thread is None:
+                self.start()
+
+    def pending(self, kind, row_id):
+        with self.lock:
+            return self.deltas[kind].get(int(row_id), 0)
+
+    def take(self):
+        """
+        Swap out the buffered deltas
+        """
+        with self.lock:
+            deltas = self.deltas
+            self.deltas = dict((kind, Counter()) for kind in COUNTERS)
+        return deltas
+
+    def restore(self, deltas):
+        """
+        Put deltas that could not be written back in the buffer
+        """
+        with self.lock:
+            for kind, counter in deltas.items():
+                self.deltas[kind].update(counter)
+
+    def flush(self):
+        deltas = self.take()
+        if not any(deltas.values()):
+            return
+        try:
+            with transaction.manager:
+                for kind, counter in deltas.items():
+                    model, column = COUNTERS[kind]
+                    column = getattr(model, column)
+                    by_amount = {}
+                    for row_id, amount in counter.items():
+                        by_amount.setdefault(amount, []).append(row_id)
+                    for amount, row_ids in by_amount.items():
+                        DBSession.query(model).filter(
+                            model.id.in_(row_ids)).update(
+                            {column: func.coalesce(column, 0) + amount},
+                            synchronize_session=False)
+                mark_changed(DBSession())
+        except Exception:
+            log.exception("Could not write counters, will retry")
+            self.restore(deltas)
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.flush()
+            DBSession.remove()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                                       name="hypernucleus-counters")
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self.stopping.set()
+        self.flush()
+
+counters = CounterBuffer()
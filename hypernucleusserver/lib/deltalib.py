@@ -0,0 +1,177 @@
+"""
+rsync style block signatures and deltas between two versions of a file.
+
+A signature is the adler32 and a 16 byte blake2b of every block of the
+old file. A delta is made by rolling adler32 over the new file and
+looking each window up in the signature, so blocks that only moved
+are still found. It is a header followed by operations:
+
+    HNDELTA1 block size (>I) new length (>Q) new sha256 (32 bytes)
+    C first block (>I) block count (>I)   copy blocks of the old file
+    D length (>I) bytes                   literal bytes
+    E                                     end
+"""
+
+from hashlib import blake2b, sha256
+import struct
+import zlib
+
+MAGIC = b"HNDELTA1"
+HEADER = struct.Struct(">IQ")
+COPY = struct.Struct(">cII")
+DATA = struct.Struct(">cI")
+BLOCK = struct.Struct(">I16s")
+MOD_ADLER = 65521
+MAX_LITERAL = 1024 * 1024
+
+class DeltaTooLarge(Exception):
+    pass
+
+class DeltaInvalid(Exception):
+    pass
+
+def strong_hash(data):
+    return blake2b(data, digest_size=16).digest()
+
+def signature(fp, block_size):
+    """
+    Get the packed block signature of a file object
+    """
+    output = []
+    while True:
+        block = fp.read(block_size)
+        if not block:
+            break
+        output.append(BLOCK.pack(zlib.adler32(block), strong_hash(block)))
+    return b"".join(output)
+
+def unpack_signature(packed):
+    """
+    Get a list of (weak, strong) block hashes
+    """
+    return [BLOCK.unpack_from(packed, x)
+            for x in range(0, len(packed), BLOCK.size)]
+
+class DeltaWriter():
+    """
+    Collects delta operations, joining runs of consecutive blocks
+    """
+
+    def __init__(self, write):
+        self.write = write
+        self.run_start = None
+        self.run_length = 0
+
+    def copy(self, block):
+        if self.run_start is not None and \
+           self.run_start + self.run_length == block:
+            self.run_length += 1
+            return
+        self.end_run()
+        self.run_start, self.run_length = block, 1
+
+    def end_run(self):
+        if self.run_start is not None:
+            self.write(COPY.pack(b"C", self.run_start, self.run_length))
+            self.run_start = None
+
+    def data(self, data):
+        if not len(data):
+            return
+        self.end_run()
+        for start in range(0, len(data), MAX_LITERAL):
+            chunk = data[start:start + MAX_LITERAL]
+            self.write(DATA.pack(b"D", len(chunk)))
+            self.write(bytes(chunk))
+
+    def close(self):
+        self.end_run()
+        self.write(b"E")
+
+def make_delta(packed_signature, block_size, data, write,
+               max_literal_ratio=0.5):
+    """
+    Write the delta turning the file with packed_signature into data,
+    data being bytes or an mmap. Raises DeltaTooLarge once more than
+    max_literal_ratio of data would be sent literally, the caller
+    should send the whole file instead.
+    """
+    blocks = unpack_signature(packed_signature)
+    length = len(data)
+    weak_index = {}
+    for number, (weak, strong) in enumerate(blocks):
+        weak_index.setdefault(weak, []).append(number)
+    max_literal = max_literal_ratio * length
+    write(MAGIC + HEADER.pack(block_size, length) +
+          sha256(data).digest())
+    writer = DeltaWriter(write)
+    literal_start = 0
+    literal = 0
+    position = 0
+    weak = None
+    while position + block_size <= length:
+        if weak is None:
+            weak = zlib.adler32(data[position:position + block_size])
+            a, b = weak & 0xffff, weak >> 16
+        match = None
+        candidates = weak_index.get(weak)
+        if candidates:
+            strong = strong_hash(data[position:position + block_size])
+            for number in candidates:
+                if blocks[number][1] == strong:
+                    match = number
+                    break
+        if match is not None:
+            literal += position - literal_start
+            writer.data(data[literal_start:position])
+            writer.copy(match)
+            position += block_size
+            literal_start = position
+            weak = None
+            continue
+        if position - literal_start + literal > max_literal:
+            raise DeltaTooLarge
+        if position + block_size < length:
+            old, new = data[position], data[position + block_size]
+            a = (a - old + new) % MOD_ADLER
+            b = (b - block_size * old + a - 1) % MOD_ADLER
+            weak = (b << 16) | a
+        position += 1
+    tail = data[literal_start:]
+    if blocks and len(tail) and len(tail) < block_size and \
+       blocks[-1][1] == strong_hash(tail):
+        writer.copy(len(blocks) - 1)
+    else:
+        if literal + len(tail) > max_literal:
+            raise DeltaTooLarge
+        writer.data(tail)
+    writer.close()
+
+def apply_delta(old, delta, write):
+    """
+    Rebuild the new file from the old file object and a delta file
+    object, raising DeltaInvalid if the result does not check out
+    """
+    if delta.read(len(MAGIC)) != MAGIC:
+        raise DeltaInvalid("Not a delta")
+    block_size, length = HEADER.unpack(delta.read(HEADER.size))
+    expected = delta.read(32)
+    digest = sha256()
+    written = 0
+    while True:
+        op = delta.read(1)
+        if op == b"C":
+            start, count = struct.unpack(">II", delta.read(8))
+            old.seek(start * block_size)
+            chunk = old.read(count * block_size)
+        elif op == b"D":
+            chunk = delta.read(struct.unpack(">I", delta.read(4))[0])
+        elif op == b"E":
+            break
+        else:
+            raise DeltaInvalid("Unknown operation %r" % op)
+        digest.update(chunk)
+        written += len(chunk)
+        write(chunk)
+    if written != length or digest.digest() != expected:
+        raise DeltaInvalid("Result does not match")
@@ -0,0 +1,202 @@
+from array import array
+from collections import deque
+import threading
+
+import transaction
+
+def add_once(items, value):
+    """
+    Append value to an array unless it is already there, so replaying an
+    update that a reload already picked up is harmless
+    """
+    if value not in items:
+        items.append(value)
+
+def remove_all(items, value):
+    """
+    Remove every copy of value from an array
+    """
+    while value in items:
+        items.remove(value)
+
+class DependencyGraph():
+    """
+    A process wide index of pages, revisions and dependencies.
+    Only integer ids are kept, with adjacency lists in arrays, so forward,
+    reverse and transitive lookups never touch the database.
+    GameDepLib updates it once its changes have committed.
+    Usage examples:
+    from hypernucleusserver.lib.depgraphlib import dependency_graph
+    dependency_graph.dependencies(page_id)      # Pages page_id needs
+    dependency_graph.dependents(page_id)        # Pages that need page_id
+    dependency_graph.revision_dependents(rev_id)  # Pages pinned to rev_id
+    dependency_graph.on_commit("add_edge", page_id, rev_id)
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded = False
+
+    def clear(self):
+        """
+        Empty the index and mark it as loaded
+        """
+        with self.lock:
+            self.names = {}            # page id -> name
+            self.page_ids = {}         # name -> page id
+            self.page_revisions = {}   # page id -> revision ids
+            self.revision_page = {}    # revision id -> page id
+            self.depends_on = {}       # page id -> revision ids
+            self.required_by = {}      # revision id -> page ids
+            self.loaded = True
+
+    def load(self):
+        """
+        Read the whole graph from the database
+        """
+        from pyracms.models import DBSession
+        from ..models import GameDepPage, GameDepRevision, GameDepDependency
+        with self.lock:
+            self.clear()
+            for page_id, name in DBSession.query(GameDepPage.id,
+                                                 GameDepPage.name):
+                self.add_page(page_id, name)
+            for rev_id, page_id in DBSession.query(GameDepRevision.id,
+                                                   GameDepRevision.page_id):
+                self.add_revision(rev_id, page_id)
+            for page_id, rev_id in DBSession.query(
+                                            GameDepDependency.game_id,
+                                            GameDepDependency.rev_id):
+                self.add_edge(page_id, rev_id)
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def apply(self, status, operation, args):
+        if status and self.loaded:
+            with self.lock:
+                getattr(self, operation)(*args)
+
+    def on_commit(self, operation, *args):
+        """
+        Run operation(*args) once the current transaction commits
+        """
+        transaction.get().addAfterCommitHook(self.apply,
+                                             args=(operation, args))
+
+    # Updates
+
+    def add_page(self, page_id, name):
+        self.names[page_id] = name
+        self.page_ids[name] = page_id
+        self.page_revisions.setdefault(page_id, array('l'))
+        self.depends_on.setdefault(page_id, array('l'))
+
+    def rename_page(self, page_id, name):
+        self.page_ids.pop(self.names.get(page_id), None)
+        self.names[page_id] = name
+        self.page_ids[name] = page_id
+
+    def remove_page(self, page_id):
+        for rev_id in list(self.page_revisions.pop(page_id, ())):
+            self.remove_revision(rev_id)
+        for rev_id in list(self.depends_on.pop(page_id, ())):
+            remove_all(self.required_by.get(rev_id, array('l')), page_id)
+        self.page_ids.pop(self.names.pop(page_id, None), None)
+
+    def add_revision(self, rev_id, page_id):
+        self.revision_page[rev_id] = page_id
+        add_once(self.page_revisions.setdefault(page_id, array('l')), rev_id)
+        self.required_by.setdefault(rev_id, array('l'))
+
+    def remove_revision(self, rev_id):
+        page_id = self.revision_page.pop(rev_id, None)
+        if page_id is not None:
+            remove_all(self.page_revisions.get(page_id, array('l')), rev_id)
+        for dependent in self.required_by.pop(rev_id, ()):
+            remove_all(self.depends_on.get(dependent, array('l')), rev_id)
+
+    def add_edge(self, page_id, rev_id):
+        add_once(self.depends_on.setdefault(page_id, array('l')), rev_id)
+        add_once(self.required_by.setdefault(rev_id, array('l')), page_id)
+
+    def remove_edge(self, page_id, rev_id):
+        remove_all(self.depends_on.get(page_id, array('l')), rev_id)
+        remove_all(self.required_by.get(rev_id, array('l')), page_id)
+
+    # Queries
+
+    def page_id(self, name):
+        """
+        Get the id of page name, or None
+        """
+        self.ensure_loaded()
+        return self.page_ids.get(name)
+
+    def name(self, page_id):
+        self.ensure_loaded()
+        return self.names.get(page_id)
+
+    def revisions(self, page_id):
+        self.ensure_loaded()
+        with self.lock:
+            return list(self.page_revisions.get(page_id, ()))
+
+    def dependencies(self, page_id):
+        """
+        Get the ids of the pages page_id depends on
+        """
+        self.ensure_loaded()
+        with self.lock:
+            result = []
+            for rev_id in self.depends_on.get(page_id, ()):
+                dep_id = self.revision_page.get(rev_id)
+                if dep_id is not None and dep_id not in result:
+                    result.append(dep_id)
+            return result
+
+    def revision_dependents(self, rev_id):
+        """
+        Get the ids of the pages pinned to revision rev_id
+        """
+        self.ensure_loaded()
+        with self.lock:
+            return list(self.required_by.get(rev_id, ()))
+
+    def dependents(self, page_id):
+        """
+        Get the ids of the pages that depend on any revision of page_id
+        """
+        self.ensure_loaded()
+        with self.lock:
+            result = []
+            for rev_id in self.page_revisions.get(page_id, ()):
+                for dependent in self.required_by.get(rev_id, ()):
+                    if dependent not in result:
+                        result.append(dependent)
+            return result
+
+    def transitive(self, page_id, step):
+        """
+        Walk step (dependencies or dependents) breadth first from page_id
+        """
+        seen = set([page_id])
+        result = []
+        queue = deque([page_id])
+        while queue:
+            current = queue.popleft()
+            for other in step(current):
+                if other not in seen:
+                    seen.add(other)
+                    result.append(other)
+                    queue.append(other)
+        return result
+
+    def all_dependencies(self, page_id):
+        return self.transitive(page_id, self.dependencies)
+
+    def all_dependents(self, page_id):
+        return self.transitive(page_id, self.dependents)
+
+dependency_graph = DependencyGraph()
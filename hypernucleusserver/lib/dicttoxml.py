@@ -3,6 +3,8 @@
 
 """
 Converts a native Python dictionary into an XML string. Supports numbers, strings, lists, dictionaries and arbitrary nesting.
+
+Modified for hypernucleus-server: XML name checks are memoized, log messages are only built when the dicttoxml logger is enabled for INFO, and unique ids are only tracked for the document being converted.
 """
 
 from __future__ import unicode_literals
@@ -11,12 +13,23 @@ __version__ = '1.6.6'
 version = __version__
 
 from random import randint
-import collections
 import numbers
 import logging
+import re
 import sys
+import threading
 from xml.dom.minidom import parseString
 
+try:
+    from collections.abc import Iterable
+except ImportError:
+    from collections import Iterable
+
+try:
+    from functools import lru_cache
+except ImportError:
+    lru_cache = None
+
 
 LOG = logging.getLogger("dicttoxml")
 
@@ -42,31 +55,41 @@ def set_debug(debug=True, filename='dicttoxml.log'):
         logging.basicConfig(level=logging.WARNING)
         print('Debug mode is off.')
 
-ids = [] # initialize list of unique ids
+def logging_enabled():
+    """Returns True if LOG messages would be emitted, so callers can skip formatting them"""
+    return LOG.isEnabledFor(logging.INFO)
+
+unique_ids = threading.local() # ids handed out for the document being converted
+
+def reset_unique_ids():
+    """Forgets the ids of the previous document in this thread"""
+    unique_ids.used = set()
 
 def unicode_me(something):
     """Converts strings with non-ASCII characters to unicode for LOG. Python 3 doesn't have a `unicode()` function, so `unicode()` is an alias for `str()`, but `str()` doesn't take a second argument, hence this kludge."""
+    if isinstance(something, unicode):
+        return something
     try:
         return unicode(something, 'utf-8')
     except:
         return unicode(something)
-        
+
 
 def make_id(element, start=100000, end=999999):
     """Returns a random integer"""
     return '%s_%s' % (element, randint(start, end))
 
 def get_unique_id(element):
-    """Returns a unique id for a given element"""
+    """Returns an id for a given element that is unique within the current document"""
+    used = getattr(unique_ids, 'used', None)
+    if used is None:
+        reset_unique_ids()
+        used = unique_ids.used
     this_id = make_id(element)
-    dup = True
-    while dup == True:
-        if this_id not in ids:
-            dup = False
-            ids.append(this_id)
-        else:
-            this_id = make_id(element)
-    return ids[-1]
+    while this_id in used:
+        this_id = make_id(element)
+    used.add(this_id)
+    return this_id
 
 def get_xml_type(val):
     """Returns the data type for the xml type attribute"""
@@ -84,7 +107,7 @@ def get_xml_type(val):
         return 'null'
     if isinstance(val, dict):
         return 'dict'
-    if isinstance(val, collections.Iterable):
+    if isinstance(val, Iterable):
         return 'list'
     return type(val).__name__
 
@@ -103,9 +126,11 @@ def make_attrstring(attr):
     attrstring = ' '.join(['%s="%s"' % (k, v) for k, v in attr.items()])
     return '%s%s' % (' ' if attrstring != '' else '', attrstring)
 
-def key_is_valid_xml(key):
-    """Checks that a key is a valid XML name"""
-    LOG.info('Inside key_is_valid_xml(). Testing "%s"' % (unicode_me(key)))
+# Plain ASCII names that minidom always accepts, checked without parsing
+SIMPLE_XML_NAME = re.compile(r'[A-Za-z_][A-Za-z0-9_.-]*\Z')
+
+def parse_key(key):
+    """Checks that a key is a valid XML name by asking minidom to parse it"""
     test_xml = '<?xml version="1.0" encoding="UTF-8" ?><%s>foo</%s>' % (key, key)
     try:
         parseString(test_xml)
@@ -113,9 +138,22 @@ def key_is_valid_xml(key):
     except Exception: #minidom does not implement exceptions well
         return False
 
+if lru_cache:
+    # bounded, so unusual keys can't grow the process forever
+    parse_key = lru_cache(maxsize=4096)(parse_key)
+
+def key_is_valid_xml(key):
+    """Checks that a key is a valid XML name"""
+    if logging_enabled():
+        LOG.info('Inside key_is_valid_xml(). Testing "%s"' % (unicode_me(key)))
+    if type(key) in (str, unicode) and SIMPLE_XML_NAME.match(key):
+        return True
+    return parse_key(key)
+
 def make_valid_xml_name(key, attr):
     """Tests an XML name and fixes it if invalid"""
-    LOG.info('Inside make_valid_xml_name(). Testing key "%s" with attr "%s"' % (unicode_me(key), unicode_me(attr)))
+    if logging_enabled():
+        LOG.info('Inside make_valid_xml_name(). Testing key "%s" with attr "%s"' % (unicode_me(key), unicode_me(attr)))
     # pass through if key is already valid
     if key_is_valid_xml(key):
         return key, attr
@@ -132,7 +170,8 @@ def make_valid_xml_name(key, attr):
 
 def convert(obj, ids, attr_type, parent='root'):
     """Routes the elements of an object to the right function to convert them based on their data type"""
-    LOG.info('Inside convert(). obj type is: "%s", obj="%s"' % (type(obj).__name__, unicode_me(obj)))
+    if logging_enabled():
+        LOG.info('Inside convert(). obj type is: "%s", obj="%s"' % (type(obj).__name__, unicode_me(obj)))
     if isinstance(obj, numbers.Number) or type(obj) in (str, unicode):
         return convert_kv('item', obj, attr_type)
     if hasattr(obj, 'isoformat'):
@@ -143,17 +182,20 @@ def convert(obj, ids, attr_type, parent='root'):
         return convert_none('item', '', attr_type)
     if isinstance(obj, dict):
         return convert_dict(obj, ids, parent, attr_type)
-    if isinstance(obj, collections.Iterable):
+    if isinstance(obj, Iterable):
         return convert_list(obj, ids, parent, attr_type)
     raise TypeError('Unsupported data type: %s (%s)' % (obj, type(obj).__name__))
 
 def convert_dict(obj, ids, parent, attr_type):
     """Converts a dict into an XML string."""
-    LOG.info('Inside convert_dict(): obj type is: "%s", obj="%s"' % (type(obj).__name__, unicode_me(obj)))
+    debug = logging_enabled()
+    if debug:
+        LOG.info('Inside convert_dict(): obj type is: "%s", obj="%s"' % (type(obj).__name__, unicode_me(obj)))
     output = []
     addline = output.append
     for key, val in obj.items():
-        LOG.info('Looping inside convert_dict(): key="%s", val="%s", type(val)="%s"' % (unicode_me(key), unicode_me(val), type(val).__name__))
+        if debug:
+            LOG.info('Looping inside convert_dict(): key="%s", val="%s", type(val)="%s"' % (unicode_me(key), unicode_me(val), type(val).__name__))
 
         attr = {} if not ids else {'id': '%s' % (get_unique_id(parent)) }
 
@@ -174,7 +216,7 @@ def convert_dict(obj, ids, parent, attr_type):
             addline('<%s%s>%s</%s>' % (
                 key, make_attrstring(attr), convert_dict(val, ids, key, attr_type), key)
             )
-        elif isinstance(val, collections.Iterable):
+        elif isinstance(val, Iterable):
             if attr_type:
                 attr['type'] = get_xml_type(val)
             addline('<%s%s>%s</%s>' % (
@@ -188,7 +230,9 @@ def convert_dict(obj, ids, parent, attr_type):
 
 def convert_list(items, ids, parent, attr_type):
     """Converts a list into an XML string."""
-    LOG.info('Inside convert_list()')
+    debug = logging_enabled()
+    if debug:
+        LOG.info('Inside convert_list()')
     output = []
     addline = output.append
 
@@ -196,7 +240,8 @@ def convert_list(items, ids, parent, attr_type):
         this_id = get_unique_id(parent)
 
     for i, item in enumerate(items):
-        LOG.info('Looping inside convert_list(): item="%s", type="%s"' % (unicode_me(item), type(item).__name__))
+        if debug:
+            LOG.info('Looping inside convert_list(): item="%s", type="%s"' % (unicode_me(item), type(item).__name__))
         attr = {} if not ids else { 'id': '%s_%s' % (this_id, i+1) }
         if isinstance(item, numbers.Number) or type(item) in (str, unicode):
             addline(convert_kv('item', item, attr_type, attr))
@@ -209,7 +254,7 @@ def convert_list(items, ids, parent, attr_type):
                 addline('<item>%s</item>' % (convert_dict(item, ids, parent, attr_type)))
             else:
                 addline('<item type="dict">%s</item>' % (convert_dict(item, ids, parent, attr_type)))
-        elif isinstance(item, collections.Iterable):
+        elif isinstance(item, Iterable):
             if not attr_type:
                 addline('<item %s>%s</item>' % (make_attrstring(attr), convert_list(item, ids, 'item', attr_type)))
             else:
@@ -220,11 +265,12 @@ def convert_list(items, ids, parent, attr_type):
             raise TypeError('Unsupported data type: %s (%s)' % (item, type(item).__name__))
     return ''.join(output)
 
-def convert_kv(key, val, attr_type, attr={}):
+def convert_kv(key, val, attr_type, attr=None):
     """Converts a number or string into an XML element"""
-    LOG.info('Inside convert_kv(): key="%s", val="%s", type(val) is: "%s"' % (unicode_me(key), unicode_me(val), type(val).__name__))
+    if logging_enabled():
+        LOG.info('Inside convert_kv(): key="%s", val="%s", type(val) is: "%s"' % (unicode_me(key), unicode_me(val), type(val).__name__))
 
-    key, attr = make_valid_xml_name(key, attr)
+    key, attr = make_valid_xml_name(key, {} if attr is None else attr)
 
     if attr_type:
         attr['type'] = get_xml_type(val)
@@ -233,22 +279,24 @@ def convert_kv(key, val, attr_type, attr={}):
         key, attrstring, xml_escape(val), key
     )
 
-def convert_bool(key, val, attr_type, attr={}):
+def convert_bool(key, val, attr_type, attr=None):
     """Converts a boolean into an XML element"""
-    LOG.info('Inside convert_bool(): key="%s", val="%s", type(val) is: "%s"' % (unicode_me(key), unicode_me(val), type(val).__name__))
+    if logging_enabled():
+        LOG.info('Inside convert_bool(): key="%s", val="%s", type(val) is: "%s"' % (unicode_me(key), unicode_me(val), type(val).__name__))
 
-    key, attr = make_valid_xml_name(key, attr)
+    key, attr = make_valid_xml_name(key, {} if attr is None else attr)
 
     if attr_type:
         attr['type'] = get_xml_type(val)
     attrstring = make_attrstring(attr)
     return '<%s%s>%s</%s>' % (key, attrstring, unicode(val).lower(), key)
 
-def convert_none(key, val, attr_type, attr={}):
+def convert_none(key, val, attr_type, attr=None):
     """Converts a null value into an XML element"""
-    LOG.info('Inside convert_none(): key="%s"' % (unicode_me(key)))
+    if logging_enabled():
+        LOG.info('Inside convert_none(): key="%s"' % (unicode_me(key)))
 
-    key, attr = make_valid_xml_name(key, attr)
+    key, attr = make_valid_xml_name(key, {} if attr is None else attr)
 
     if attr_type:
         attr['type'] = get_xml_type(val)
@@ -260,7 +308,9 @@ def dicttoxml(obj, root=True, custom_root='root', ids=False, attr_type=True):
     attr_type is used to specify if data type for each element should be included in the resulting xml.
     By default, it is set to True.
     """
-    LOG.info('Inside dicttoxml(): type(obj) is: "%s", obj="%s"' % (type(obj).__name__, unicode_me(obj)))
+    if logging_enabled():
+        LOG.info('Inside dicttoxml(): type(obj) is: "%s", obj="%s"' % (type(obj).__name__, unicode_me(obj)))
+    reset_unique_ids()
     output = []
     addline = output.append
     if root == True:
@@ -268,5 +318,5 @@ def dicttoxml(obj, root=True, custom_root='root', ids=False, attr_type=True):
         addline('<%s>%s</%s>' % (custom_root, convert(obj, ids, attr_type, parent=custom_root), custom_root))
     else:
         addline(convert(obj, ids, attr_type, parent=''))
+    reset_unique_ids()
     return ''.join(output).encode('utf-8')
-
@@ -0,0 +1,283 @@
+from glob import glob
+from hashlib import sha1
+from os.path import exists, isabs, join
+from tempfile import NamedTemporaryFile, gettempdir
+from urllib.parse import quote
+import mmap
+import os
+
+from pyracms.models import DBSession, Files
+from pyramid.path import AssetResolver
+from pyramid.response import Response
+from sqlalchemy import or_
+from sqlalchemy.orm import aliased
+from webob.static import FileIter
+from ..models import GameDepBinary, GameDepRevision, GameDepSignature
+from .deltalib import DeltaTooLarge, make_delta, signature
+
+BLOCK_SIZE = 64 * 1024
+ONE_YEAR = 365 * 24 * 60 * 60
+
+class StoredFileNotFound(Exception):
+    pass
+
+class DeltaNotReady(Exception):
+    pass
+
+class DownloadLib():
+    """
+    A library to serve uploaded gamedep files from disk.
+    Files are stored by pyracms as <upload path>/<uuid>/<name>, the
+    upload path comes from the hypernucleus.upload_path setting and may
+    be an asset spec.
+    Usage examples:
+    d = DownloadLib(request)
+    d.show(5)                   # Files row 5, if a binary or source uses it
+    d.response(d.show(5))       # Response streaming it
+    d.delta_allowed(old, new)   # Whether old and new are the same binary
+    d.write_delta(old, new)     # Work out the delta from old to new
+    d.delta_response(old, new)  # Response with it, once written
+    """
+
+    def __init__(self, request):
+        self.request = request
+        settings = request.registry.settings
+        self.upload_path = upload_path(settings)
+        self.block_size = int(settings.get("hypernucleus.delta_block_size",
+                                           16384))
+        self.delta_path = settings.get("hypernucleus.delta_cache_path",
+                                       join(gettempdir(),
+                                            "hypernucleus-deltas"))
+
+    def query(self):
+        """
+        Query files used by a binary or a revision's source code
+        """
+        used = or_(
+            DBSession.query(GameDepBinary.id).filter(
+                GameDepBinary.file_id == Files.id).exists(),
+            DBSession.query(GameDepRevision.id).filter(
+                GameDepRevision.file_id == Files.id).exists())
+        return DBSession.query(Files).filter(used)
+
+    def show(self, file_id):
+        """
+        Get a file used by a binary or a revision's source code
+        """
+        try:
+            file_id = int(file_id)
+        except (TypeError, ValueError):
+            raise StoredFileNotFound
+        file_obj = self.query().filter(Files.id == file_id).first()
+        if not file_obj:
+            raise StoredFileNotFound
+        return file_obj
+
+    def show_uuid(self, uuid):
+        """
+        Get a file by the uuid the catalog feeds list it under
+        """
+        file_obj = self.query().filter(Files.uuid == uuid).first()
+        if not file_obj:
+            raise StoredFileNotFound
+        return file_obj
+
+    def binary_id(self, file_obj, binary_id=None):
+        """
+        Get the binary a download is for. Files can be shared by
+        several binaries, so binary_id picks one of them, otherwise
+        the oldest binary using the file gets the download.
+        """
+        binary_ids = [x for x, in DBSession.query(GameDepBinary.id).filter(
+                                    GameDepBinary.file_id == file_obj.id
+                                    ).order_by(GameDepBinary.id)]
+        try:
+            if int(binary_id) in binary_ids:
+                return int(binary_id)
+        except (TypeError, ValueError):
+            pass
+        if binary_ids:
+            return binary_ids[0]
+
+    def path(self, file_obj):
+        """
+        Get the location of a file on disk
+        """
+        return join(self.upload_path, file_obj.uuid, file_obj.name)
+
+    def response(self, file_obj):
+        """
+        Build a response for a file.
+        Whole files go through wsgi.file_wrapper so the server can use
+        sendfile, Range requests get WebOb's FileIter, which seeks to the
+        range instead of reading the file up to it. WebOb also handles
+        If-Range, If-None-Match and HEAD. A file's content never changes
+        under its id, an update writes a new one, so it can be cached for
+        a long time.
+        """
+        return self.file_response(self.path(file_obj), file_obj.mimetype,
+                                  file_obj.name, file_obj.uuid)
+
+    def file_response(self, path, mimetype, name, tag):
+        """
+        Build a response for a file on disk, see response
+        """
+        try:
+            fobj = open(path, "rb")
+        except (IOError, OSError):
+            raise StoredFileNotFound
+        stat = os.fstat(fobj.fileno())
+        file_wrapper = self.request.environ.get("wsgi.file_wrapper")
+        if self.request.range is None and file_wrapper:
+            app_iter = file_wrapper(fobj, BLOCK_SIZE)
+        else:
+            app_iter = FileIter(fobj)
+        res = Response(content_type=mimetype or "application/octet-stream",
+                       conditional_response=True)
+        res.app_iter = app_iter
+        res.content_length = stat.st_size
+        res.last_modified = stat.st_mtime
+        res.etag = sha1(("%s-%s-%s" % (tag, stat.st_size,
+                                       int(stat.st_mtime))).encode()
+                        ).hexdigest()
+        res.accept_ranges = "bytes"
+        res.cache_control = "public, max-age=%s" % ONE_YEAR
+        res.content_disposition = content_disposition(name)
+        return res
+
+    def signature(self, file_obj, fp=None):
+        """
+        Get the block signature of a file, working it out and storing
+        it the first time. fp is an open copy of the file, if at hand.
+        """
+        sig = DBSession.query(GameDepSignature).filter_by(
+                                            file_id=file_obj.id).first()
+        if sig:
+            return sig
+        if fp is None:
+            try:
+                with open(self.path(file_obj), "rb") as fp:
+                    packed = signature(fp, self.block_size)
+            except (IOError, OSError):
+                raise StoredFileNotFound
+        else:
+            packed = signature(fp, self.block_size)
+        sig = GameDepSignature(file_obj.id, self.block_size, packed)
+        DBSession.add(sig)
+        return sig
+
+    def delta_allowed(self, old_obj, new_obj):
+        """
+        Whether there are binaries of old_obj and new_obj for the same
+        page, operating system and architecture. Deltas are only worked
+        out between versions of the same binary.
+        """
+        if old_obj.id == new_obj.id:
+            return False
+        old_bin = aliased(GameDepBinary)
+        old_rev = aliased(GameDepRevision)
+        return DBSession.query(GameDepBinary.id).join(
+                    GameDepRevision,
+                    GameDepBinary.revision_id == GameDepRevision.id).join(
+                    old_bin,
+                    (old_bin.operatingsystem_id ==
+                     GameDepBinary.operatingsystem_id) &
+                    (old_bin.architecture_id ==
+                     GameDepBinary.architecture_id)).join(
+                    old_rev,
+                    (old_rev.id == old_bin.revision_id) &
+                    (old_rev.page_id == GameDepRevision.page_id)).filter(
+                    GameDepBinary.file_id == new_obj.id,
+                    old_bin.file_id == old_obj.id).first() is not None
+
+    def delta_name(self, old_obj, new_obj):
+        return "%s-%s.delta" % (old_obj.uuid, new_obj.uuid)
+
+    def write_delta(self, old_obj, new_obj):
+        """
+        Work out the delta turning old_obj into new_obj and write it to
+        hypernucleus.delta_cache_path. When most of the new file would
+        be sent anyway a .toolarge marker is written instead, so that
+        is only found out once. Slow, run it off the request.
+        """
+        path = join(self.delta_path, self.delta_name(old_obj, new_obj))
+        if exists(path) or exists(path + ".toolarge"):
+            return
+        sig = self.signature(old_obj)
+        if not os.path.isdir(self.delta_path):
+            os.makedirs(self.delta_path)
+        try:
+            source = open(self.path(new_obj), "rb")
+        except (IOError, OSError):
+            raise StoredFileNotFound
+        with source, NamedTemporaryFile(dir=self.delta_path,
+                                        delete=False) as output:
+            try:
+                if os.fstat(source.fileno()).st_size:
+                    data = mmap.mmap(source.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+                else:
+                    data = b""
+                try:
+                    make_delta(sig.signature, sig.block_size, data,
+                               output.write)
+                finally:
+                    if data:
+                        data.close()
+            except DeltaTooLarge:
+                output.close()
+                os.remove(output.name)
+                open(path + ".toolarge", "wb").close()
+                return
+            except Exception:
+                output.close()
+                os.remove(output.name)
+                raise
+        os.replace(output.name, path)
+
+    def delta_response(self, old_obj, new_obj):
+        """
+        Build a response with the delta turning old_obj into new_obj.
+        Raises DeltaTooLarge when write_delta found most of the new file
+        would be sent anyway, DeltaNotReady if it has not run yet.
+        """
+        name = self.delta_name(old_obj, new_obj)
+        path = join(self.delta_path, name)
+        if exists(path + ".toolarge"):
+            raise DeltaTooLarge
+        if not exists(path):
+            raise DeltaNotReady
+        return self.file_response(path, "application/octet-stream",
+                                  name, name)
+
+    def forget(self, file_obj):
+        """
+        Remove the signature and cached deltas of a file being deleted
+        """
+        DBSession.query(GameDepSignature).filter_by(
+                                            file_id=file_obj.id).delete()
+        for path in glob(join(self.delta_path, "*%s*.delta*" %
+                                               file_obj.uuid)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def content_disposition(name):
+    """
+    Get an attachment Content-Disposition for a file name, with an ASCII
+    fallback for clients that do not understand filename* (RFC 6266)
+    """
+    fallback = "".join(x if " " <= x < "\x7f" and x not in '"\\' else "_"
+                       for x in name)
+    return "attachment; filename=\"%s\"; filename*=UTF-8''%s" % (
+                fallback, quote(name, safe=""))
+
+def upload_path(settings):
+    """
+    Get the upload directory from the settings
+    """
+    path = settings.get("hypernucleus.upload_path", "pyracms:static/uploads")
+    if not isabs(path) and ":" in path:
+        path = AssetResolver().resolve(path).abspath()
+    return path
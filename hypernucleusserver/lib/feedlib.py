@@ -0,0 +1,117 @@
+"""
+Streaming serialisers for the catalog feeds.
+The top level values of root may be any iterable (e.g. a generator
+reading the database in batches), the output is the same as serialising
+the fully built dictionary at once.
+"""
+
+import json
+
+# Name of the operating system and architecture of binaries that run
+# everywhere
+PLATFORM_INDEPENDENT = "pi"
+
+def iter_json(root, indent=4):
+    """
+    Yield the same text as json.dumps(root, sort_keys=True, indent=indent)
+    one list element at a time.
+    """
+    outer = "\n" + " " * indent
+    inner = outer + " " * indent
+    if not root:
+        yield "{}"
+        return
+    separator = "{"
+    for key in sorted(root):
+        yield "%s%s%s: " % (separator, outer, json.dumps(key))
+        separator = ","
+        item_separator = "["
+        for item in root[key]:
+            yield item_separator + inner + json.dumps(
+                        item, sort_keys=True, indent=indent).replace("\n",
+                                                                     inner)
+            item_separator = ","
+        if item_separator == "[":
+            yield "[]"
+        else:
+            yield outer + "]"
+    yield "\n}"
+
+def xml_escape(text):
+    return text.replace('&', '&amp;').replace('"', '&quot;').replace(
+                '\'', '&apos;').replace('<', '&lt;').replace('>', '&gt;')
+
+def xml_element(key, value, output, list_item=False):
+    """
+    Append value as XML to output, the way dicttoxml does with
+    attr_type=False after a JSON round trip: dictionary keys sorted,
+    list elements named item. Keys must already be valid XML names.
+    """
+    if isinstance(value, dict):
+        output.append("<%s>" % key)
+        for child in sorted(value):
+            xml_element(child, value[child], output)
+        output.append("</%s>" % key)
+    elif isinstance(value, (list, tuple)):
+        # dicttoxml leaves a space behind for nested lists
+        output.append("<%s >" % key if list_item else "<%s>" % key)
+        for item in value:
+            xml_element("item", item, output, True)
+        output.append("</%s>" % key)
+    elif value is None:
+        output.append("<%s></%s>" % (key, key))
+    elif isinstance(value, str):
+        output.append("<%s>%s</%s>" % (key, xml_escape(value), key))
+    else:
+        output.append("<%s>%s</%s>" % (key, value, key))
+
+def iter_xml(root, custom_root="hypernucleus"):
+    """
+    Yield the same text as
+    dicttoxml(json.loads(json.dumps(root, sort_keys=True)),
+              custom_root=custom_root,
+              attr_type=False)
+    one list element at a time, without the JSON round trip.
+    """
+    yield '<?xml version="1.0" encoding="UTF-8" ?><%s>' % custom_root
+    for key in sorted(root):
+        yield "<%s>" % key
+        for item in root[key]:
+            output = []
+            xml_element("item", item, output, True)
+            yield "".join(output)
+        yield "</%s>" % key
+    yield "</%s>" % custom_root
+
+def platform_matches(operatingsystem, architecture, binary_os, binary_arch):
+    """
+    Check if a binary built for binary_os/binary_arch runs on
+    operatingsystem/architecture
+    """
+    return (binary_os in (operatingsystem, PLATFORM_INDEPENDENT) and
+            binary_arch in (architecture, PLATFORM_INDEPENDENT))
+
+def platform_catalog(root, operatingsystem, architecture):
+    """
+    Copy a catalog dictionary keeping only the binaries that run on
+    operatingsystem/architecture, including platform independent ones.
+    """
+    result = dict(root)
+    result["gamedep"] = []
+    for entry in root["gamedep"]:
+        filtered = {}
+        for key, gamedepdict in entry.items():
+            gamedepdict = dict(gamedepdict)
+            revisions = []
+            for revdict in gamedepdict["revisions"]:
+                revdict = dict(revdict)
+                revdict["binaries"] = [x for x in revdict["binaries"]
+                                       if platform_matches(
+                                            operatingsystem, architecture,
+                                            x["operating_system"],
+                                            x["architecture"])]
+                revisions.append(revdict)
+            gamedepdict["revisions"] = revisions
+            filtered[key] = gamedepdict
+        result["gamedep"].append(filtered)
+    return result
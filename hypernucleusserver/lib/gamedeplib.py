@@ -1,13 +1,21 @@
-from pyracms.lib.filelib import FileLib
 from pyracms.lib.settingslib import SettingsLib
 from ..models import (OperatingSystems, Architectures, GameDepBinary,
     GameDepPage, GameDepRevision, GameDepTags, GameDepDependency, GameDepVotes)
 from pyracms.lib.taglib import TagLib, GAMEDEP
 from pyracms.models import DBSession, Files
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import subqueryload
 from sqlalchemy.orm.exc import NoResultFound
+from functools import wraps
 import transaction
 from os.path import join
+from .bloblib import BlobLib
+from .changelib import ChangeLib
+from .depgraphlib import dependency_graph
+from .pipelinelib import lock, pipeline
+from .platformlib import platforms
+from .requestcachelib import RequestCache
+from .snapshotlib import catalog_snapshot
 
 class GameDepNotFound(Exception):
     pass
@@ -24,6 +32,9 @@ class BinaryNotFound(Exception):
 class GameDepFound(Exception):
     pass
 
+class ProcessingNotFinished(Exception):
+    pass
+
 class InvalidGameDepType(Exception):
     pass
 
@@ -33,6 +44,20 @@ class AlreadyVoted(Exception):
 GAME = "game"
 DEP = "dep"
 
+def catalog_mutator(func):
+    """
+    Decorate a GameDepLib method that changes what the catalog feeds
+    contain, so the cached feeds are rebuilt once the transaction commits.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            args[0].cache.clear()
+            catalog_snapshot.invalidate_on_commit()
+    return wrapper
+
 class GameDepLib():
     """
     A library to manage the Games and Dependencies database.
@@ -43,6 +68,7 @@ class GameDepLib():
     # or
     # Make instance of class for Dependencies
     gd = GameDepLib(DEP)                 
+    gd = GameDepLib(GAME, request)       # Share lookups within a request
     gd.list()                            # To list games/deps
     gd.show("Front_Page")                # Get the database row of Front_Page
     gd.exists("NotThere")                # Check to see if page exists
@@ -66,11 +92,16 @@ class GameDepLib():
                 admin)         # To delete page
     """
     
-    def __init__(self, gamedep_type):
+    def __init__(self, gamedep_type, request=None):
         if not gamedep_type in [GAME, DEP]:
             raise InvalidGameDepType
         self.gamedep_type = gamedep_type
+        if request is not None:
+            self.cache = request.gamedep_cache
+        else:
+            self.cache = RequestCache(enabled=False)
         self.t = TagLib(GameDepTags, GAMEDEP)
+        self.c = ChangeLib()
 
     def list(self): #@ReservedAssignment
         """
@@ -85,6 +116,50 @@ class GameDepLib():
             result.add(gamedep.name)
         return result
     
+    def search(self, after=None, limit=50, tag=None, published_only=False,
+               operatingsystem=None, architecture=None, owner=None,
+               updated_since=None):
+        """
+        Get up to limit pages with an id above after, ordered by id.
+        operatingsystem and architecture match pages that have a binary
+        for them, owner is a user name.
+        """
+        query = DBSession.query(GameDepPage).filter(
+                            GameDepPage.gamedeptype == self.gamedep_type)
+        if after:
+            query = query.filter(GameDepPage.id > int(after))
+        if tag:
+            query = query.filter(GameDepPage.tags.any(GameDepTags.name == tag))
+        if owner:
+            query = query.filter(GameDepPage.owner.has(name=owner))
+        if updated_since:
+            query = query.filter(GameDepPage.updated >= updated_since)
+        revisions = DBSession.query(GameDepRevision.id).filter(
+                            GameDepRevision.page_id == GameDepPage.id)
+        if published_only:
+            revisions = revisions.filter(GameDepRevision.published == True)
+            query = query.filter(revisions.exists())
+        if operatingsystem or architecture:
+            binaries = revisions.join(GameDepBinary,
+                            GameDepBinary.revision_id == GameDepRevision.id)
+            if operatingsystem:
+                os_obj = platforms.show_name(OperatingSystems,
+                                             operatingsystem)
+                if not os_obj:
+                    return []
+                binaries = binaries.filter(
+                            GameDepBinary.operatingsystem_id == os_obj.id)
+            if architecture:
+                arch_obj = platforms.show_name(Architectures, architecture)
+                if not arch_obj:
+                    return []
+                binaries = binaries.filter(
+                            GameDepBinary.architecture_id == arch_obj.id)
+            query = query.filter(binaries.exists())
+        return query.options(subqueryload(GameDepPage.tags)).order_by(
+                        GameDepPage.id).limit(limit).all()
+
+    @catalog_mutator
     def create(self, name, display_name, description, tags, owner, request):
         """
         Add a new page
@@ -105,18 +180,27 @@ class GameDepLib():
                 album = g.create_album(name, display_name, owner)
                 page.album_id = album
             DBSession.add(page)
+            DBSession.flush()
+            self.c.record("create", page)
+            dependency_graph.on_commit("add_page", page.id, page.name)
 
+    @catalog_mutator
     def update(self, name, newname, display_name, description, tags):
         """
         Update a page
         Raise GameDepNotFound if page does not exist
         """
         page = self.show(name)[0]
+        if page.name != newname:
+            self.c.record("rename", page)
+            dependency_graph.on_commit("rename_page", page.id, newname)
         page.name = newname
         page.display_name = display_name
         page.description = description
         self.t.set_tags(page, tags)
+        self.c.record("update", page)
         
+    @catalog_mutator
     def flip_published(self, name, revision):
         rev = self.show(name, revision)[1]
         if rev.published == False:
@@ -124,60 +208,78 @@ class GameDepLib():
                 raise SourceCodeNotFound
             if self.gamedep_type == DEP and not len(rev.binary):
                 raise BinaryNotFound
+            if pipeline.unfinished(rev):
+                raise ProcessingNotFinished
         rev.published = not(rev.published)
+        self.c.record("publish" if rev.published else "unpublish",
+                      rev.page, rev.id)
 
+    @catalog_mutator
     def create_source(self, name, revision, source, mimetype, 
-                      filename, request):
+                      filename, request, sha256=None, members=None):
         """
-        Add a new source code
+        Add a new source code, from a file object or by the hash of
+        already stored bytes. A new file is deduplicated in the
+        background.
         """
-        rev = self.show(name, revision)[1]
-        file_lib = FileLib(request)
+        rev = lock(self.show(name, revision)[1])
+        blob_lib = BlobLib(request)
+        if sha256:
+            srcobj = blob_lib.link(sha256)
+        else:
+            srcobj = blob_lib.store(filename, source, mimetype)
         if rev.file_obj:
-            file_lib.delete(rev.file_obj)
-        srcobj = file_lib.write(filename, source, mimetype)
+            blob_lib.release(rev.file_obj)
         rev.file_obj = srcobj
+        if not sha256:
+            pipeline.enqueue("source", rev, srcobj, members=members)
+        self.c.record("source", rev.page, rev.id)
 
     def show_binary(self, binary_id):
-        try:
-            bin_obj = DBSession.query(GameDepBinary).filter_by(
-                                            id=binary_id).one()
-        except NoResultFound:
+        bin_obj = self.cache.get(("binary", binary_id),
+                                 lambda: DBSession.query(GameDepBinary
+                                            ).filter_by(id=binary_id).first())
+        if not bin_obj:
             raise GameDepNotFound
         return bin_obj
     
+    @catalog_mutator
     def create_binary(self, name, revision, operatingsystem, architecture, 
-                      binary, mimetype, filename, request):
+                      binary, mimetype, filename, request, sha256=None,
+                      members=None):
         """
-        Add a new binary
+        Add a new binary, from a file object or by the hash of already
+        stored bytes. A new file is deduplicated in the background.
         """
-        try:
-            os_obj = DBSession.query(OperatingSystems).filter_by(
-                                                id=operatingsystem).one()
-            arch_obj = DBSession.query(Architectures).filter_by(
-                                                id=architecture).one()
-        except NoResultFound:
+        os_obj = platforms.show(OperatingSystems, operatingsystem)
+        arch_obj = platforms.show(Architectures, architecture)
+        if not os_obj or not arch_obj:
             raise GameDepNotFound
         
         rev = self.show(name, revision)[1]
-        file_lib = FileLib(request)
-        aio_obj = file_lib.write(filename, binary, mimetype)
+        blob_lib = BlobLib(request)
+        if sha256:
+            aio_obj = blob_lib.link(sha256)
+        else:
+            aio_obj = blob_lib.store(filename, binary, mimetype)
         bin_obj = GameDepBinary(aio_obj, os_obj, arch_obj)
         rev.binary.append(bin_obj)
+        DBSession.flush()
+        if not sha256:
+            pipeline.enqueue("binary", rev, aio_obj, bin_obj, members)
+        self.c.record("create_binary", rev.page, rev.id, bin_obj.id)
 
+    @catalog_mutator
     def update_binary(self, name, revision, binary_id, operatingsystem, 
                       architecture, binary, request):
         """
         Update a binary
         """
-        try:
-            if not binary:
-                os_obj = DBSession.query(OperatingSystems).filter_by(
-                                                    id=operatingsystem).one()
-                arch_obj = DBSession.query(Architectures).filter_by(
-                                                    id=architecture).one()
-        except NoResultFound:
-            raise GameDepNotFound
+        if not binary:
+            os_obj = platforms.show(OperatingSystems, operatingsystem)
+            arch_obj = platforms.show(Architectures, architecture)
+            if not os_obj or not arch_obj:
+                raise GameDepNotFound
         
         rev = self.show(name, revision)[1]
         bin_obj = None
@@ -192,14 +294,22 @@ class GameDepLib():
             bin_obj.operatingsystem_obj = os_obj
             bin_obj.architecture_obj = arch_obj
         else:
-            file_lib = FileLib(request)
+            lock(bin_obj)
+            blob_lib = BlobLib(request)
             old_name = bin_obj.file_obj.name
             old_mimetype = bin_obj.file_obj.mimetype
-            aio_obj = file_lib.write(old_name, binary, old_mimetype)
-            file_lib.delete(bin_obj.file_obj)
+            members = None
+            if isinstance(binary, dict):
+                members = binary.get('members')
+                binary = binary['fp']
+            aio_obj = blob_lib.store(old_name, binary, old_mimetype)
+            blob_lib.release(bin_obj.file_obj)
             bin_obj.file_obj = aio_obj
+            pipeline.enqueue("binary", rev, aio_obj, bin_obj, members)
+        self.c.record("update_binary", rev.page, rev.id, bin_obj.id)
 
-    def delete_binary(self, name, revision, bin_id):
+    @catalog_mutator
+    def delete_binary(self, name, revision, bin_id, request):
         """
         Delete a binary
         """
@@ -210,14 +320,20 @@ class GameDepLib():
             if revbin.id == bin_id:
                 binitem = revbin
         if binitem:
+            if lock(binitem).file_obj:
+                BlobLib(request).release(binitem.file_obj)
+                binitem.file_obj = None
             rev.binary.remove(binitem)
             DBSession.delete(binitem)
+            self.c.record("delete_binary", rev.page, rev.id, bin_id)
         else:
             raise GameDepNotFound
 
+    @catalog_mutator
     def create_dependency(self, name, dep_id, rev_id=-1):
         """
-        Add a new dependency
+        Add a new dependency, pinned to rev_id or following the latest
+        published revision if it is -1
         """
         dep_id = int(dep_id)
         try:
@@ -241,6 +357,13 @@ class GameDepLib():
             if pagedep.page.id == dep.id:
                 raise GameDepFound
         page.dependencies.append(rev)
+        if rev_id == -1:
+            DBSession.flush()
+            DBSession.query(GameDepDependency).filter_by(
+                        game_id=page.id, rev_id=rev.id).update(
+                        {"pinned": False}, synchronize_session=False)
+        self.c.record("create_dependency", page, rev.id)
+        dependency_graph.on_commit("add_edge", page.id, rev.id)
 
     def show_dependency(self, page, dep_id):
         """
@@ -254,17 +377,24 @@ class GameDepLib():
         if not found:
             raise GameDepNotFound
         
-    def delete_dependency(self, name, dep_id):
+    @catalog_mutator
+    def delete_dependency(self, name, dep_id, request):
         """
         Delete a dependency
         """
         dep_id = int(dep_id)
         page = self.show(name)[0]
         item = self.show_dependency(page, dep_id)
+        self.release_files(item, BlobLib(request))
         page.dependencies.remove(item)
         DBSession.flush()
         DBSession.delete(item)
+        self.c.record("delete_dependency", page, item.id)
+        # The dependency's revision row is deleted along with the link
+        dependency_graph.on_commit("remove_edge", page.id, item.id)
+        dependency_graph.on_commit("remove_revision", item.id)
         
+    @catalog_mutator
     def create_revision(self, name, version, moduletype):
         """
         Add a new revision
@@ -275,7 +405,11 @@ class GameDepLib():
             page, rev = self.show(name, no_revision_error=False)
             rev = GameDepRevision(version, moduletype)
             page.revisions.append(rev)
+            DBSession.flush()
+            self.c.record("create_revision", page, rev.id)
+            dependency_graph.on_commit("add_revision", rev.id, page.id)
             
+    @catalog_mutator
     def update_revision(self, name, revision, version, moduletype):
         """
         Update a revision
@@ -285,25 +419,38 @@ class GameDepLib():
         rev = self.show(name, revision)[1]
         rev.version = version
         rev.moduletype = moduletype
+        self.c.record("update_revision", rev.page, rev.id)
     
+    @catalog_mutator
     def delete_revision(self, name, revision, request):
         """
         Delete a revision
         Raise GameDepNotFound if page does not exist
         """
-        f = FileLib(request)
         rev = self.show(name, revision)[1]
-        files = set()
+        self.release_files(rev, BlobLib(request))
+        self.c.record("delete_revision", rev.page, rev.id)
+        dependency_graph.on_commit("remove_revision", rev.id)
+        DBSession.delete(rev)
+
+    def release_files(self, rev, blob_lib):
+        """
+        Drop the references a revision and its binaries hold to their
+        files, before deleting the revision or cascading to it
+        """
+        lock(rev)
+        files = []
         if rev.file_obj:
-            files.add(rev.file_obj)
+            files.append(rev.file_obj)
             rev.file_obj = None
         for item in rev.binary:
-            files.add(item.file_obj)
-            item.file_obj = None
+            if lock(item).file_obj:
+                files.append(item.file_obj)
+                item.file_obj = None
         for item in files:
-            f.delete(item)
-        DBSession.delete(rev)
+            blob_lib.release(item)
         
+    @catalog_mutator
     def delete(self, name, request):
         """
         Delete a page
@@ -319,6 +466,13 @@ class GameDepLib():
         if page.album_id != -1:
             from pyracms_gallery.lib.gallerylib import GalleryLib
             GalleryLib().delete_album(page.album_id, request)
+        self.c.record("delete", page)
+        # Deleting a page cascades to the revisions it depends on
+        blob_lib = BlobLib(request)
+        for item in page.dependencies:
+            self.release_files(item, blob_lib)
+            dependency_graph.on_commit("remove_revision", item.id)
+        dependency_graph.on_commit("remove_page", page.id)
         DBSession.delete(page)
 
     def exists(self, name, version=None, raise_if_found=False):
@@ -326,16 +480,14 @@ class GameDepLib():
         Check to see if a page exists
         Return True/False
         """
-        try:
-            page = DBSession.query(GameDepPage).filter_by(
-                                            name=name,
-                                            gamedeptype=self.gamedep_type
-                                            ).one()
-        except NoResultFound:
+        page = self.show_page(name)
+        if not page:
             return False
         
         if version:
-            versions = [x.version for x in page.revisions]
+            versions = self.cache.get(("versions", page.id),
+                                      lambda: [x.version for x in
+                                               page.revisions])
             if not version in versions:
                 return False
         if raise_if_found:
@@ -344,68 +496,56 @@ class GameDepLib():
     
     def list_operatingsystems(self, with_display_name=True):
         """
-        Get a Operating System list from database.
+        Get a Operating System list from the platform cache.
         """
         if with_display_name:
-            oslist = DBSession.query(OperatingSystems.id, 
-                                    OperatingSystems.display_name).order_by(
-                                    OperatingSystems.id).all()
-            oslist = [(x[0], x[1]) for x in oslist]
-        else:
-            oslist = DBSession.query(OperatingSystems.id).order_by(
-                                    OperatingSystems.id).all()
-            oslist = [x[0] for x in oslist]
-        return oslist
+            return [(x.id, x.display_name)
+                    for x in platforms.list(OperatingSystems)]
+        return [x.id for x in platforms.list(OperatingSystems)]
     
     def list_architectures(self, with_display_name=True):
         """
-        Get a Architecture list from database.
+        Get a Architecture list from the platform cache.
         """
         if with_display_name:
-            archlist = DBSession.query(Architectures.id, 
-                                    Architectures.display_name).order_by(
-                                    Architectures.id).all()
-            archlist = [(x[0], x[1]) for x in archlist]
-        else:
-            archlist = DBSession.query(Architectures.id).order_by(
-                                    Architectures.id).all()
-            archlist = [x[0] for x in archlist]
-        return archlist
+            return [(x.id, x.display_name)
+                    for x in platforms.list(Architectures)]
+        return [x.id for x in platforms.list(Architectures)]
     
     def dependency_dropdown(self, with_display_name=True):
-        result = []
-        page = DBSession.query(GameDepPage).filter_by(gamedeptype="dep")
-        for x in page:
-            if x.revisions.count():
-                i = 0
-                for revision in x.revisions:
-                    if revision.published:
-                        i += 1
-                if i > 0:
-                    if with_display_name:
-                        result.append((str(x.id), 
-                                       "%s (%s)" % (x.display_name, 
-                                                    x.name)))
-                    else:
-                        result.append(str(x.id))
-        return result
+        """
+        Get the dependencies with a published revision, for the
+        dependency picker. Cached until the catalog changes.
+        """
+        def build():
+            published = DBSession.query(GameDepRevision.id).filter(
+                                GameDepRevision.page_id == GameDepPage.id,
+                                GameDepRevision.published == True).exists()
+            return DBSession.query(GameDepPage.id, GameDepPage.name,
+                                   GameDepPage.display_name).filter(
+                                GameDepPage.gamedeptype == DEP,
+                                published).order_by(GameDepPage.id).all()
+        pages = catalog_snapshot.cached(("dependency_dropdown",), build)
+        if with_display_name:
+            return [(str(x[0]), "%s (%s)" % (x[2], x[1])) for x in pages]
+        return [str(x[0]) for x in pages]
     
     def revision_dropdown(self, dep_id, with_display_name=True):
-        initial_item = [("-1", "Use Latest Version")]
-        if with_display_name:
-            rev = DBSession.query(GameDepRevision.id, 
-                                   GameDepRevision.version).filter_by(
-                                            page_id=dep_id, published=True)
-        else:
-            rev = DBSession.query(GameDepRevision.id).filter_by(
-                                            page_id=dep_id, published=True)
-        result = initial_item 
-        result.extend(rev.all())
+        """
+        Get the published revisions of a dependency, for the revision
+        picker. Cached until the catalog changes.
+        """
+        revisions = catalog_snapshot.cached(
+                        ("revision_dropdown", str(dep_id)),
+                        lambda: [("-1", "Use Latest Version")] + [
+                            (str(x[0]), str(x[1])) for x in
+                            DBSession.query(GameDepRevision.id,
+                                            GameDepRevision.version
+                                            ).filter_by(page_id=dep_id,
+                                                        published=True)])
         if with_display_name:
-            result = [(str(x[0]), str(x[1])) for x in result]
-        else:
-            result = [str(x[0]) for x in result]
-        return result
+            return list(revisions)
+        return [x[0] for x in revisions]
     
     def show(self, name, revision=None, no_revision_error=True):
         """
@@ -418,23 +558,30 @@ class GameDepLib():
             raise GameDepNotFound
         
         if not revision:
-            try:
-                page = DBSession.query(GameDepPage).filter_by(
-                                                name=name,
-                                                gamedeptype=self.gamedep_type
-                                                ).one()
-            except NoResultFound:
+            page = self.show_page(name)
+            if not page:
                 raise GameDepNotFound("NoResultFound")
-            if not page.revisions.count() and no_revision_error:
+            if no_revision_error and not self.cache.get(
+                        ("revision_count", page.id), page.revisions.count):
                 raise GameDepNotFound("no_revision_error")
             return (page, page.revisions)
         else:
-            try:
-                page, rev = self.show(name)
-                rev_result = rev.filter_by(id=revision).one()
-                return (page, rev_result)
-            except NoResultFound:
+            page, rev = self.show(name)
+            rev_result = self.cache.get(("revision", page.id, revision),
+                                        rev.filter_by(id=revision).first)
+            if not rev_result:
                 raise GameDepNotFound
+            return (page, rev_result)
+
+    def show_page(self, name):
+        """
+        Get a page by name, None if it does not exist
+        """
+        return self.cache.get(("page", self.gamedep_type, name),
+                              lambda: DBSession.query(GameDepPage).filter_by(
+                                            name=name,
+                                            gamedeptype=self.gamedep_type
+                                            ).first())
             
     def add_vote(self, db_obj, user, like):
         """
@@ -2,10 +2,16 @@ import json
 
 from pyracms.lib.settingslib import SettingsLib
 from pyracms.lib.widgetlib import WidgetLib
-from pyracms.models import DBSession
+from pyracms.models import DBSession, Files
+from sqlalchemy import desc
+from sqlalchemy.orm import joinedload, subqueryload
 
-from .dicttoxml import dicttoxml
-from ..models import GameDepPage, Architectures, OperatingSystems
+from .changelib import ChangeLib
+from .feedlib import iter_xml
+from .gamedeplib import GAME, DEP
+from ..models import (GameDepPage, GameDepRevision, GameDepBinary,
+                      GameDepDependency, GameDepTags, Architectures,
+                      OperatingSystems)
 from os.path import splitext
 
 class OutputLib():
@@ -14,50 +20,211 @@ class OutputLib():
     """
     def __init__(self, request):
         self.uploadurl = WidgetLib().get_upload_url(request)
+        self.downloadurl = request.application_url + "/outputs/download/"
         self.gallery = None
         if SettingsLib().has_setting("PYRACMS_GALLERY"):
             from pyracms_gallery.lib.gallerylib import GalleryLib
             self.gallery = GalleryLib()
 
-    def show_xml(self):
+    def show_xml(self, root=None):
         """
         Serialize gamedep into xml
         """
-        return dicttoxml(json.loads(self.show_json()), 
-                         custom_root="hypernucleus", attr_type=False)
+        if root is None:
+            root = self.show_dict()
+        return "".join(iter_xml(root)).encode()
     
     def show_json(self):
         """
         Serialise gamedep into json
         """
+        return json.dumps(self.show_dict(), sort_keys=True, indent=4)
+
+    def show_feeds(self):
+        """
+        Serialise gamedep into every feed format, for CatalogSnapshot.
+        "cursor" is the change feed sequence number the feeds are
+        up to date with.
+        """
+        cursor = ChangeLib().latest()
+        root = self.show_dict()
+        return {"json": json.dumps(root, sort_keys=True, indent=4).encode(),
+                "xml": self.show_xml(root),
+                "cursor": str(cursor).encode()}
+
+    def show_changes(self, cursor, limit=500):
+        """
+        Serialise the changes after cursor into json, along with the
+        current entries of the pages they touched. Pages that no longer
+        have an entry were deleted or lost their last revision.
+        """
+        changes = ChangeLib().since(cursor, limit + 1)
+        result = {"cursor": cursor,
+                  "more": len(changes) > limit,
+                  "changes": [],
+                  "gamedep": []}
+        changes = changes[:limit]
+        for change in changes:
+            changedict = {}
+            changedict["sequence"] = change.id
+            changedict["action"] = change.action
+            changedict["type"] = {GAME: "game",
+                                  DEP: "dependency"}[change.gamedeptype]
+            changedict["name"] = change.name
+            changedict["created"] = str(change.created)
+            result["changes"].append(changedict)
+        if changes:
+            result["cursor"] = changes[-1].id
+            page_ids = list(set(x.page_id for x in changes))
+            result["gamedep"].extend(self.iter_gamedep(page_ids))
+        return json.dumps(result, sort_keys=True, indent=4)
+
+    def show_dict(self, batch_size=None):
+        """
+        Build the whole catalog as a dictionary
+        With a batch_size, "gamedep" is a generator that reads that many
+        pages at a time, for use with feedlib.iter_json.
+        """
         root = {"operatingsystems": [], 
                 "architectures": [],
                 "gamedep": []}
-        key = None
-        gametype = "game"
-        deptype = "dep"
-        game = DBSession.query(GameDepPage).filter_by(gamedeptype=gametype
-                                                      ).all()
-        dep = DBSession.query(GameDepPage).filter_by(gamedeptype=deptype).all()
-        oslist = DBSession.query(OperatingSystems)
-        archlist = DBSession.query(Architectures)
-        for os in oslist:
+        for os in DBSession.query(OperatingSystems):
             osdict = {}
             osdict["name"] = os.name
             osdict["display_name"] = os.display_name
             root["operatingsystems"].append(osdict)
-        for arch in archlist:
+        for arch in DBSession.query(Architectures):
             archdict = {}
             archdict["name"] = arch.name
             archdict["display_name"] = arch.display_name
             root["architectures"].append(archdict)
-        for gamedep in [game, dep]:
-            if gamedep == game:
-                key = "game"
-            else:
-                key = "dependency"
-            for item in gamedep:
-                if item.revisions.count() == 0:
+        if batch_size:
+            root["gamedep"] = self.iter_gamedep_batches(batch_size)
+        else:
+            root["gamedep"].extend(self.iter_gamedep())
+        return root
+
+    def iter_gamedep_batches(self, batch_size):
+        """
+        Same as iter_gamedep, but only holds batch_size pages at a time
+        """
+        for gamedeptype in (GAME, DEP):
+            last_id = 0
+            while True:
+                page_ids = [x[0] for x in DBSession.query(
+                                GameDepPage.id).filter(
+                                GameDepPage.gamedeptype == gamedeptype,
+                                GameDepPage.id > last_id).order_by(
+                                GameDepPage.id).limit(batch_size)]
+                if not page_ids:
+                    break
+                for item in self.iter_gamedep(page_ids):
+                    yield item
+                last_id = page_ids[-1]
+
+    def file_url(self, uuid, name):
+        """
+        Get the public url of an uploaded file
+        """
+        return self.uploadurl + uuid + "/" + name
+
+    def download_url(self, binary_id, uuid, name):
+        """
+        Get the url of a binary that counts its downloads
+        """
+        return "%s%s/%s?binary=%s" % (self.downloadurl, uuid, name, binary_id)
+
+    def iter_gamedep(self, page_ids=None):
+        """
+        Yield a {"game"|"dependency": dict} entry for every page that has
+        at least one revision, games first.
+        The whole graph is fetched up front in a fixed number of queries
+        and joined in memory, so the query count does not grow with the
+        catalog. Pass page_ids to only serialise those pages.
+        """
+        def limit(query, column):
+            if page_ids is None:
+                return query
+            return query.filter(column.in_(page_ids))
+
+        pages = limit(DBSession.query(GameDepPage).filter(
+                            GameDepPage.gamedeptype.in_([GAME, DEP])),
+                      GameDepPage.id).order_by(GameDepPage.id).all()
+
+        # Pages that have any revision at all, published or not
+        has_revisions = set(x[0] for x in limit(
+                                DBSession.query(GameDepRevision.page_id),
+                                GameDepRevision.page_id).distinct())
+
+        oslist = dict(DBSession.query(OperatingSystems.id,
+                                      OperatingSystems.name))
+        archlist = dict(DBSession.query(Architectures.id,
+                                        Architectures.name))
+
+        tags = {}
+        for game_id, name in limit(DBSession.query(GameDepTags.game_id,
+                                                   GameDepTags.name),
+                                   GameDepTags.game_id
+                                   ).order_by(GameDepTags.id):
+            tags.setdefault(game_id, []).append(name)
+
+        dependencies = {}
+        for game_id, dep_page_id, dep_name, version in limit(
+                DBSession.query(GameDepDependency.game_id,
+                                GameDepPage.id, GameDepPage.name,
+                                GameDepRevision.version).join(
+                    GameDepRevision,
+                    GameDepDependency.rev_id == GameDepRevision.id).join(
+                    GameDepPage,
+                    GameDepRevision.page_id == GameDepPage.id),
+                GameDepDependency.game_id).order_by(
+                    GameDepDependency.game_id, desc(GameDepRevision.version)):
+            dependencies.setdefault(game_id, []).append((dep_page_id,
+                                                         dep_name, version))
+
+        revisions = {}
+        for rev in limit(DBSession.query(GameDepRevision.id,
+                                         GameDepRevision.page_id,
+                                         GameDepRevision.version,
+                                         GameDepRevision.created,
+                                         GameDepRevision.moduletype,
+                                         Files.uuid, Files.name).outerjoin(
+                            Files, GameDepRevision.file_id == Files.id
+                            ).filter(GameDepRevision.published == True),
+                         GameDepRevision.page_id).order_by(
+                            GameDepRevision.page_id,
+                            desc(GameDepRevision.version)):
+            revisions.setdefault(rev.page_id, []).append(rev)
+
+        binaries = {}
+        for binary_id, revision_id, os_id, arch_id, uuid, name in limit(
+                DBSession.query(GameDepBinary.id, GameDepBinary.revision_id,
+                                GameDepBinary.operatingsystem_id,
+                                GameDepBinary.architecture_id,
+                                Files.uuid, Files.name).join(
+                    Files, GameDepBinary.file_id == Files.id).join(
+                    GameDepRevision,
+                    GameDepBinary.revision_id == GameDepRevision.id).filter(
+                    GameDepRevision.published == True),
+                GameDepRevision.page_id).order_by(GameDepBinary.id):
+            bindict = {}
+            bindict["binary"] = self.download_url(binary_id, uuid, name)
+            bindict["operating_system"] = oslist[os_id]
+            bindict["architecture"] = archlist[arch_id]
+            bindict['uuid'] = uuid
+            bindict['name'] = name
+            binaries.setdefault(revision_id, []).append(bindict)
+
+        pictures = {}
+        if self.gallery:
+            pictures = self.load_pictures(limit(DBSession.query(
+                                    GameDepPage.album_id), GameDepPage.id))
+
+        for gamedeptype, key in ((GAME, "game"), (DEP, "dependency")):
+            for item in pages:
+                if item.gamedeptype != gamedeptype:
+                    continue
+                if item.id not in has_revisions:
                     continue
                 gamedepdict = {}
                 gamedepdict["name"] = item.name
@@ -65,68 +232,62 @@ class OutputLib():
                 gamedepdict["description"] = item.description
                 gamedepdict["created"] = str(item.created)
                 gamedepdict["dependencies"] = []
-                for loopdep in item.dependencies:
+                # A dependency always points at one of the dependency's
+                # own revisions, so it never needs skipping here.
+                for dep_page_id, dep_name, version in dependencies.get(
+                                                            item.id, []):
                     depdict = {}
-                    if loopdep.page.revisions.count() == 0:
-                        continue
-                    depdict['dependency'] = loopdep.page.name
-                    if loopdep:
-                        depdict['version'] = str(loopdep.version)
-                    else:
-                        depdict['version'] = str(loopdep.page.\
-                                                 revisions[0].version)
+                    depdict['dependency'] = dep_name
+                    depdict['version'] = str(version)
                     gamedepdict["dependencies"].append(depdict)
                 gamedepdict["tags"] = []
-                for looptag in item.tags:
-                    if looptag.name.strip():
-                        gamedepdict["tags"].append(looptag.name)
-                gamedepdict["pictures"] = []
-                if self.gallery:
-                    album = self.gallery.show_album(item.album_id)
-                    for pic in album.pictures:
-                        picture = {}
-                        picture['url'] = (self.uploadurl + pic.file_obj.uuid +
-                                          "/" + pic.file_obj.name)
-                        thumb_name = (splitext(pic.file_obj.name)[0] +
-                                      ".thumbnail.png")
-                        picture['thumb_url'] = (self.uploadurl +
-                                                pic.file_obj.uuid +
-                                                "/" + thumb_name)
-                        picture['thumb_name'] = thumb_name
-                        picture['default'] = False
-                        picture['display_name'] = pic.display_name
-                        picture['description'] = pic.description
-                        picture['uuid'] = pic.file_obj.uuid
-                        picture['name'] = pic.file_obj.name
-                        if album.default_picture == pic:
-                            picture['default'] = True
-                        gamedepdict["pictures"].append(picture)
+                for looptag in tags.get(item.id, []):
+                    if looptag.strip():
+                        gamedepdict["tags"].append(looptag)
+                gamedepdict["pictures"] = pictures.get(item.album_id, [])
                 gamedepdict["revisions"] = []
-                for looprev in item.revisions:
-                    if looprev.published:
-                        revdict = {}
-                        revdict["version"] = str(looprev.version)
-                        revdict["created"] = str(looprev.created)
-                        revdict["moduletype"] = looprev.moduletype
-                        if gamedep == game:
-                            revdict["source"]=  self.uploadurl + \
-                                                looprev.file_obj.uuid \
-                                                + "/" + looprev.file_obj.name
-                            revdict['source_uuid'] = looprev.file_obj.uuid
-                            revdict['source_name'] = looprev.file_obj.name
-                        revdict["binaries"] = []
-                        for loopbin in looprev.binary:
-                            bindict = {}
-                            bindict["binary"] = self.uploadurl + \
-                                                loopbin.file_obj.uuid \
-                                                + "/" + loopbin.file_obj.name
-                            bindict["operating_system"] = \
-                                            loopbin.operatingsystem_obj.name
-                            bindict["architecture"] = \
-                                            loopbin.architecture_obj.name
-                            bindict['uuid'] = loopbin.file_obj.uuid
-                            bindict['name'] = loopbin.file_obj.name
-                            revdict["binaries"].append(bindict)
-                        gamedepdict["revisions"].append(revdict)
-                root["gamedep"].append({key: gamedepdict})
-        return json.dumps(root, sort_keys=True, indent=4)
+                for looprev in revisions.get(item.id, []):
+                    revdict = {}
+                    revdict["version"] = str(looprev.version)
+                    revdict["created"] = str(looprev.created)
+                    revdict["moduletype"] = looprev.moduletype
+                    if gamedeptype == GAME:
+                        revdict["source"] = self.file_url(looprev.uuid,
+                                                          looprev.name)
+                        revdict['source_uuid'] = looprev.uuid
+                        revdict['source_name'] = looprev.name
+                    revdict["binaries"] = binaries.get(looprev.id, [])
+                    gamedepdict["revisions"].append(revdict)
+                yield {key: gamedepdict}
+
+    def load_pictures(self, album_ids):
+        """
+        Serialise the pictures of the albums in album_ids (a query),
+        returns a dictionary of album id to picture list.
+        Albums, pictures and their files are loaded in bulk.
+        """
+        from pyracms_gallery.models import GalleryAlbum
+        picture_class = GalleryAlbum.pictures.property.mapper.class_
+        albums = DBSession.query(GalleryAlbum).filter(
+                    GalleryAlbum.id.in_(album_ids.subquery())).options(
+                    subqueryload(GalleryAlbum.pictures).joinedload(
+                                                picture_class.file_obj),
+                    joinedload(GalleryAlbum.default_picture))
+        result = {}
+        for album in albums:
+            result[album.id] = []
+            for pic in album.pictures:
+                uuid = pic.file_obj.uuid
+                name = pic.file_obj.name
+                thumb_name = splitext(name)[0] + ".thumbnail.png"
+                picture = {}
+                picture['url'] = self.file_url(uuid, name)
+                picture['thumb_url'] = self.file_url(uuid, thumb_name)
+                picture['thumb_name'] = thumb_name
+                picture['default'] = album.default_picture == pic
+                picture['display_name'] = pic.display_name
+                picture['description'] = pic.description
+                picture['uuid'] = uuid
+                picture['name'] = name
+                result[album.id].append(picture)
+        return result
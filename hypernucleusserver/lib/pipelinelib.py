@@ -0,0 +1,305 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import json
+import logging
+import threading
+
+from pyracms.models import DBSession, Files
+from pyramid.scripting import prepare
+from sqlalchemy.orm.exc import NoResultFound
+from zope.sqlalchemy import mark_changed
+import transaction
+
+from ..models import GameDepBinary, GameDepJob, GameDepRevision
+from .bloblib import BlobLib
+from .changelib import ChangeLib
+from .downloadlib import DownloadLib, StoredFileNotFound
+from .snapshotlib import catalog_snapshot
+
+log = logging.getLogger(__name__)
+
+class Superseded(Exception):
+    """
+    The binary or revision of a job no longer uses its file
+    """
+
+def lock(owner):
+    """
+    Lock the row of a binary or revision until commit and read it again.
+    Requests replacing its file and the pipeline moving it to a
+    deduplicated one take turns on this lock, so neither overwrites the
+    other's file.
+    """
+    DBSession.refresh(owner, with_for_update=True)
+    return owner
+
+class PipelineLib():
+    """
+    A library to process uploads after the request that stored them.
+    Jobs are rows in gamedepjob, so they outlive the process, and are
+    run on a bounded thread pool once the request commits. A sweeper
+    thread, started by the first request, submits pending jobs, running
+    ones nobody touched within the timeout and failed ones with attempts
+    left, every interval seconds.
+    Usage examples:
+    pipeline.configure(registry, 2)         # At startup
+    pipeline.start()                        # On the first request
+    pipeline.enqueue("binary", rev, file_obj, bin_obj)
+    pipeline.unfinished(rev)                # Jobs keeping rev unpublished
+    pipeline.delta(old_file_id, new_file_id)  # Work out a delta
+    """
+
+    def __init__(self):
+        self.registry = None
+        self.executor = None
+        self.timeout = timedelta(hours=1)
+        self.interval = 300
+        self.attempts = 3
+        self.lock = threading.Lock()
+        self.queued = set()
+        self.deltas = set()
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def configure(self, registry, workers, timeout=3600, interval=300,
+                  attempts=3):
+        with self.lock:
+            self.registry = registry
+            self.timeout = timedelta(seconds=timeout)
+            self.interval = interval
+            self.attempts = attempts
+            if self.executor:
+                self.executor.shutdown(wait=False)
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def enqueue(self, kind, rev, file_obj, bin_obj=None, members=None):
+        """
+        Add a job for a stored file, it runs after the transaction
+        commits
+        """
+        DBSession.flush()
+        job = GameDepJob(kind, rev.id, file_obj.id,
+                         bin_obj.id if bin_obj else None,
+                         None if members is None else json.dumps(members))
+        DBSession.add(job)
+        DBSession.flush()
+        job_id = job.id
+        transaction.get().addAfterCommitHook(
+                            lambda status: status and self.submit(job_id))
+        return job
+
+    def unfinished(self, rev):
+        """
+        Get the jobs of a revision that are not done, for files it
+        still uses
+        """
+        file_ids = [x.file_id for x in rev.binary]
+        if rev.file_id:
+            file_ids.append(rev.file_id)
+        if not file_ids:
+            return []
+        return DBSession.query(GameDepJob).filter(
+                            GameDepJob.revision_id == rev.id,
+                            GameDepJob.file_id.in_(file_ids),
+                            GameDepJob.status != "done").all()
+
+    def list(self, revision_ids):
+        """
+        Get the jobs of some revisions, newest first
+        """
+        if not revision_ids:
+            return []
+        return DBSession.query(GameDepJob).filter(
+                            GameDepJob.revision_id.in_(revision_ids)
+                            ).order_by(GameDepJob.id.desc()).all()
+
+    def show(self, job_id):
+        return DBSession.query(GameDepJob).filter_by(id=job_id).first()
+
+    def submit(self, job_id):
+        """
+        Run a job on the pool, unless it is already queued there
+        """
+        with self.lock:
+            if self.executor is None:
+                log.warning("Job %s queued before the pool was configured",
+                            job_id)
+                return
+            if job_id in self.queued:
+                return
+            self.queued.add(job_id)
+        self.executor.submit(self.run, job_id)
+
+    def delta(self, old_id, new_id):
+        """
+        Write the delta between two files on the pool, unless it is
+        already queued. Returns False if there is no pool.
+        """
+        with self.lock:
+            if self.executor is None:
+                return False
+            if (old_id, new_id) in self.deltas:
+                return True
+            self.deltas.add((old_id, new_id))
+        self.executor.submit(self.run_delta, old_id, new_id)
+        return True
+
+    def run_delta(self, old_id, new_id):
+        env = prepare(registry=self.registry)
+        try:
+            with transaction.manager:
+                d = DownloadLib(env['request'])
+                d.write_delta(d.show(old_id), d.show(new_id))
+        except Exception:
+            log.exception("Delta from file %s to %s failed", old_id, new_id)
+        finally:
+            with self.lock:
+                self.deltas.discard((old_id, new_id))
+            DBSession.remove()
+            env['closer']()
+
+    def runnable(self):
+        """
+        Get the criterion of jobs that may be claimed
+        """
+        stale = datetime.now() - self.timeout
+        return ((GameDepJob.status == "pending") |
+                (((GameDepJob.status == "failed") |
+                  ((GameDepJob.status == "running") &
+                   (GameDepJob.updated < stale))) &
+                 (GameDepJob.attempts < self.attempts)))
+
+    def sweep(self):
+        """
+        Submit every job that may be claimed. Running jobs past the
+        timeout that are out of attempts are marked failed.
+        """
+        stale = datetime.now() - self.timeout
+        with transaction.manager:
+            DBSession.query(GameDepJob).filter(
+                        GameDepJob.status == "running",
+                        GameDepJob.updated < stale,
+                        GameDepJob.attempts >= self.attempts).update(
+                        {"status": "failed", "error": "Timed out."},
+                        synchronize_session=False)
+            mark_changed(DBSession())
+            job_ids = [x for x, in DBSession.query(GameDepJob.id).filter(
+                                self.runnable()).order_by(GameDepJob.id)]
+        for job_id in job_ids:
+            self.submit(job_id)
+
+    def run_sweeper(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception:
+                log.exception("Could not sweep the job table")
+            finally:
+                DBSession.remove()
+            if self.stopping.wait(self.interval):
+                return
+
+    def start(self, event=None):
+        """
+        Start the sweeper thread once. Subscribed to NewRequest rather
+        than application start, so scripts that bootstrap the
+        application do not pick up jobs.
+        """
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run_sweeper,
+                                           name="hypernucleus-pipeline")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def claim(self, job_id):
+        """
+        Mark a job running and count the attempt, False if another
+        worker has it or it may not run
+        """
+        with transaction.manager:
+            claimed = DBSession.query(GameDepJob).filter(
+                        GameDepJob.id == job_id, self.runnable()).update(
+                        {"status": "running", "updated": datetime.now(),
+                         "attempts": GameDepJob.attempts + 1},
+                        synchronize_session=False)
+            mark_changed(DBSession())
+        return claimed == 1
+
+    def run(self, job_id):
+        env = prepare(registry=self.registry)
+        try:
+            with self.lock:
+                self.queued.discard(job_id)
+            if not self.claim(job_id):
+                return
+            try:
+                with transaction.manager:
+                    self.process(env['request'], self.show(job_id))
+            except Exception as e:
+                log.exception("Job %s failed", job_id)
+                with transaction.manager:
+                    job = self.show(job_id)
+                    job.status = "failed"
+                    job.error = str(e)[:1024]
+        finally:
+            DBSession.remove()
+            env['closer']()
+
+    def owner(self, job):
+        """
+        Get the binary or revision of a job, None if it was deleted
+        """
+        if job.kind == "binary":
+            return DBSession.query(GameDepBinary).filter_by(
+                                                id=job.binary_id).first()
+        return DBSession.query(GameDepRevision).filter_by(
+                                                id=job.revision_id).first()
+
+    def process(self, request, job):
+        """
+        Deduplicate, index and sign the file of a job. The file is read
+        first, then the owner is locked and checked again before any
+        row is written, so an upload replacing the file meanwhile wins.
+        """
+        b = BlobLib(request)
+        members = json.loads(job.members) if job.members else None
+        try:
+            file_obj = DBSession.query(Files).filter_by(id=job.file_id).one()
+            owner = self.owner(job)
+            if not owner or owner.file_id != file_obj.id:
+                raise Superseded
+            try:
+                inspected = b.inspect(file_obj, members)
+            except StoredFileNotFound:
+                # Deleted along with the owner or the file it replaced
+                owner = self.owner(job)
+                if not owner or lock(owner).file_id != file_obj.id:
+                    raise Superseded
+                raise Exception("The uploaded file is missing.")
+            if lock(owner).file_id != file_obj.id:
+                raise Superseded
+        except (NoResultFound, Superseded):
+            # Replaced or deleted since, whoever did that released it
+            job.status = "done"
+            job.error = None
+            return
+        stored = b.process(file_obj, inspected)
+        if stored.id != file_obj.id:
+            owner.file_obj = stored
+            DBSession.flush()
+            b.discard(file_obj)
+            # The feeds list the file's uuid
+            rev = DBSession.query(GameDepRevision).filter_by(
+                                            id=job.revision_id).one()
+            ChangeLib().record("update_binary" if job.kind == "binary"
+                               else "source", rev.page, rev.id,
+                               job.binary_id)
+            catalog_snapshot.invalidate_on_commit()
+        job.status = "done"
+        job.error = None
+
+pipeline = PipelineLib()
@@ -0,0 +1,105 @@
+from pyracms.models import DBSession
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+import transaction
+
+from ..models import Architectures, OperatingSystems
+
+class PlatformCache():
+    """
+    A process wide cache of the operating system and architecture tables.
+    They are seeded by initializedb and hardly ever change, so they are
+    read once and kept as rows detached from any session, by id and by
+    name. A transaction that changes either table through the ORM
+    empties the cache when it commits.
+    Usage examples:
+    from hypernucleusserver.lib.platformlib import platforms
+    platforms.list(OperatingSystems)            # Rows ordered by id
+    platforms.show(Architectures, 3)            # Row 3 in DBSession, or None
+    platforms.show_name(Architectures, "arm")   # Same by name
+    """
+    models = (OperatingSystems, Architectures)
+
+    def __init__(self):
+        self.tables = {}
+
+    def load(self, model):
+        """
+        Get the cached table of model, reading it the first time
+        """
+        table = self.tables.get(model)
+        if table is None:
+            rows = []
+            for row_id, name, display_name in DBSession.query(
+                        model.id, model.name, model.display_name
+                        ).order_by(model.id):
+                row = model(name, display_name)
+                row.id = row_id
+                make_transient_to_detached(row)
+                rows.append(row)
+            table = {"rows": rows,
+                     "ids": dict((x.id, x) for x in rows),
+                     "names": dict((x.name, x) for x in rows)}
+            self.tables[model] = table
+        return table
+
+    def list(self, model): #@ReservedAssignment
+        """
+        Get the detached rows of model ordered by id, read only
+        """
+        return self.load(model)["rows"]
+
+    def show(self, model, row_id):
+        """
+        Get a row by id in DBSession without querying it, None if there
+        is no such row
+        """
+        try:
+            row = self.load(model)["ids"].get(int(row_id))
+        except (TypeError, ValueError):
+            return None
+        if row is not None:
+            return DBSession.merge(row, load=False)
+
+    def show_name(self, model, name):
+        """
+        Get a row by name in DBSession without querying it, None if there
+        is no such row
+        """
+        row = self.load(model)["names"].get(name)
+        if row is not None:
+            return DBSession.merge(row, load=False)
+
+    def invalidate(self):
+        self.tables = {}
+
+    def after_commit(self, status):
+        if status:
+            self.invalidate()
+
+    def invalidate_on_commit(self, *args):
+        """
+        Invalidate once the current transaction commits successfully,
+        also a mapper event listener
+        """
+        txn = transaction.get()
+        for hook, hook_args, kws in txn.getAfterCommitHooks():
+            if hook == self.after_commit:
+                return
+        txn.addAfterCommitHook(self.after_commit)
+
+    def preload(self, event=None):
+        """
+        Read both tables on application start
+        """
+        try:
+            with transaction.manager:
+                for model in self.models:
+                    self.load(model)
+        finally:
+            DBSession.remove()
+
+platforms = PlatformCache()
+for model in PlatformCache.models:
+    for name in ("after_insert", "after_update", "after_delete"):
+        event.listen(model, name, platforms.invalidate_on_commit)
@@ -0,0 +1,84 @@
+import logging
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger(__name__)
+
+class RequestCache():
+    """
+    An identity map of database rows looked up while serving one
+    request, so checking the owner, showing the page and the form
+    callback share one query. Rows stay attached to the request's
+    DBSession. Anything that changes rows must call clear.
+    Usage examples:
+    c = request.gamedep_cache
+    c.get(("page", "game", "Pong"), load)  # load() once, None if missing
+    c.clear()                              # Forget everything
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.rows = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        """
+        Get the cached result of load for key, calling it the first
+        time. Exceptions are not cached.
+        """
+        if not self.enabled:
+            return load()
+        try:
+            result = self.rows[key]
+            self.hits += 1
+            return result
+        except KeyError:
+            self.misses += 1
+        result = self.rows[key] = load()
+        return result
+
+    def clear(self):
+        self.rows.clear()
+
+def request_cache(request):
+    """
+    Request method, see RequestCache
+    """
+    return RequestCache()
+
+class QueryCounter(threading.local):
+    """
+    Counts SQL statements run by the current thread
+    """
+    count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+query_counter = QueryCounter()
+
+def query_count_tween_factory(handler, registry):
+    """
+    Log how many queries each request took and how often the
+    request cache saved one, at debug level
+    """
+    if not log.isEnabledFor(logging.DEBUG):
+        return handler
+    # Only counted when logged, the listener runs for every statement
+    if not event.contains(Engine, "before_cursor_execute", query_counter):
+        event.listen(Engine, "before_cursor_execute", query_counter)
+
+    def query_count_tween(request):
+        start = query_counter.count
+        try:
+            return handler(request)
+        finally:
+            cache = request.__dict__.get("gamedep_cache")
+            log.debug("%s %s: %s queries, %s cache hits",
+                      request.method, request.path_info,
+                      query_counter.count - start,
+                      cache.hits if cache else 0)
+    return query_count_tween
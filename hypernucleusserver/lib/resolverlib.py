@@ -0,0 +1,177 @@
+from pyracms.lib.widgetlib import WidgetLib
+from pyracms.models import DBSession
+
+from .feedlib import platform_matches, PLATFORM_INDEPENDENT
+from .gamedeplib import GameDepLib, GameDepNotFound, GAME
+from ..models import GameDepDependency
+
+class DependencyCycle(Exception):
+    pass
+
+class ResolverLib():
+    """
+    A library to work out everything needed to install a game or
+    dependency on one operating system and architecture.
+    Usage examples:
+    r = ResolverLib(request)
+    r.resolve(GAME, "mygame", "lin", "x86_64")
+    """
+
+    def __init__(self, request):
+        self.uploadurl = WidgetLib().get_upload_url(request)
+        self.downloadurl = request.application_url + "/outputs/download/"
+
+    def latest_published(self, page):
+        """
+        Get the newest published revision of page, or None
+        """
+        return page.revisions.filter_by(published=True).first()
+
+    def pick_binary(self, rev, operatingsystem, architecture):
+        """
+        Get the binary of rev that best fits the platform, exact matches
+        are preferred over platform independent ones.
+        """
+        best = None
+        best_score = -1
+        for binary in rev.binary:
+            binary_os = binary.operatingsystem_obj.name
+            binary_arch = binary.architecture_obj.name
+            if not platform_matches(operatingsystem, architecture,
+                                    binary_os, binary_arch):
+                continue
+            score = ((binary_os != PLATFORM_INDEPENDENT) * 2 +
+                     (binary_arch != PLATFORM_INDEPENDENT))
+            if score > best_score:
+                best, best_score = binary, score
+        return best
+
+    def dependencies(self, page):
+        """
+        Get a (dependency page, pinned revision or None) pair for each
+        dependency of page
+        """
+        return [(x.rev_obj.page, x.rev_obj if x.pinned else None)
+                for x in DBSession.query(GameDepDependency).filter_by(
+                            game_id=page.id).order_by(GameDepDependency.id)]
+
+    def resolve(self, gamedep_type, name, operatingsystem, architecture):
+        """
+        Get the install plan of page name.
+        Returns {"plan": [...], "missing": [...]}, the plan is ordered so
+        every entry comes after its dependencies. Pinned dependencies use
+        their pinned revision, the others their latest published one.
+        missing lists what cannot be installed with a reason:
+        "unpublished" (no published revision), "pin_unpublished" (the
+        pinned revision is not published), "pin_conflict" (pages pin
+        different revisions of it) or "no_binary" (nothing for this
+        platform). Pages only needed by missing ones are left out.
+        Raise GameDepNotFound if the page has no published revision.
+        Raise DependencyCycle if the dependencies loop.
+        """
+        page = GameDepLib(gamedep_type).show(name)[0]
+        rev = self.latest_published(page)
+        if not rev:
+            raise GameDepNotFound("no_published_revision")
+        edges = {}
+        order = []
+        self.collect(page, [], edges, order)
+
+        # Dependents come before their dependencies in reversed order, so
+        # every requirement on a page is known by the time it is reached
+        result = {"plan": [], "missing": []}
+        chosen = {page.id: (rev, False)}
+        required = {}
+        for item in reversed(order):
+            if item.id != page.id:
+                if item.id not in required:
+                    continue
+                choice = self.choose(item, required[item.id], result)
+                if not choice:
+                    continue
+                chosen[item.id] = choice
+            for dep_page, pin in edges[item.id]:
+                required.setdefault(dep_page.id, []).append((pin, item.name))
+        for item in order:
+            if item.id in chosen:
+                item_rev, pinned = chosen[item.id]
+                self.add_entry(item, item_rev, pinned, operatingsystem,
+                               architecture, result)
+        return result
+
+    def collect(self, page, path, edges, order):
+        """
+        Fill edges with the dependencies of page and everything below it,
+        and order with those pages, each after its dependencies
+        """
+        path_ids = [x.id for x in path]
+        if page.id in path_ids:
+            cycle = path[path_ids.index(page.id):] + [page]
+            raise DependencyCycle(" -> ".join(x.name for x in cycle))
+        if page.id in edges:
+            return
+        edges[page.id] = self.dependencies(page)
+        path.append(page)
+        for dep_page, pin in edges[page.id]:
+            self.collect(dep_page, path, edges, order)
+        path.pop()
+        order.append(page)
+
+    def choose(self, page, requirements, result):
+        """
+        Pick the revision of page that satisfies every (pinned revision or
+        None, dependent name) requirement, returns (revision, pinned) or
+        None after adding the reason to result["missing"]
+        """
+        pins = [(pin, name) for pin, name in requirements if pin]
+        if len(set(pin.id for pin, name in pins)) > 1:
+            result["missing"].append({"name": page.name,
+                                      "reason": "pin_conflict",
+                                      "pins": [{"version": str(pin.version),
+                                                "required_by": name}
+                                               for pin, name in pins]})
+            return None
+        if pins:
+            pin = pins[0][0]
+            if not pin.published:
+                result["missing"].append({"name": page.name,
+                                          "reason": "pin_unpublished",
+                                          "version": str(pin.version)})
+                return None
+            return pin, True
+        rev = self.latest_published(page)
+        if not rev:
+            result["missing"].append({"name": page.name,
+                                      "reason": "unpublished"})
+            return None
+        return rev, False
+
+    def add_entry(self, page, rev, pinned, operatingsystem, architecture,
+                  result):
+        """
+        Add the plan entry of one page
+        """
+        entry = {"name": page.name,
+                 "type": {GAME: "game"}.get(page.gamedeptype, "dependency"),
+                 "version": str(rev.version),
+                 "moduletype": rev.moduletype,
+                 "pinned": pinned,
+                 "binary": None}
+        if page.gamedeptype == GAME and rev.file_obj:
+            entry["source"] = (self.uploadurl + rev.file_obj.uuid + "/" +
+                               rev.file_obj.name)
+        binary = self.pick_binary(rev, operatingsystem, architecture)
+        if binary:
+            entry["binary"] = {"binary": "%s%s/%s?binary=%s" % (
+                                         self.downloadurl,
+                                         binary.file_obj.uuid,
+                                         binary.file_obj.name, binary.id),
+                               "operating_system":
+                                         binary.operatingsystem_obj.name,
+                               "architecture": binary.architecture_obj.name,
+                               "uuid": binary.file_obj.uuid,
+                               "name": binary.file_obj.name}
+        elif "source" not in entry:
+            result["missing"].append({"name": page.name,
+                                      "reason": "no_binary"})
+        result["plan"].append(entry)
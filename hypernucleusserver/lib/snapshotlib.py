@@ -0,0 +1,211 @@
+import gzip
+import lzma
+import threading
+from datetime import datetime
+from hashlib import sha1
+
+from pyracms.models import DBSession
+from sqlalchemy import event
+import transaction
+
+# Content-Encodings we can precompress, most preferred first. xz is not
+# a registered content-coding, so it is only sent to clients that ask for
+# it by name. Preset 6 keeps compression to about 100 MiB of memory.
+ENCODINGS = [("gzip", lambda data: gzip.compress(data, 9, mtime=0)),
+             ("xz", lambda data: lzma.compress(data, preset=6))]
+EXPLICIT_ONLY = ("xz",)
+
+def best_encoding(accept_encoding):
+    """
+    Pick the best supported encoding from an Accept-Encoding header,
+    None means send the feed as is.
+    """
+    accepted = {}
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for coding, compress in ENCODINGS:
+        if coding in EXPLICIT_ONLY:
+            quality = accepted.get(coding, 0.0)
+        else:
+            quality = accepted.get(coding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+class Snapshot():
+    """
+    One immutable build of the serialised feeds
+    """
+    def __init__(self, generation, modified, feeds):
+        self.generation = generation
+        self.modified = modified
+        self.feeds = feeds
+        self.etags = dict((name, sha1(body).hexdigest())
+                          for name, body in feeds.items())
+        self.lock = threading.RLock()
+        self.derived = {}
+
+    def derive(self, key, build):
+        """
+        Get a value computed from this snapshot, build() is only called
+        once per snapshot for each key.
+        """
+        value = self.derived.get(key)
+        if value is None:
+            with self.lock:
+                value = self.derived.get(key)
+                if value is None:
+                    value = build()
+                    self.derived[key] = value
+        return value
+
+    def feed(self, name, build=None):
+        """
+        Get the serialised feed called name. Feeds that are not part of
+        the snapshot are made by build() the first time they are asked for.
+        """
+        body = self.feeds.get(name)
+        if body is None:
+            with self.lock:
+                body = self.feeds.get(name)
+                if body is None:
+                    body = build()
+                    self.etags[name] = sha1(body).hexdigest()
+                    self.feeds[name] = body
+        return body
+
+    def encode(self, name, encoding):
+        """
+        Get feed name compressed with encoding, each variant is only
+        compressed once per snapshot.
+        """
+        return self.derive(("encoded", name, encoding),
+                           lambda: dict(ENCODINGS)[encoding](self.feeds[name]))
+
+class CatalogSnapshot():
+    """
+    A process wide cache of the pre-serialised catalog feeds.
+    The generation number is bumped whenever a transaction that changed
+    the catalog commits, the feeds are then rebuilt on the next read.
+    Usage examples:
+    from hypernucleusserver.lib.snapshotlib import catalog_snapshot
+    catalog_snapshot.show("json", build)    # Cached feed, build() if stale
+    catalog_snapshot.invalidate_on_commit() # Mark current transaction
+    catalog_snapshot.generation             # Number of catalog changes
+    catalog_snapshot.cached(key, build)     # build() once per generation
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.generation = 0
+        self.modified = datetime.utcnow().replace(microsecond=0)
+        self.snapshot = None
+        self.values = (0, {})
+
+    def invalidate(self):
+        """
+        Throw away the current feeds
+        """
+        with self.lock:
+            self.generation += 1
+            self.modified = datetime.utcnow().replace(microsecond=0)
+
+    def after_commit(self, status):
+        if status:
+            self.invalidate()
+
+    def invalidate_on_commit(self):
+        """
+        Invalidate once the current transaction commits successfully
+        """
+        txn = transaction.get()
+        for hook, args, kws in txn.getAfterCommitHooks():
+            if hook == self.after_commit:
+                return
+        txn.addAfterCommitHook(self.after_commit)
+
+    def current(self, build):
+        """
+        Get an up to date Snapshot, calling build() to get a dictionary
+        of feed name to bytes if the catalog has changed.
+        """
+        snapshot = self.snapshot
+        if snapshot and snapshot.generation == self.generation:
+            return snapshot
+        with self.build_lock:
+            snapshot = self.snapshot
+            generation, modified = self.generation, self.modified
+            if snapshot and snapshot.generation == generation:
+                return snapshot
+            snapshot = Snapshot(generation, modified, build())
+            # Built from a database snapshot older than generation
+            if self.began(generation) == generation:
+                self.snapshot = snapshot
+            return snapshot
+
+    def cached(self, key, build):
+        """
+        Get a value computed from the catalog without building the feeds,
+        build() is called again once the catalog has changed. Values are
+        shared between threads, so they must not be database rows. A
+        value is only kept if the database transaction it was read in
+        began after the last change, and none committed while building.
+        """
+        generation = self.generation
+        values_generation, values = self.values
+        if values_generation == generation:
+            value = values.get(key)
+            if value is not None:
+                return value
+        value = build()
+        begun = self.began(generation)
+        with self.lock:
+            if begun == generation == self.generation:
+                if self.values[0] != generation:
+                    self.values = (generation, {})
+                self.values[1][key] = value
+        return value
+
+    def began(self, generation):
+        """
+        Get the generation the current database transaction began in,
+        generation if there is none
+        """
+        if not DBSession.registry.has():
+            return generation
+        return DBSession().info.get(self, generation)
+
+    def after_begin(self, session, session_transaction, connection):
+        """
+        Session event listener, remembers the generation a database
+        transaction began in
+        """
+        session.info.setdefault(self, self.generation)
+
+    def after_transaction_end(self, session, session_transaction):
+        """
+        Session event listener
+        """
+        if session_transaction.parent is None:
+            session.info.pop(self, None)
+
+    def show(self, name, build):
+        """
+        Get the serialised feed called name
+        """
+        return self.current(build).feeds[name]
+
+catalog_snapshot = CatalogSnapshot()
+event.listen(DBSession, "after_begin", catalog_snapshot.after_begin)
+event.listen(DBSession, "after_transaction_end",
+             catalog_snapshot.after_transaction_end)
@@ -0,0 +1,187 @@
+from bisect import bisect_right
+from os.path import join, isdir
+from tempfile import gettempdir
+from uuid import uuid4
+import json
+import os
+import re
+import shutil
+import time
+
+BLOCK_SIZE = 64 * 1024
+SESSION_ID = re.compile(r'[0-9a-f]{32}\Z')
+
+class UploadNotFound(Exception):
+    pass
+
+class ChunkTooLarge(Exception):
+    pass
+
+class ChunksMissing(Exception):
+    pass
+
+class ChunkReader():
+    """
+    A read only, seekable file object over numbered chunk files,
+    in order
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.starts = []
+        self.length = 0
+        for path in self.paths:
+            self.starts.append(self.length)
+            self.length += os.path.getsize(path)
+        self.position = 0
+        self.current = None
+        self.current_index = None
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.length
+        self.position = max(offset, 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        output = []
+        while size != 0 and self.position < self.length:
+            index = bisect_right(self.starts, self.position) - 1
+            if index != self.current_index:
+                self.close()
+                self.current = open(self.paths[index], "rb")
+                self.current_index = index
+            self.current.seek(self.position - self.starts[index])
+            chunk = self.current.read(size if size > 0 else -1)
+            if not chunk:
+                break
+            output.append(chunk)
+            self.position += len(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(output)
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+            self.current_index = None
+
+class UploadLib():
+    """
+    A library for resumable uploads, spooled to disk a chunk at a time.
+    Each session is a directory under hypernucleus.upload_spool_path
+    holding meta.json and one file per chunk, so it survives restarts
+    and can be shared by every worker.
+    Usage examples:
+    u = UploadLib(request)
+    session = u.create({"kind": "binary", ...})    # Open a session
+    u.write_chunk(session, 0, request.body_file)   # Store chunk 0
+    u.show(session)                                # Chunks received
+    u.reader(session)                              # Read them back in order
+    u.delete(session)                              # Done or aborted
+    """
+
+    def __init__(self, request):
+        settings = request.registry.settings
+        self.spool_path = settings.get("hypernucleus.upload_spool_path",
+                                       join(gettempdir(),
+                                            "hypernucleus-uploads"))
+        self.chunk_size = int(settings.get("hypernucleus.upload_chunk_size",
+                                           8 * 1024 * 1024))
+        self.expire = int(settings.get("hypernucleus.upload_expire",
+                                       24 * 60 * 60))
+
+    def path(self, session_id, *parts):
+        if not SESSION_ID.match(session_id or ""):
+            raise UploadNotFound
+        return join(self.spool_path, session_id, *parts)
+
+    def create(self, meta):
+        """
+        Open a session for an upload described by meta,
+        returns the session id
+        """
+        self.expire_sessions()
+        session_id = uuid4().hex
+        os.makedirs(self.path(session_id))
+        meta = dict(meta, created=time.time())
+        with open(self.path(session_id, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        return session_id
+
+    def show(self, session_id):
+        """
+        Get the meta data of a session and the chunk numbers received
+        """
+        try:
+            with open(self.path(session_id, "meta.json")) as f:
+                meta = json.load(f)
+            names = os.listdir(self.path(session_id))
+        except (IOError, OSError, ValueError):
+            raise UploadNotFound
+        meta["chunks"] = sorted(int(x) for x in names if x.isdigit())
+        return meta
+
+    def write_chunk(self, session_id, number, data):
+        """
+        Store chunk number from a file object, replacing any earlier
+        copy. Written to a temporary name first, so a broken upload
+        never leaves a partial chunk behind.
+        """
+        if not isdir(self.path(session_id)):
+            raise UploadNotFound
+        number = int(number)
+        if number < 0:
+            raise UploadNotFound
+        tmp = self.path(session_id, "%08d.part" % number)
+        size = 0
+        try:
+            with open(tmp, "wb") as f:
+                while True:
+                    block = data.read(BLOCK_SIZE)
+                    if not block:
+                        break
+                    size += len(block)
+                    if size > self.chunk_size:
+                        raise ChunkTooLarge
+                    f.write(block)
+            os.replace(tmp, self.path(session_id, "%08d" % number))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return size
+
+    def reader(self, session_id):
+        """
+        Get a file object reading all chunks in order,
+        raise ChunksMissing if there is a gap
+        """
+        chunks = self.show(session_id)["chunks"]
+        if not chunks or chunks != list(range(len(chunks))):
+            raise ChunksMissing
+        return ChunkReader(self.path(session_id, "%08d" % x)
+                           for x in chunks)
+
+    def delete(self, session_id):
+        shutil.rmtree(self.path(session_id), ignore_errors=True)
+
+    def expire_sessions(self):
+        """
+        Remove sessions untouched for longer than the expiry time
+        """
+        if not isdir(self.spool_path):
+            return
+        cutoff = time.time() - self.expire
+        for name in os.listdir(self.spool_path):
+            path = join(self.spool_path, name)
+            if SESSION_ID.match(name) and os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
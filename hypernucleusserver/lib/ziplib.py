@@ -0,0 +1,98 @@
+import struct
+import zipfile
+
+END_RECORD = b"PK\x05\x06"
+END_RECORD_SIZE = 22
+ZIP64_LOCATOR = b"PK\x06\x07"
+ZIP64_LOCATOR_SIZE = 20
+ZIP64_END_RECORD = b"PK\x06\x06"
+MAX_COMMENT = 0xFFFF
+
+DEFAULT_LIMITS = {"max_members": 10000,
+                  "max_size": 4 * 1024 * 1024 * 1024,
+                  "max_ratio": 100}
+
+class ZipInvalid(Exception):
+    pass
+
+def zip_limits(settings):
+    """
+    Get the archive limits from the hypernucleus.zip_* settings
+    """
+    return dict((key, int(settings.get("hypernucleus.zip_" + key, value)))
+                for key, value in DEFAULT_LIMITS.items())
+
+def central_directory(fp):
+    """
+    Get the member count and central directory size from the end of
+    central directory record, reading at most the last 64KB of fp
+    """
+    fp.seek(0, 2)
+    length = fp.tell()
+    tail_size = min(length, END_RECORD_SIZE + MAX_COMMENT +
+                            ZIP64_LOCATOR_SIZE)
+    fp.seek(length - tail_size)
+    tail = fp.read(tail_size)
+    start = tail.rfind(END_RECORD)
+    if start == -1 or len(tail) - start < END_RECORD_SIZE:
+        raise ZipInvalid("The uploaded file is not a zip.")
+    count, size = struct.unpack("<xxxxxxxxxxHI",
+                                tail[start:start + END_RECORD_SIZE - 6])
+    locator = start - ZIP64_LOCATOR_SIZE
+    if (count == 0xFFFF or size == 0xFFFFFFFF) and locator >= 0 and \
+       tail[locator:locator + 4] == ZIP64_LOCATOR:
+        offset = struct.unpack("<Q", tail[locator + 8:locator + 16])[0]
+        fp.seek(offset)
+        record = fp.read(56)
+        if record[:4] != ZIP64_END_RECORD or len(record) < 56:
+            raise ZipInvalid("The uploaded file is not a zip.")
+        count, size = struct.unpack("<QQ", record[32:48])
+    return count, size
+
+def read_index(fp, max_members=DEFAULT_LIMITS["max_members"],
+               max_size=DEFAULT_LIMITS["max_size"],
+               max_ratio=DEFAULT_LIMITS["max_ratio"]):
+    """
+    Get the member index of a zip from its central directory only,
+    nothing is decompressed. The member count is checked before the
+    directory is parsed, so time spent is bounded by max_members.
+    Raises ZipInvalid when a limit is broken.
+    """
+    count, size = central_directory(fp)
+    if count > max_members:
+        raise ZipInvalid("The zip has more than %s files." % max_members)
+    fp.seek(0)
+    try:
+        infolist = zipfile.ZipFile(fp).infolist()
+    except (zipfile.BadZipfile, zipfile.LargeZipFile, struct.error):
+        raise ZipInvalid("The uploaded file is not a zip.")
+    total = 0
+    compressed = 0
+    index = []
+    for info in infolist:
+        total += info.file_size
+        compressed += info.compress_size
+        if total > max_size:
+            raise ZipInvalid("The zip unpacks to more than %s bytes."
+                             % max_size)
+        index.append({"name": info.filename, "size": info.file_size,
+                      "crc": info.CRC})
+    if total > max_ratio * max(compressed, 1):
+        raise ZipInvalid("The zip is compressed more than %s times."
+                         % max_ratio)
+    return index
+
+def missing_members(index, required):
+    """
+    Get the required names not in the index, folders ending with /
+    count as present when any member is inside them
+    """
+    names = set()
+    for member in index:
+        name = member["name"]
+        names.add(name)
+        slash = name.rfind("/", 0, len(name) - 1)
+        while slash != -1:
+            names.add(name[:slash + 1])
+            slash = name.rfind("/", 0, slash)
+    return [item for item in required if item not in names]
@@ -1,9 +1,10 @@
 from datetime import datetime
 from pyracms.models import Files, User, Base, JsonBase
 from sqlalchemy import (Column, Integer, Unicode, DateTime, Boolean, Float, desc, 
-    Enum)
+    Enum, BigInteger, UnicodeText, LargeBinary)
 from sqlalchemy.orm import relationship
 from sqlalchemy.schema import ForeignKey, UniqueConstraint
+from sqlalchemy.sql.expression import true
 
 class GameDepVotes(Base):
     __tablename__ = 'gamedepvotes'
@@ -27,7 +28,7 @@ class GameDepTags(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(Unicode(128), index=True, nullable=False)
-    game_id = Column(Integer, ForeignKey('gamedeppage.id'))
+    game_id = Column(Integer, ForeignKey('gamedeppage.id'), index=True)
     game = relationship("GameDepPage")
 
     def __init__(self, name):
@@ -63,16 +64,19 @@ class GameDepBinary(Base):
     
     id = Column(Integer, primary_key=True)
     revision_id = Column(Integer, ForeignKey('gamedeprevision.id'),
-                         nullable=False)
+                         nullable=False, index=True)
     operatingsystem_id = Column(Integer, ForeignKey('operatingsystems.id'),
-                                nullable=False)
+                                nullable=False, index=True)
     architecture_id = Column(Integer, ForeignKey('architectures.id'),
-                             nullable=False)
-    file_id = Column(Integer, ForeignKey('files.id'), nullable=True)
-    file_obj = relationship(Files, uselist=False, single_parent=True,
-                            cascade="all, delete, delete-orphan")
+                             nullable=False, index=True)
+    file_id = Column(Integer, ForeignKey('files.id'), nullable=True,
+                     index=True)
+    # Shared with other binaries uploading the same bytes, see BlobLib
+    file_obj = relationship(Files, uselist=False)
     operatingsystem_obj = relationship(OperatingSystems, uselist=False)
     architecture_obj = relationship(Architectures, uselist=False)
+    download_count = Column(Integer, default=0, nullable=False,
+                            server_default="0")
                             
     def __init__(self, file_obj, operatingsystem_obj, architecture_obj):
         self.file_obj = file_obj
@@ -85,8 +89,10 @@ class GameDepRevision(Base, JsonBase):
     __json__ = ["moduletype", "version", "published"]
 
     id = Column(Integer, primary_key=True)
-    page_id = Column(Integer, ForeignKey('gamedeppage.id'), nullable=False)
-    file_id = Column(Integer, ForeignKey('files.id'), nullable=True)
+    page_id = Column(Integer, ForeignKey('gamedeppage.id'), nullable=False,
+                     index=True)
+    file_id = Column(Integer, ForeignKey('files.id'), nullable=True,
+                     index=True)
     moduletype = Column(Enum("file", "folder"), nullable=False)
     page = relationship("GameDepPage")
     version = Column(Float(), default=0.1, index=True, nullable=False)
@@ -109,6 +115,10 @@ class GameDepDependency(Base):
                      nullable=False)
     rev_id = Column(Integer, ForeignKey('gamedeprevision.id'), 
                     nullable=False)
+    # False for "Use Latest Version", rev_id is then only the revision
+    # that was latest when the dependency was added
+    pinned = Column(Boolean, nullable=False, default=True,
+                    server_default=true())
     page_obj = relationship("GameDepPage", uselist=False)
     rev_obj = relationship(GameDepRevision, uselist=False)
     
@@ -123,13 +133,15 @@ class GameDepPage(Base, JsonBase):
                 "view_count"]
 
     id = Column(Integer, primary_key=True)
-    gamedeptype = Column(Enum("game", "dep"), nullable=False)
-    owner_id = Column(Integer, ForeignKey('user.id'), nullable=False)
+    gamedeptype = Column(Enum("game", "dep"), nullable=False, index=True)
+    owner_id = Column(Integer, ForeignKey('user.id'), nullable=False,
+                      index=True)
     owner = relationship(User)
     name = Column(Unicode(128), index=True, unique=True, nullable=False)
     display_name = Column(Unicode(128), index=True, nullable=False)
     description = Column(Unicode(16384), default="")
     created = Column(DateTime, default=datetime.now)
+    updated = Column(DateTime, default=datetime.now, index=True)
     thread_id = Column(Integer, nullable=False, default=-1)
     album_id = Column(Integer, nullable=False, default=-1)
     view_count = Column(Integer, default=0, index=True)
@@ -153,3 +165,105 @@ class GameDepPage(Base, JsonBase):
         self.display_name = display_name
         self.gamedeptype = gamedeptype
         self.owner = owner
+
+class GameDepChange(Base):
+    __tablename__ = 'gamedepchange'
+    __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
+
+    # id doubles as the change feed sequence number, rows are only
+    # inserted while holding GameDepChangeLock so ids commit in order
+    id = Column(Integer, primary_key=True)
+    created = Column(DateTime, default=datetime.now)
+    action = Column(Unicode(32), nullable=False)
+    gamedeptype = Column(Enum("game", "dep"), nullable=False)
+    # Not foreign keys, the rows they point at may have been deleted
+    page_id = Column(Integer, nullable=False, index=True)
+    name = Column(Unicode(128), nullable=False)
+    revision_id = Column(Integer)
+    binary_id = Column(Integer)
+
+    def __init__(self, action, page, revision_id=None, binary_id=None):
+        self.action = action
+        self.gamedeptype = page.gamedeptype
+        self.page_id = page.id
+        self.name = page.name
+        self.revision_id = revision_id
+        self.binary_id = binary_id
+
+class GameDepChangeLock(Base):
+    __tablename__ = 'gamedepchangelock'
+    __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
+
+    # A single row, locked by transactions adding changes, see ChangeLib
+    id = Column(Integer, primary_key=True)
+
+    def __init__(self, id):
+        self.id = id
+
+class GameDepBlob(Base):
+    __tablename__ = 'gamedepblob'
+    __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
+
+    id = Column(Integer, primary_key=True)
+    sha256 = Column(Unicode(64), nullable=False, unique=True)
+    file_id = Column(Integer, ForeignKey('files.id'), nullable=False,
+                     unique=True)
+    file_obj = relationship(Files, uselist=False)
+    size = Column(BigInteger, nullable=False)
+    # Binaries and revisions using file_obj
+    refcount = Column(Integer, nullable=False, default=1)
+    # JSON list of the zip's names, sizes and CRCs, null if not a zip
+    members = Column(UnicodeText)
+
+    def __init__(self, sha256, file_obj, size, members=None):
+        self.sha256 = sha256
+        self.file_obj = file_obj
+        self.size = size
+        self.refcount = 1
+        self.members = members
+
+class GameDepSignature(Base):
+    __tablename__ = 'gamedepsignature'
+    __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
+
+    id = Column(Integer, primary_key=True)
+    file_id = Column(Integer, ForeignKey('files.id'), nullable=False,
+                     unique=True)
+    block_size = Column(Integer, nullable=False)
+    # Packed block hashes, see lib/deltalib.py
+    signature = Column(LargeBinary(2 ** 31 - 1), nullable=False)
+
+    def __init__(self, file_id, block_size, signature):
+        self.file_id = file_id
+        self.block_size = block_size
+        self.signature = signature
+
+class GameDepJob(Base):
+    __tablename__ = 'gamedepjob'
+    __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8'}
+
+    id = Column(Integer, primary_key=True)
+    created = Column(DateTime, default=datetime.now)
+    updated = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+    kind = Column(Enum("binary", "source"), nullable=False)
+    status = Column(Enum("pending", "running", "done", "failed"),
+                    nullable=False, default="pending", index=True)
+    # Not foreign keys, the rows they point at may be deleted first
+    revision_id = Column(Integer, nullable=False, index=True)
+    binary_id = Column(Integer)
+    file_id = Column(Integer, nullable=False)
+    # JSON zip index if the upload was already checked
+    members = Column(UnicodeText)
+    error = Column(Unicode(1024))
+    # Times a worker claimed it, failed jobs are retried up to a limit
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+
+    def __init__(self, kind, revision_id, file_id, binary_id=None,
+                 members=None):
+        self.kind = kind
+        self.status = "pending"
+        self.revision_id = revision_id
+        self.file_id = file_id
+        self.binary_id = binary_id
+        self.members = members
+        self.attempts = 0
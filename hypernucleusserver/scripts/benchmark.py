@@ -0,0 +1,156 @@
+from ..lib import dicttoxml as dicttoxml_module
+from ..lib.dicttoxml import dicttoxml, key_is_valid_xml, parse_key
+from ..lib.feedlib import iter_xml
+import json
+import os
+import sys
+import time
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print(('usage: %s [item_count | config_uri]\n'
+          '(example: "%s 10000" or "%s production.ini")' % (cmd, cmd, cmd)))
+    sys.exit(1)
+
+def synthetic_catalog(count):
+    """
+    Make a catalog dictionary shaped like OutputLib.show_dict
+    """
+    uploadurl = "http://localhost/uploads/"
+    root = {"operatingsystems": [{"name": "pi",
+                                  "display_name": "Platform Independent"},
+                                 {"name": "lin", "display_name": "Linux"}],
+            "architectures": [{"name": "pi",
+                               "display_name": "Platform Independent"},
+                              {"name": "x86_64", "display_name": "64bit X86"}],
+            "gamedep": []}
+    for i in range(count):
+        key = "game" if i % 2 else "dependency"
+        revisions = []
+        for version in ("0.2", "0.1"):
+            uuid = "%08d-%s" % (i, version)
+            binaries = [{"binary": uploadurl + uuid + "/bin.zip",
+                         "operating_system": "pi", "architecture": "pi",
+                         "uuid": uuid, "name": "bin.zip"}]
+            revdict = {"version": version, "created": "2012-01-01 00:00:00",
+                       "moduletype": "file", "binaries": binaries}
+            if key == "game":
+                revdict["source"] = uploadurl + uuid + "/src.zip"
+                revdict["source_uuid"] = uuid
+                revdict["source_name"] = "src.zip"
+            revisions.append(revdict)
+        root["gamedep"].append({key: {
+            "name": "item%s" % i, "display_name": "Item <%s> & co" % i,
+            "description": "A \"description\" of item %s" % i,
+            "created": "2012-01-01 00:00:00",
+            "dependencies": [{"dependency": "item%s" % (i - 1),
+                              "version": "0.2"}] if i else [],
+            "tags": ["tag%s" % (i % 10)], "pictures": [],
+            "revisions": revisions}})
+    return root
+
+def timed(func, repeat=3):
+    """
+    Return the result of func and the best time in seconds
+    """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+def real_catalog(config_uri):
+    """
+    Build the catalog dictionary from the database in config_uri
+    """
+    from pyramid.paster import bootstrap
+    from ..lib.outputlib import OutputLib
+    env = bootstrap(config_uri)
+    try:
+        return OutputLib(env['request']).show_dict()
+    finally:
+        env['closer']()
+
+def catalog_keys(value, keys):
+    """
+    Collect every dictionary key in a catalog
+    """
+    if isinstance(value, dict):
+        for key, child in value.items():
+            keys.append(key)
+            catalog_keys(child, keys)
+    elif isinstance(value, list):
+        for child in value:
+            catalog_keys(child, keys)
+    return keys
+
+def bench_feeds(root):
+    """
+    The old JSON round trip through dicttoxml against feedlib.iter_xml
+    """
+    def json_round_trip():
+        return dicttoxml(json.loads(json.dumps(root, sort_keys=True,
+                                               indent=4)),
+                         custom_root="hypernucleus", attr_type=False)
+    def direct():
+        return "".join(iter_xml(root)).encode()
+
+    old, old_time = timed(json_round_trip)
+    new, new_time = timed(direct)
+    print("%s bytes of xml" % len(new))
+    print("json + dicttoxml: %.3fs" % old_time)
+    print("feedlib.iter_xml: %.3fs (%.1fx)" % (new_time, old_time / new_time))
+    return old == new
+
+def bench_dicttoxml(root):
+    """
+    dicttoxml's XML name checks and logging, uncached against cached
+    """
+    keys = catalog_keys(root, [])
+    uncached = getattr(parse_key, '__wrapped__', parse_key)
+    def minidom_names():
+        for key in keys:
+            uncached(key)
+    def cached_names():
+        for key in keys:
+            key_is_valid_xml(key)
+    minidom_time = timed(minidom_names)[1]
+    cached_time = timed(cached_names)[1]
+    print("%s key checks with minidom: %.3fs" % (len(keys), minidom_time))
+    print("%s key checks cached: %.3fs (%.1fx)" % (len(keys), cached_time,
+                                                  minidom_time / cached_time))
+
+    def convert():
+        return dicttoxml(root, custom_root="hypernucleus", attr_type=False)
+    # Force log messages to be built but throw them away, like the
+    # original module did on every call.
+    logger = dicttoxml_module.LOG
+    level, propagate = logger.level, logger.propagate
+    logger.setLevel(dicttoxml_module.logging.INFO)
+    logger.propagate = False
+    try:
+        logging_time = timed(convert, 1)[1]
+    finally:
+        logger.setLevel(level)
+        logger.propagate = propagate
+    quiet_time = timed(convert)[1]
+    print("dicttoxml formatting log messages: %.3fs" % logging_time)
+    print("dicttoxml with logging off: %.3fs (%.1fx)" % (
+                                    quiet_time, logging_time / quiet_time))
+
+def main(argv=sys.argv):
+    if len(argv) > 2:
+        usage(argv)
+    if len(argv) == 2 and not argv[1].isdigit():
+        root = real_catalog(argv[1])
+    else:
+        root = synthetic_catalog(int(argv[1]) if len(argv) == 2 else 10000)
+    print("%s items" % len(root["gamedep"]))
+    same = bench_feeds(root)
+    bench_dicttoxml(root)
+    if not same:
+        print("OUTPUT DIFFERS")
+        sys.exit(1)
@@ -0,0 +1,220 @@
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from os.path import basename, dirname, exists, isfile, join
+from urllib.parse import urlparse
+import argparse
+import json
+import os
+import shutil
+import sys
+
+from pyracms.models import DBSession
+from pyramid.paster import bootstrap
+from pyramid.request import Request
+import transaction
+
+from ..lib.changelib import ChangeLib
+from ..lib.downloadlib import upload_path
+from ..lib.feedlib import platform_catalog
+from .importcatalog import MANIFEST_NAME, chunks
+from ..lib.outputlib import OutputLib
+from ..models import GameDepPage
+from ..web_service_views import gamedep_document
+
+STATE_NAME = ".mirror-state.json"
+CHANGE_BATCH = 500
+# Catalog keys holding urls of uploaded files
+FILE_URL_KEYS = ("binary", "source", "url", "thumb_url")
+# Page fields that change without a change feed entry
+VOLATILE_KEYS = ("view_count",)
+# /outputs/json has /outputs/json/{os}/{arch} under it, so a static
+# server has to serve it as the index of that directory
+JSON_FEED = "outputs/json/index.json"
+
+def parse_args(argv):
+    cmd = basename(argv[0])
+    parser = argparse.ArgumentParser(prog=cmd, description=
+        "Write a static mirror of the catalog feeds, the per item api "
+        "documents and every uploaded file, laid out by their urls. The "
+        "/outputs/json feed is written as %s. Run it again to only write "
+        "what changed since the last export." % JSON_FEED,
+        epilog='example: "%s production.ini /srv/mirror --base-url '
+               'https://cdn.example.com"' % cmd)
+    parser.add_argument("config_uri")
+    parser.add_argument("target")
+    parser.add_argument("--base-url", default="http://localhost/",
+                        help="site url the file urls in the feeds start "
+                             "with")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="parallel file copies (default 8)")
+    return parser.parse_args(argv[1:])
+
+def write_atomic(path, data):
+    """
+    Replace a file without readers ever seeing half of it
+    """
+    os.makedirs(dirname(path), exist_ok=True)
+    with open(path + ".part", "wb") as f:
+        f.write(data)
+    os.replace(path + ".part", path)
+
+def file_urls(value):
+    """
+    Yield the url of every uploaded file in a catalog
+    """
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in FILE_URL_KEYS and isinstance(item, str):
+                yield item
+            else:
+                for url in file_urls(item):
+                    yield url
+    elif isinstance(value, list):
+        for item in value:
+            for url in file_urls(item):
+                yield url
+
+class MirrorExporter():
+    """
+    Write the mirror, remembering in .mirror-state.json the change feed
+    cursor it is up to date with, the hashes of the feeds and the files
+    it holds. Files never change under their uuid, so only new ones are
+    copied, and only items with changes since the cursor are rewritten.
+    """
+
+    def __init__(self, request, target, workers=8, log=print):
+        self.request = request
+        self.target = target
+        self.workers = workers
+        self.log = log
+        self.upload_path = upload_path(request.registry.settings)
+        try:
+            with open(join(target, STATE_NAME)) as f:
+                self.state = json.load(f)
+        except (IOError, ValueError):
+            self.state = {"cursor": None, "feeds": {}, "files": []}
+
+    def copy_file(self, path):
+        """
+        Copy an upload to its url path, the last two parts being the
+        uuid and name it is stored under
+        """
+        target = join(self.target, path)
+        if exists(target):
+            return
+        source = join(self.upload_path, *path.split("/")[-2:])
+        if not exists(source):
+            self.log("Missing upload %s" % source)
+            return
+        os.makedirs(dirname(target), exist_ok=True)
+        shutil.copyfile(source, target + ".part")
+        os.replace(target + ".part", target)
+
+    def changed_pages(self, cursor):
+        """
+        Get the (type, name) of every page changed after cursor, None
+        meaning all of them
+        """
+        if cursor is None:
+            return None
+        changed = set()
+        c = ChangeLib()
+        while True:
+            changes = c.since(cursor, CHANGE_BATCH)
+            for change in changes:
+                changed.add((change.gamedeptype, change.name))
+                cursor = change.id
+            if len(changes) < CHANGE_BATCH:
+                return changed
+
+    def write_documents(self, changed):
+        """
+        Write the api_gamedep document of changed pages, removing those
+        of pages that are gone
+        """
+        query = DBSession.query(GameDepPage)
+        if changed is None:
+            pages = query.all()
+            names = set()
+        else:
+            names = set(name for gamedeptype, name in changed)
+            pages = []
+            for batch in chunks(sorted(names), 1000):
+                pages.extend(query.filter(GameDepPage.name.in_(batch)))
+        written = 0
+        for page in pages:
+            names.discard(page.name)
+            path = join(self.target, "api", "gamedep", page.gamedeptype,
+                        "item", page.name)
+            document = gamedep_document(page)
+            for key in VOLATILE_KEYS:
+                document.pop(key, None)
+            write_atomic(path, json.dumps(document, sort_keys=True).encode())
+            written += 1
+        for gamedeptype, name in changed or ():
+            if name in names:
+                path = join(self.target, "api", "gamedep", gamedeptype,
+                            "item", name)
+                if exists(path):
+                    os.remove(path)
+        self.log("Wrote %s item documents" % written)
+
+    def export(self):
+        with transaction.manager:
+            feeds = OutputLib(self.request).show_feeds()
+            cursor = int(feeds["cursor"])
+            root = json.loads(feeds["json"].decode())
+            self.write_documents(self.changed_pages(self.state["cursor"]))
+
+        paths = sorted(set(urlparse(url).path.lstrip("/")
+                           for url in file_urls(root)))
+        with ThreadPoolExecutor(self.workers) as pool:
+            list(pool.map(self.copy_file, paths))
+
+        # Feeds last, so they never list a file that is not there yet
+        outputs = [(MANIFEST_NAME, feeds["json"]),
+                   (JSON_FEED, feeds["json"]),
+                   ("outputs/xml", feeds["xml"])]
+        for osdict in root["operatingsystems"]:
+            for archdict in root["architectures"]:
+                outputs.append((
+                    "outputs/json/%s/%s" % (osdict["name"], archdict["name"]),
+                    json.dumps(platform_catalog(root, osdict["name"],
+                                                archdict["name"]),
+                               sort_keys=True, indent=4).encode()))
+        # Platforms that are gone, and the json feed of older exports,
+        # which was a file where the outputs/json directory goes
+        for name in set(self.state["feeds"]) - set(x[0] for x in outputs):
+            if isfile(join(self.target, name)):
+                os.remove(join(self.target, name))
+            del self.state["feeds"][name]
+        for name, data in outputs:
+            digest = sha1(data).hexdigest()
+            if self.state["feeds"].get(name) != digest:
+                write_atomic(join(self.target, name), data)
+                self.state["feeds"][name] = digest
+                self.log("Wrote %s" % name)
+
+        for path in set(self.state["files"]) - set(paths):
+            if exists(join(self.target, path)):
+                os.remove(join(self.target, path))
+                try:
+                    # The uuid directory the file was alone in
+                    os.rmdir(dirname(join(self.target, path)))
+                except OSError:
+                    pass
+        self.log("%s files, %s removed" % (
+                    len(paths), len(set(self.state["files"]) - set(paths))))
+        self.state["files"] = paths
+        self.state["cursor"] = cursor
+        write_atomic(join(self.target, STATE_NAME),
+                     json.dumps(self.state).encode())
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    request = Request.blank("/", base_url=args.base_url)
+    env = bootstrap(args.config_uri, request=request)
+    try:
+        MirrorExporter(env['request'], args.target, args.workers).export()
+    finally:
+        env['closer']()
@@ -0,0 +1,418 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from os.path import basename, dirname, exists, getsize, isdir, join
+from urllib.parse import urlparse
+from urllib.request import urlretrieve
+import argparse
+import json
+import mimetypes
+import os
+import shutil
+import sys
+
+from pyracms.lib.settingslib import SettingsLib
+from pyracms.lib.userlib import UserLib
+from pyracms.models import DBSession, Files
+from pyramid.paster import bootstrap
+from sqlalchemy import func
+from zope.sqlalchemy import mark_changed
+import transaction
+
+from ..lib.bloblib import hash_stream
+from ..lib.changelib import ChangeLib
+from ..lib.downloadlib import upload_path
+from ..lib.gamedeplib import GAME, DEP
+from ..lib.ziplib import ZipInvalid, read_index, zip_limits
+from ..models import (Architectures, GameDepBinary, GameDepBlob,
+                      GameDepChange, GameDepDependency, GameDepPage,
+                      GameDepRevision, GameDepTags, OperatingSystems)
+
+MANIFEST_NAME = "catalog.json"
+
+def parse_args(argv):
+    cmd = basename(argv[0])
+    parser = argparse.ArgumentParser(prog=cmd, description=
+        "Import games and dependencies from a catalog in the /outputs/json "
+        "format. Pass the manifest, or a directory holding %s, files are "
+        "looked for next to it as <uuid>/<name> or under their url path. "
+        "Entries already imported are skipped, so an interrupted import can "
+        "be run again."
+        % MANIFEST_NAME,
+        epilog='example: "%s development.ini mirror/ --owner admin"' % cmd)
+    parser.add_argument("config_uri")
+    parser.add_argument("source")
+    parser.add_argument("--owner", required=True,
+                        help="user name that will own the imported pages")
+    parser.add_argument("--batch", type=int, default=500,
+                        help="pages per transaction (default 500)")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="parallel file copies (default 8)")
+    parser.add_argument("--fetch", action="store_true",
+                        help="download files missing from the source "
+                             "directory from their catalog url")
+    return parser.parse_args(argv[1:])
+
+def load_manifest(source):
+    """
+    Get the catalog dictionary and the directory its files are in
+    """
+    if isdir(source):
+        source = join(source, MANIFEST_NAME)
+    with open(source) as f:
+        return json.load(f), dirname(os.path.abspath(source))
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value[:19], "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return datetime.now()
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+class CatalogImporter():
+    """
+    Bulk load catalog entries with one multi-row INSERT per table per
+    batch. Ids are read back by natural key (page name, file uuid,
+    revision version) rather than row by row. Files are hashed and
+    indexed as they are copied and stored once per content hash, the
+    way the upload pipeline would, so nothing is left for it to do.
+    """
+
+    def __init__(self, settings, base, owner, batch_size=500, workers=8,
+                 fetch=False):
+        self.base = base
+        self.upload_path = upload_path(settings)
+        self.limits = zip_limits(settings)
+        self.owner = owner
+        self.owner_id = UserLib().show(owner).id
+        self.batch_size = batch_size
+        self.workers = workers
+        self.fetch = fetch
+        self.os_ids = dict(DBSession.query(OperatingSystems.name,
+                                           OperatingSystems.id))
+        self.arch_ids = dict(DBSession.query(Architectures.name,
+                                             Architectures.id))
+
+    def entries(self, root):
+        """
+        Get (gamedeptype, entry) pairs, dependencies first
+        """
+        found = {GAME: [], DEP: []}
+        for item in root.get("gamedep", []):
+            for key, entry in item.items():
+                found[GAME if key == "game" else DEP].append(entry)
+        return ([(DEP, x) for x in found[DEP]] +
+                [(GAME, x) for x in found[GAME]])
+
+    def copy_file(self, item):
+        """
+        Copy one file into the upload directory, skipping it if an
+        earlier run already did
+        """
+        uuid, name, url = item
+        target = join(self.upload_path, uuid, name)
+        source = join(self.base, uuid, name)
+        if not exists(source) and url:
+            # Laid out by url, as export_hypernucleus-server_mirror does
+            mirrored = join(self.base, urlparse(url).path.lstrip("/"))
+            if exists(mirrored):
+                source = mirrored
+        if exists(target) and (not exists(source) or
+                               getsize(target) == getsize(source)):
+            return
+        os.makedirs(dirname(target), exist_ok=True)
+        if exists(source):
+            shutil.copyfile(source, target + ".part")
+        elif self.fetch and url:
+            urlretrieve(url, target + ".part")
+        else:
+            raise IOError("Missing file %s" % source)
+        os.replace(target + ".part", target)
+
+    def inspect_file(self, item):
+        """
+        Copy one file and read its sha256, size and zip index
+        """
+        uuid, name, url = item
+        self.copy_file(item)
+        with open(join(self.upload_path, uuid, name), "rb") as fp:
+            sha, size = hash_stream(fp)
+            try:
+                members = json.dumps(read_index(fp, **self.limits))
+            except ZipInvalid:
+                members = None
+        return uuid, (sha, size, members)
+
+    def import_pages(self, entries, log=print):
+        """
+        Import pages, revisions, binaries, sources and tags a batch at a
+        time, each batch in its own transaction
+        """
+        names = [x["name"] for gamedeptype, x in entries]
+        done = set()
+        with transaction.manager:
+            for batch in chunks(names, 1000):
+                done.update(x for x, in DBSession.query(
+                                GameDepPage.name).filter(
+                                GameDepPage.name.in_(batch)))
+        todo = [x for x in entries if x[1]["name"] not in done]
+        log("%s pages to import, %s already there" % (len(todo), len(done)))
+        with ThreadPoolExecutor(self.workers) as pool:
+            for number, batch in enumerate(chunks(todo, self.batch_size)):
+                with transaction.manager:
+                    duplicates = self.import_batch(batch, pool)
+                    mark_changed(DBSession())
+                # Copies of bytes stored under another uuid
+                for uuid, name in duplicates:
+                    shutil.rmtree(join(self.upload_path, uuid),
+                                  ignore_errors=True)
+                log("Imported %s of %s" % (min((number + 1) *
+                                               self.batch_size,
+                                               len(todo)), len(todo)))
+
+    def import_batch(self, batch, pool):
+        """
+        Import one batch, returns the (uuid, name) of files that turned
+        out to be copies of stored bytes
+        """
+        files = {}
+        for gamedeptype, entry in batch:
+            for rev in entry.get("revisions", []):
+                if rev.get("source_uuid"):
+                    files[rev["source_uuid"]] = (rev["source_uuid"],
+                                                 rev["source_name"],
+                                                 rev.get("source"))
+                for binary in rev.get("binaries", []):
+                    files[binary["uuid"]] = (binary["uuid"], binary["name"],
+                                             binary.get("binary"))
+        # Files go first, so a failed copy leaves no rows behind
+        inspected = dict(pool.map(self.inspect_file, files.values()))
+
+        now = datetime.now()
+        DBSession.bulk_insert_mappings(GameDepPage, [
+            {"gamedeptype": gamedeptype, "owner_id": self.owner_id,
+             "name": entry["name"],
+             "display_name": entry.get("display_name", entry["name"]),
+             "description": entry.get("description", ""),
+             "created": parse_date(entry.get("created")), "updated": now}
+            for gamedeptype, entry in batch])
+        page_ids = dict(DBSession.query(GameDepPage.name, GameDepPage.id
+                            ).filter(GameDepPage.name.in_(
+                                [x["name"] for gamedeptype, x in batch])))
+        self.add_threads_and_albums(batch, page_ids)
+
+        file_ids, duplicates = self.store_files(files, inspected)
+
+        revisions = []
+        for gamedeptype, entry in batch:
+            for rev in entry.get("revisions", []):
+                # Only published revisions are in the feeds, and their
+                # files are fully processed here
+                revisions.append({
+                    "page_id": page_ids[entry["name"]],
+                    "version": float(rev["version"]),
+                    "moduletype": rev.get("moduletype", "file"),
+                    "created": parse_date(rev.get("created")),
+                    "published": True,
+                    "file_id": file_ids.get(rev.get("source_uuid"))})
+        DBSession.bulk_insert_mappings(GameDepRevision, revisions)
+        revision_ids = {}
+        for rev_id, page_id, version in DBSession.query(
+                    GameDepRevision.id, GameDepRevision.page_id,
+                    GameDepRevision.version).filter(
+                    GameDepRevision.page_id.in_(list(page_ids.values()))):
+            revision_ids[(page_id, version)] = rev_id
+
+        binaries = []
+        tags = []
+        for gamedeptype, entry in batch:
+            page_id = page_ids[entry["name"]]
+            tags.extend({"game_id": page_id, "name": x}
+                        for x in entry.get("tags", []))
+            for rev in entry.get("revisions", []):
+                rev_id = revision_ids[(page_id, float(rev["version"]))]
+                for binary in rev.get("binaries", []):
+                    if (binary["operating_system"] not in self.os_ids or
+                        binary["architecture"] not in self.arch_ids):
+                        raise ValueError("Unknown platform %s/%s in %s" % (
+                                binary["operating_system"],
+                                binary["architecture"], entry["name"]))
+                    binaries.append({
+                        "revision_id": rev_id,
+                        "operatingsystem_id":
+                            self.os_ids[binary["operating_system"]],
+                        "architecture_id":
+                            self.arch_ids[binary["architecture"]],
+                        "file_id": file_ids[binary["uuid"]]})
+        DBSession.bulk_insert_mappings(GameDepBinary, binaries)
+        DBSession.bulk_insert_mappings(GameDepTags, tags)
+        self.count_references(set(file_ids.values()))
+        # Last thing before the commit, so the change ids commit in order
+        ChangeLib().lock()
+        DBSession.bulk_insert_mappings(GameDepChange, [
+            {"action": "create", "gamedeptype": gamedeptype,
+             "page_id": page_ids[entry["name"]], "name": entry["name"]}
+            for gamedeptype, entry in batch])
+        return duplicates
+
+    def add_threads_and_albums(self, batch, page_ids):
+        """
+        Give the new pages a forum thread and a gallery album, as
+        GameDepLib.create does, when those plugins are enabled
+        """
+        s = SettingsLib()
+        forum = s.has_setting("PYRACMS_FORUM")
+        gallery = s.has_setting("PYRACMS_GALLERY")
+        if not forum and not gallery:
+            return
+        owner = UserLib().show(self.owner)
+        updates = []
+        for gamedeptype, entry in batch:
+            name = entry["name"]
+            display_name = entry.get("display_name", name)
+            update = {"id": page_ids[name]}
+            if forum:
+                from pyracms_forum.lib.boardlib import BoardLib
+                update["thread_id"] = BoardLib().add_thread(
+                        name, display_name, "", owner, add_post=False).id
+            if gallery:
+                from pyracms_gallery.lib.gallerylib import GalleryLib
+                update["album_id"] = GalleryLib().create_album(
+                                            name, display_name, owner)
+            updates.append(update)
+        DBSession.bulk_update_mappings(GameDepPage, updates)
+
+    def store_files(self, files, inspected):
+        """
+        Add a Files row and a blob for every distinct content hash not
+        stored yet. Returns the Files id to use for each uuid, and the
+        (uuid, name) of copies of bytes stored under another uuid.
+        """
+        file_ids = dict(DBSession.query(Files.uuid, Files.id).filter(
+                                            Files.uuid.in_(list(files))))
+        shas = set(sha for sha, size, members in inspected.values())
+        stored = dict(DBSession.query(GameDepBlob.sha256,
+                                      GameDepBlob.file_id).filter(
+                                      GameDepBlob.sha256.in_(list(shas))))
+        new_files = {}
+        duplicates = []
+        for uuid, (sha, size, members) in sorted(inspected.items()):
+            if uuid in file_ids:
+                stored.setdefault(sha, file_ids[uuid])
+            elif sha in stored or sha in new_files:
+                duplicates.append(files[uuid][:2])
+            else:
+                new_files[sha] = uuid
+        DBSession.bulk_insert_mappings(Files, [
+            {"uuid": uuid, "name": files[uuid][1],
+             "mimetype": mimetypes.guess_type(files[uuid][1])[0] or
+                         "application/zip"}
+            for uuid in new_files.values()])
+        file_ids.update(DBSession.query(Files.uuid, Files.id).filter(
+                                    Files.uuid.in_(list(new_files.values()))))
+        stored.update((sha, file_ids[uuid])
+                      for sha, uuid in new_files.items())
+        have_blob = set(x for x, in DBSession.query(GameDepBlob.file_id
+                            ).filter(GameDepBlob.file_id.in_(
+                                list(stored.values()))))
+        blobs = []
+        for uuid, (sha, size, members) in inspected.items():
+            file_id = stored[sha]
+            file_ids[uuid] = file_id
+            if file_id not in have_blob:
+                have_blob.add(file_id)
+                blobs.append({"sha256": sha, "file_id": file_id,
+                              "size": size, "members": members,
+                              "refcount": 0})
+        DBSession.bulk_insert_mappings(GameDepBlob, blobs)
+        return file_ids, duplicates
+
+    def count_references(self, file_ids):
+        """
+        Set the refcount of the blobs of file_ids to the binaries and
+        revisions using them
+        """
+        binaries = DBSession.query(func.count(GameDepBinary.id)).filter(
+                    GameDepBinary.file_id == GameDepBlob.file_id
+                    ).correlate(GameDepBlob).as_scalar()
+        revisions = DBSession.query(func.count(GameDepRevision.id)).filter(
+                    GameDepRevision.file_id == GameDepBlob.file_id
+                    ).correlate(GameDepBlob).as_scalar()
+        for batch in chunks(sorted(file_ids), 1000):
+            DBSession.query(GameDepBlob).filter(
+                    GameDepBlob.file_id.in_(batch)).update(
+                    {"refcount": binaries + revisions},
+                    synchronize_session=False)
+
+    def import_dependencies(self, entries, log=print):
+        """
+        Link pages to the dependency revisions they list, once every
+        page exists. Links already there are left alone. Each link is
+        logged to the change feed, as GameDepLib.create_dependency does.
+        """
+        with transaction.manager:
+            page_ids = dict(DBSession.query(GameDepPage.name,
+                                            GameDepPage.id))
+            revision_ids = dict(((page_id, version), rev_id)
+                                for rev_id, page_id, version in
+                                DBSession.query(GameDepRevision.id,
+                                                GameDepRevision.page_id,
+                                                GameDepRevision.version))
+            linked = set(tuple(x) for x in DBSession.query(
+                                            GameDepDependency.game_id,
+                                            GameDepDependency.rev_id))
+        links = []
+        pages = {}
+        for gamedeptype, entry in entries:
+            for dep in entry.get("dependencies", []):
+                key = (page_ids.get(dep["dependency"]),
+                       float(dep["version"]))
+                if key not in revision_ids:
+                    log("Skipping missing dependency %s %s of %s" % (
+                            dep["dependency"], dep["version"],
+                            entry["name"]))
+                    continue
+                link = (page_ids[entry["name"]], revision_ids[key])
+                if link not in linked:
+                    linked.add(link)
+                    links.append({"game_id": link[0], "rev_id": link[1]})
+                    pages[link[0]] = (gamedeptype, entry["name"])
+        for batch in chunks(links, self.batch_size * 10):
+            with transaction.manager:
+                DBSession.bulk_insert_mappings(GameDepDependency, batch)
+                now = datetime.now()
+                for ids in chunks(sorted(set(x["game_id"] for x in batch)),
+                                  1000):
+                    DBSession.query(GameDepPage).filter(
+                            GameDepPage.id.in_(ids)).update(
+                            {"updated": now}, synchronize_session=False)
+                # Last thing before the commit, so the change ids commit
+                # in order
+                ChangeLib().lock()
+                DBSession.bulk_insert_mappings(GameDepChange, [
+                    {"action": "create_dependency",
+                     "gamedeptype": pages[x["game_id"]][0],
+                     "page_id": x["game_id"],
+                     "name": pages[x["game_id"]][1],
+                     "revision_id": x["rev_id"]}
+                    for x in batch])
+                mark_changed(DBSession())
+        log("Linked %s dependencies" % len(links))
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    root, base = load_manifest(args.source)
+    env = bootstrap(args.config_uri)
+    try:
+        with transaction.manager:
+            importer = CatalogImporter(env['registry'].settings, base,
+                                       args.owner, args.batch, args.workers,
+                                       args.fetch)
+        entries = importer.entries(root)
+        importer.import_pages(entries)
+        importer.import_dependencies(entries)
+    finally:
+        env['closer']()
+    print("Done, restart the server so it picks up the new catalog.")
@@ -1,6 +1,7 @@
 from pyracms.lib.settingslib import SettingsLib
-from ..models import OperatingSystems, Architectures
+from ..models import OperatingSystems, Architectures, GameDepChangeLock
 from ..lib.gamedeplib import GAME, DEP
+from .upgradedb import SETTINGS
 from pyracms.factory import RootFactory
 from pyracms.lib.menulib import MenuLib
 from pyracms.lib.userlib import UserLib
@@ -48,6 +49,9 @@ def main(argv=sys.argv):
         DBSession.add(Architectures("ppc64", "64bit PowerPC"))
         DBSession.add(Architectures("sparc", "32bit SPARC"))
         DBSession.add(Architectures("sparc64", "64bit SPARC"))
+
+        # Locked while adding to the change feed, see ChangeLib
+        DBSession.add(GameDepChangeLock(1))
     
         # Default Groups
         u = UserLib()
@@ -99,6 +103,8 @@ def main(argv=sys.argv):
                  "You have not uploaded any binaries.")
         s.create("ERROR_NOT_UPLOADED_SOURCE_CODE",
                  "You have not uploaded any source code.")
+        for name, value in SETTINGS:
+            s.create(name, value)
         s.create("HYPERNUCLEUS_SERVER")
 
         m = MenuLib()
@@ -0,0 +1,109 @@
+from pyracms.lib.settingslib import SettingsLib
+from pyracms.models import Base, DBSession
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import engine_from_config, inspect, text
+from sqlalchemy.schema import CreateColumn
+import os
+import sys
+import transaction
+
+from .. import models
+from ..models import GameDepChangeLock
+
+# Run once after a column is added, to fill it in for existing rows
+BACKFILL = {
+    ("gamedeppage", "updated"):
+        "UPDATE gamedeppage SET updated = created",
+}
+
+# Settings added since the first release, initializedb creates them too
+SETTINGS = [
+    ("ERROR_UPLOAD_PROCESSING",
+     "Your uploads are still being processed or failed, check them "
+     "before publishing."),
+]
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print(('usage: %s <config_uri>\n'
+          'Bring a database made by an older version up to date: adds '
+          'new tables, columns and indexes.\n'
+          '(example: "%s development.ini")' % (cmd, cmd)))
+    sys.exit(1)
+
+def model_tables():
+    """
+    Get the tables of this package's models
+    """
+    return [x.__table__ for x in vars(models).values()
+            if isinstance(x, type) and issubclass(x, Base) and
+               x.__module__ == models.__name__]
+
+def upgrade(engine, log=print):
+    """
+    Create missing tables, then add missing columns and indexes to the
+    existing ones, and the rows initializedb seeds. Columns added to
+    existing tables must be nullable or have a server default.
+    """
+    tables = model_tables()
+    inspector = inspect(engine)
+    existing = set(inspector.get_table_names())
+    Base.metadata.create_all(engine, tables=tables)
+    for table in tables:
+        if table.name not in existing:
+            log("Created %s" % table.name)
+            continue
+        columns = set(x["name"] for x in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            if not column.nullable and column.server_default is None:
+                raise ValueError("%s.%s needs a server default to be added"
+                                 % (table.name, column.name))
+            ddl = CreateColumn(column).compile(dialect=engine.dialect)
+            with engine.begin() as connection:
+                connection.execute(text("ALTER TABLE %s ADD COLUMN %s" % (
+                                         table.name, ddl)))
+                backfill = BACKFILL.get((table.name, column.name))
+                if backfill:
+                    connection.execute(text(backfill))
+            log("Added %s.%s" % (table.name, column.name))
+        indexes = set(x["name"] for x in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(engine)
+                log("Added index %s" % index.name)
+    seed_rows(engine, log)
+
+def seed_rows(engine, log=print):
+    """
+    Add the rows initializedb creates that the code expects to exist
+    """
+    lock = GameDepChangeLock.__table__
+    with engine.begin() as connection:
+        if connection.execute(lock.select().where(lock.c.id == 1)
+                              ).first() is None:
+            connection.execute(lock.insert().values(id=1))
+            log("Added the change log lock row")
+
+def seed_settings(log=print):
+    """
+    Create the settings in SETTINGS that are missing
+    """
+    s = SettingsLib()
+    for name, value in SETTINGS:
+        if not s.has_setting(name):
+            s.create(name, value)
+            log("Added setting %s" % name)
+
+def main(argv=sys.argv):
+    if len(argv) != 2:
+        usage(argv)
+    config_uri = argv[1]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    upgrade(engine)
+    with transaction.manager:
+        seed_settings()
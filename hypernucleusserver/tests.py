@@ -1,9 +1,12 @@
+import json
 import unittest
 import transaction
 
 from pyramid import testing
+from sqlalchemy import text
+from zope.sqlalchemy import mark_changed
 
-from .models import DBSession
+from pyracms.models import DBSession
 
 class TestMyView(unittest.TestCase):
     def setUp(self):
@@ -30,3 +33,1601 @@ class TestMyView(unittest.TestCase):
         info = my_view(request)
         self.assertEqual(info['one'].name, 'one')
         self.assertEqual(info['project'], 'hypernucleus-server')
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Runs each test against an empty in memory database
+    """
+    settings = {}
+
+    def setUp(self):
+        self.config = testing.setUp(settings=self.settings)
+        from sqlalchemy import create_engine
+        from .models import Base
+        self.engine = create_engine('sqlite://')
+        DBSession.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        from .scripts.upgradedb import seed_rows
+        seed_rows(self.engine, log=lambda x: None)
+
+    def tearDown(self):
+        DBSession.remove()
+        testing.tearDown()
+
+    def add_page(self, name, gamedeptype="dep", versions=(), published=True):
+        """
+        Add a page with a revision for each version, returns its id
+        """
+        from .models import GameDepPage, GameDepRevision
+        page_id = DBSession.execute(GameDepPage.__table__.insert(), {
+                    "gamedeptype": gamedeptype, "owner_id": 1, "name": name,
+                    "display_name": name.capitalize(), "thread_id": -1,
+                    "album_id": -1}).inserted_primary_key[0]
+        for version in versions:
+            DBSession.execute(GameDepRevision.__table__.insert(), {
+                "page_id": page_id, "moduletype": "file",
+                "version": version, "published": published})
+        mark_changed(DBSession())
+        return page_id
+
+class TestOutputLibQueries(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+        from sqlalchemy import create_engine, event
+        from .models import Base
+        self.engine = create_engine('sqlite://')
+        DBSession.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        self.statements = []
+        event.listen(self.engine, "before_cursor_execute",
+                     lambda *args: self.statements.append(args[2]))
+        self.page_count = 0
+
+    def tearDown(self):
+        DBSession.remove()
+        testing.tearDown()
+
+    def add_pages(self, count):
+        """
+        Add count dependencies with two revisions, a tag and a
+        dependency on the previous page.
+        """
+        from .models import (GameDepPage, GameDepRevision, GameDepTags,
+                             GameDepDependency)
+        with transaction.manager:
+            for i in range(count):
+                self.page_count += 1
+                page_id = self.page_count
+                DBSession.execute(GameDepPage.__table__.insert(), {
+                    "id": page_id, "gamedeptype": "dep", "owner_id": 1,
+                    "name": "dep%s" % page_id, "display_name": "Dep",
+                    "thread_id": -1, "album_id": -1})
+                for rev in range(2):
+                    DBSession.execute(GameDepRevision.__table__.insert(), {
+                        "id": page_id * 2 + rev, "page_id": page_id,
+                        "moduletype": "file", "version": rev + 0.1,
+                        "published": True})
+                DBSession.execute(GameDepTags.__table__.insert(), {
+                    "name": "tag", "game_id": page_id})
+                if page_id > 1:
+                    DBSession.execute(GameDepDependency.__table__.insert(), {
+                        "game_id": page_id, "rev_id": (page_id - 1) * 2})
+            mark_changed(DBSession())
+
+    def show_json(self):
+        from unittest import mock
+        from .lib import outputlib
+        with mock.patch.object(outputlib, "WidgetLib"), \
+             mock.patch.object(outputlib, "SettingsLib") as settings:
+            settings.return_value.has_setting.return_value = False
+            olib = outputlib.OutputLib(testing.DummyRequest())
+            olib.uploadurl = "/uploads/"
+            self.statements = []
+            result = olib.show_json()
+        return result, len(self.statements)
+
+    def test_query_count_is_constant(self):
+        self.add_pages(2)
+        small, small_count = self.show_json()
+        self.add_pages(20)
+        large, large_count = self.show_json()
+        self.assertEqual(small_count, large_count)
+        self.assertEqual(len(json.loads(large)["gamedep"]), 22)
+        dep = json.loads(large)["gamedep"][1]["dependency"]
+        self.assertEqual(dep["dependencies"],
+                         [{"dependency": "dep1", "version": "0.1"}])
+        self.assertEqual([x["version"] for x in dep["revisions"]],
+                         ["1.1", "0.1"])
+
+    def test_load_pictures(self):
+        import sys
+        import types
+        from unittest import mock
+        from pyracms.models import Files
+        from sqlalchemy import Column, ForeignKey, Integer, Unicode
+        from sqlalchemy.ext.declarative import declarative_base
+        from sqlalchemy.orm import relationship
+        # Stands in for the gallery plugin's album and picture models
+        GalleryBase = declarative_base()
+        class GalleryPicture(GalleryBase):
+            __tablename__ = "gallerypicture"
+            id = Column(Integer, primary_key=True)
+            album_id = Column(Integer, ForeignKey("galleryalbum.id"))
+            file_id = Column(Integer, ForeignKey(Files.id))
+            file_obj = relationship(Files)
+            display_name = Column(Unicode(128))
+            description = Column(Unicode(128))
+        class GalleryAlbum(GalleryBase):
+            __tablename__ = "galleryalbum"
+            id = Column(Integer, primary_key=True)
+            default_picture_id = Column(Integer)
+            pictures = relationship(GalleryPicture, order_by=GalleryPicture.id)
+            default_picture = relationship(GalleryPicture, uselist=False,
+                primaryjoin=default_picture_id == GalleryPicture.id,
+                foreign_keys=default_picture_id)
+        GalleryBase.metadata.create_all(self.engine)
+        with transaction.manager:
+            for i in (1, 2):
+                DBSession.add(Files(id=i, uuid="uuid%s" % i,
+                                    name="shot%s.jpg" % i))
+                DBSession.add(GalleryPicture(id=i, album_id=1, file_id=i,
+                                             display_name="Shot %s" % i,
+                                             description=""))
+            DBSession.add(GalleryAlbum(id=1, default_picture_id=2))
+        from .lib import outputlib
+        from .models import GameDepPage
+        gallery = types.ModuleType("pyracms_gallery.models")
+        gallery.GalleryAlbum = GalleryAlbum
+        with mock.patch.dict(sys.modules, {"pyracms_gallery.models": gallery,
+                                           "pyracms_gallery": gallery}), \
+             mock.patch.object(outputlib, "WidgetLib"), \
+             mock.patch.object(outputlib, "SettingsLib") as settings:
+            settings.return_value.has_setting.return_value = False
+            olib = outputlib.OutputLib(testing.DummyRequest())
+            olib.uploadurl = "/uploads/"
+            with transaction.manager:
+                self.add_pages(1)
+                DBSession.query(GameDepPage).update({"album_id": 1})
+                self.page_count += 1
+                DBSession.execute(GameDepPage.__table__.insert(), {
+                    "id": self.page_count, "gamedeptype": "dep",
+                    "owner_id": 1, "name": "noalbum", "display_name": "Dep",
+                    "thread_id": -1, "album_id": -1})
+                self.statements = []
+                pictures = olib.load_pictures(
+                                DBSession.query(GameDepPage.album_id))
+        # Pages without an album are left out instead of raising
+        self.assertEqual(list(pictures), [1])
+        self.assertEqual([(x["url"], x["thumb_url"], x["default"])
+                          for x in pictures[1]],
+                         [("/uploads/uuid1/shot1.jpg",
+                           "/uploads/uuid1/shot1.thumbnail.png", False),
+                          ("/uploads/uuid2/shot2.jpg",
+                           "/uploads/uuid2/shot2.thumbnail.png", True)])
+        self.assertEqual(len(self.statements), 2)
+
+
+class TestCatalogSnapshot(unittest.TestCase):
+    def test_rebuilt_after_commit_only(self):
+        from .lib.snapshotlib import CatalogSnapshot
+        snapshot = CatalogSnapshot()
+        builds = []
+        def build():
+            builds.append(1)
+            return {"json": b"%d" % len(builds)}
+        self.assertEqual(snapshot.show("json", build), b"1")
+        self.assertEqual(snapshot.show("json", build), b"1")
+        transaction.begin()
+        snapshot.invalidate_on_commit()
+        snapshot.invalidate_on_commit()
+        transaction.abort()
+        self.assertEqual(snapshot.show("json", build), b"1")
+        transaction.begin()
+        snapshot.invalidate_on_commit()
+        snapshot.invalidate_on_commit()
+        transaction.commit()
+        self.assertEqual(snapshot.generation, 1)
+        self.assertEqual(snapshot.show("json", build), b"2")
+
+    def test_cached(self):
+        from .lib.snapshotlib import CatalogSnapshot
+        snapshot = CatalogSnapshot()
+        builds = []
+        def build():
+            builds.append(1)
+            return len(builds)
+        self.assertEqual(snapshot.cached("dropdown", build), 1)
+        self.assertEqual(snapshot.cached("dropdown", build), 1)
+        snapshot.invalidate()
+        self.assertEqual(snapshot.cached("dropdown", build), 2)
+        self.assertEqual(snapshot.snapshot, None)
+
+    def test_cached_not_kept_when_stale(self):
+        from sqlalchemy import create_engine, event
+        from .lib.snapshotlib import CatalogSnapshot
+        DBSession.remove()
+        DBSession.configure(bind=create_engine("sqlite://"))
+        self.addCleanup(DBSession.remove)
+        snapshot = CatalogSnapshot()
+        for name in ("after_begin", "after_transaction_end"):
+            event.listen(DBSession, name, getattr(snapshot, name))
+            self.addCleanup(event.remove, DBSession, name,
+                            getattr(snapshot, name))
+        builds = []
+        def build(invalidate=False):
+            DBSession.execute(text("select 1"))
+            builds.append(1)
+            if invalidate:
+                # Another transaction commits while this one builds
+                snapshot.invalidate()
+            return len(builds)
+        with transaction.manager:
+            self.assertEqual(snapshot.cached("dropdown",
+                                             lambda: build(True)), 1)
+            self.assertEqual(snapshot.cached("dropdown", build), 2)
+        with transaction.manager:
+            DBSession.execute(text("select 1"))
+            # Committed after this transaction began
+            snapshot.invalidate()
+            self.assertEqual(snapshot.cached("dropdown", build), 3)
+            self.assertEqual(snapshot.cached("dropdown", build), 4)
+        with transaction.manager:
+            self.assertEqual(snapshot.cached("dropdown", build), 5)
+            self.assertEqual(snapshot.cached("dropdown", build), 5)
+
+    def test_current_not_kept_when_stale(self):
+        from sqlalchemy import create_engine, event
+        from .lib.snapshotlib import CatalogSnapshot
+        DBSession.remove()
+        DBSession.configure(bind=create_engine("sqlite://"))
+        self.addCleanup(DBSession.remove)
+        snapshot = CatalogSnapshot()
+        for name in ("after_begin", "after_transaction_end"):
+            event.listen(DBSession, name, getattr(snapshot, name))
+            self.addCleanup(event.remove, DBSession, name,
+                            getattr(snapshot, name))
+        builds = []
+        def build():
+            DBSession.execute(text("select 1"))
+            builds.append(1)
+            return {"json": b"%d" % len(builds)}
+        with transaction.manager:
+            # An authenticated request has already queried the user
+            DBSession.execute(text("select 1"))
+            # Committed after this transaction began
+            snapshot.invalidate()
+            self.assertEqual(snapshot.show("json", build), b"1")
+            self.assertEqual(snapshot.snapshot, None)
+        with transaction.manager:
+            self.assertEqual(snapshot.show("json", build), b"2")
+            self.assertEqual(snapshot.show("json", build), b"2")
+            self.assertEqual(snapshot.snapshot.generation, 1)
+
+
+class TestBestEncoding(unittest.TestCase):
+    def test_negotiation(self):
+        from .lib.snapshotlib import best_encoding
+        self.assertEqual(best_encoding(None), None)
+        self.assertEqual(best_encoding("identity"), None)
+        self.assertEqual(best_encoding("gzip, deflate"), "gzip")
+        self.assertEqual(best_encoding("*"), "gzip")
+        self.assertEqual(best_encoding("xz, gzip"), "gzip")
+        self.assertEqual(best_encoding("xz, gzip;q=0.5"), "xz")
+        self.assertEqual(best_encoding("xz"), "xz")
+        self.assertEqual(best_encoding("gzip;q=0, *"), None)
+        self.assertEqual(best_encoding("GZIP;q=0.2"), "gzip")
+
+    def test_encode(self):
+        import gzip
+        import lzma
+        from datetime import datetime
+        from .lib.snapshotlib import Snapshot
+        snapshot = Snapshot(1, datetime(2020, 1, 1), {"json": b"{}" * 100})
+        self.assertEqual(gzip.decompress(snapshot.encode("json", "gzip")),
+                         b"{}" * 100)
+        self.assertEqual(lzma.decompress(snapshot.encode("json", "xz")),
+                         b"{}" * 100)
+        self.assertTrue(snapshot.encode("json", "gzip") is
+                        snapshot.encode("json", "gzip"))
+
+
+class TestOutputFeed(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def get(self, headers=None):
+        """
+        Get the json feed of a fixed snapshot, with the conditional
+        headers applied as the WSGI server would
+        """
+        from datetime import datetime
+        from pyramid.request import Request
+        from .lib.snapshotlib import Snapshot
+        from .views import output_feed
+        snapshot = Snapshot(3, datetime(2020, 1, 2, 3, 4, 5),
+                            {"json": b'{"gamedep": []}', "cursor": b"7"})
+        request = Request.blank("/outputs/json", headers=headers or {})
+        request.registry = self.config.registry
+        res = output_feed(request, "json", "application/json", snapshot)
+        return res, request.get_response(res)
+
+    def test_headers(self):
+        res, served = self.get()
+        self.assertEqual(served.status_int, 200)
+        self.assertEqual(served.body, b'{"gamedep": []}')
+        self.assertEqual(served.headers["X-Catalog-Cursor"], "7")
+        self.assertTrue(res.etag)
+        self.assertEqual(served.headers["Last-Modified"],
+                         "Thu, 02 Jan 2020 03:04:05 GMT")
+
+    def test_not_modified(self):
+        res, served = self.get()
+        res, served = self.get({"If-None-Match": '"%s"' % res.etag})
+        self.assertEqual(served.status_int, 304)
+        self.assertEqual(served.body, b"")
+        res, served = self.get({"If-Modified-Since":
+                                "Thu, 02 Jan 2020 03:04:05 GMT"})
+        self.assertEqual(served.status_int, 304)
+        res, served = self.get({"If-Modified-Since":
+                                "Wed, 01 Jan 2020 00:00:00 GMT"})
+        self.assertEqual(served.status_int, 200)
+        res, served = self.get({"If-None-Match": '"other"'})
+        self.assertEqual(served.status_int, 200)
+
+
+class TestFeedLib(unittest.TestCase):
+    root = {"operatingsystems": [{"name": "pi", "display_name": "PI"}],
+            "architectures": [],
+            "gamedep": [{"game": {"name": "g", "tags": [],
+                                  "description": None,
+                                  "pictures": [{"default": True}]}},
+                        {"dependency": {"name": "dé <&>"}}]}
+
+    def test_iter_json(self):
+        from .lib.feedlib import iter_json
+        streamed = dict((key, iter(value))
+                        for key, value in self.root.items())
+        self.assertEqual("".join(iter_json(streamed)),
+                         json.dumps(self.root, sort_keys=True, indent=4))
+
+    def test_iter_xml(self):
+        from .lib.dicttoxml import dicttoxml
+        from .lib.feedlib import iter_xml
+        expected = dicttoxml(json.loads(json.dumps(self.root,
+                                                   sort_keys=True)),
+                             custom_root="hypernucleus", attr_type=False)
+        self.assertEqual("".join(iter_xml(self.root)).encode(), expected)
+
+    def test_platform_catalog(self):
+        from .lib.feedlib import platform_catalog
+        binaries = [{"operating_system": os, "architecture": arch}
+                    for os, arch in (("pi", "pi"), ("lin", "x86_64"),
+                                     ("win", "x86_64"), ("lin", "pi"))]
+        root = {"gamedep": [{"dependency": {"revisions": [
+                                {"binaries": binaries}]}}]}
+        result = platform_catalog(root, "lin", "x86_64")
+        revision = result["gamedep"][0]["dependency"]["revisions"][0]
+        self.assertEqual(revision["binaries"],
+                         [binaries[0], binaries[1], binaries[3]])
+        self.assertEqual(len(binaries), 4)
+
+
+class TestDependencyGraph(unittest.TestCase):
+    def test_queries_and_updates(self):
+        from .lib.depgraphlib import DependencyGraph
+        g = DependencyGraph()
+        g.clear()
+        for page_id, name in ((1, "game"), (2, "liba"), (3, "libb")):
+            g.add_page(page_id, name)
+        g.add_revision(20, 2)
+        g.add_revision(30, 3)
+        g.add_edge(1, 20)
+        g.add_edge(2, 30)
+        g.add_edge(2, 30)
+        self.assertEqual(g.dependencies(1), [2])
+        self.assertEqual(g.dependents(3), [2])
+        self.assertEqual(g.revision_dependents(30), [2])
+        self.assertEqual(g.all_dependencies(1), [2, 3])
+        self.assertEqual(g.all_dependents(3), [2, 1])
+        g.remove_revision(30)
+        self.assertEqual(g.all_dependencies(1), [2])
+        g.remove_page(2)
+        self.assertEqual(g.dependencies(1), [])
+        self.assertEqual(g.page_id("liba"), None)
+
+
+class TestDownloadLib(unittest.TestCase):
+    def setUp(self):
+        import os, tempfile
+        self.config = testing.setUp(settings={})
+        self.upload_path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.upload_path, "abc"))
+        with open(os.path.join(self.upload_path, "abc", "bin.zip"),
+                  "wb") as f:
+            f.write(b"0123456789")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.upload_path)
+        testing.tearDown()
+
+    def get(self, **headers):
+        from webob import Request
+        from .lib.downloadlib import DownloadLib
+        request = Request.blank("/outputs/file/1", headers=headers)
+        request.registry = self.config.registry
+        request.registry.settings["hypernucleus.upload_path"] = \
+            self.upload_path
+        file_obj = testing.DummyResource(uuid="abc", name="bin.zip",
+                                         mimetype="application/zip")
+        return request.get_response(DownloadLib(request).response(file_obj))
+
+    def test_range(self):
+        res = self.get()
+        self.assertEqual(res.status_int, 200)
+        self.assertEqual(res.body, b"0123456789")
+        self.assertEqual(self.get(Range="bytes=4-").body, b"456789")
+        etag = '"%s"' % res.etag
+        res = self.get(Range="bytes=2-3", **{"If-Range": etag})
+        self.assertEqual(res.status_int, 206)
+        self.assertEqual(res.body, b"23")
+        res = self.get(Range="bytes=2-3", **{"If-Range": '"stale"'})
+        self.assertEqual(res.status_int, 200)
+        self.assertEqual(self.get(**{"If-None-Match": etag}).status_int, 304)
+
+    def test_range_seeks(self):
+        from webob import Request
+        from .lib.downloadlib import DownloadLib
+        request = Request.blank("/outputs/file/1", headers={
+                                    "Range": "bytes=8-"})
+        request.registry = self.config.registry
+        request.registry.settings["hypernucleus.upload_path"] = \
+            self.upload_path
+        res = DownloadLib(request).response(testing.DummyResource(
+                    uuid="abc", name="bin.zip", mimetype="application/zip"))
+        reads = []
+        fobj = res.app_iter.file
+        read = fobj.read
+        fobj.read = lambda size: reads.append(fobj.tell()) or read(size)
+        res = request.get_response(res)
+        self.assertEqual(res.status_int, 206)
+        self.assertEqual(res.body, b"89")
+        self.assertEqual(reads[0], 8)
+
+    def test_content_disposition(self):
+        from .lib.downloadlib import content_disposition
+        self.assertEqual(content_disposition("bin.zip"),
+                         "attachment; filename=\"bin.zip\"; "
+                         "filename*=UTF-8''bin.zip")
+        self.assertEqual(content_disposition('sp\u00e9l "1".zip'),
+                         "attachment; filename=\"sp_l _1_.zip\"; "
+                         "filename*=UTF-8''sp%C3%A9l%20%221%22.zip")
+
+
+class TestBlobLib(unittest.TestCase):
+    def test_hash_stream(self):
+        import hashlib, io
+        from .lib.bloblib import hash_stream, BLOCK_SIZE
+        data = b"x" * (BLOCK_SIZE + 10)
+        output = io.BytesIO()
+        self.assertEqual(hash_stream(io.BytesIO(data), output),
+                         (hashlib.sha256(data).hexdigest(), len(data)))
+        self.assertEqual(output.getvalue(), data)
+
+
+class TestBlobReferences(DatabaseTestCase):
+    def setUp(self):
+        super(TestBlobReferences, self).setUp()
+        from pyracms.models import Files
+        from .models import GameDepBlob
+        transaction.begin()
+        for i in (1, 2):
+            DBSession.add(Files(id=i, uuid="uuid%s" % i, name="bin.zip"))
+        DBSession.flush()
+        DBSession.add(GameDepBlob("aa" * 32, DBSession.query(Files).get(1),
+                                  10))
+        DBSession.flush()
+
+    def tearDown(self):
+        transaction.abort()
+        super(TestBlobReferences, self).tearDown()
+
+    def blob_lib(self):
+        from .lib.bloblib import BlobLib
+        return BlobLib(testing.DummyRequest())
+
+    def refcount(self):
+        from .models import GameDepBlob
+        return DBSession.execute(GameDepBlob.__table__.select()).first(
+                                                                ).refcount
+
+    def test_link(self):
+        from .lib.bloblib import BlobNotFound
+        b = self.blob_lib()
+        blob = b.show("AA" * 32)
+        # Another request took a reference after blob was loaded
+        DBSession.execute(text("UPDATE gamedepblob SET refcount = 5"))
+        self.assertEqual(b.link("aa" * 32).id, 1)
+        self.assertEqual(self.refcount(), 6)
+        self.assertEqual(blob.refcount, 6)
+        self.assertRaises(BlobNotFound, b.link, "bb" * 32)
+
+    def test_release(self):
+        from unittest import mock
+        from pyracms.models import Files
+        from .lib import bloblib
+        from .models import GameDepBlob
+        b = self.blob_lib()
+        file_obj = DBSession.query(Files).get(1)
+        b.link("aa" * 32)
+        with mock.patch.object(bloblib, "FileLib") as file_lib, \
+             mock.patch.object(bloblib, "DownloadLib"):
+            b.release(file_obj)
+            self.assertEqual(self.refcount(), 1)
+            self.assertFalse(file_lib.return_value.delete.called)
+            b.release(file_obj)
+            self.assertEqual(DBSession.query(GameDepBlob).count(), 0)
+            file_lib.return_value.delete.assert_called_once_with(file_obj)
+
+    def test_add_same_bytes(self):
+        from pyracms.models import Files
+        b = self.blob_lib()
+        # Stored by a concurrent upload between the lookup and the insert
+        self.assertEqual(b.add("aa" * 32, DBSession.query(Files).get(2), 10,
+                               None).id, 1)
+        self.assertEqual(self.refcount(), 2)
+        self.assertEqual(b.add("bb" * 32, DBSession.query(Files).get(2), 10,
+                               [{"name": "a"}]).id, 2)
+        self.assertEqual(b.members(DBSession.query(Files).get(2)),
+                         [{"name": "a"}])
+
+
+class TestDeleteDependency(DatabaseTestCase):
+    def setUp(self):
+        import os, tempfile
+        super(TestDeleteDependency, self).setUp()
+        from pyracms.models import Files
+        from .models import GameDepBinary, GameDepBlob, GameDepDependency
+        self.upload_path = tempfile.mkdtemp()
+        self.config.registry.settings["hypernucleus.upload_path"] = \
+            self.upload_path
+        self.path = os.path.join(self.upload_path, "uuid1", "bin.zip")
+        os.mkdir(os.path.dirname(self.path))
+        with open(self.path, "wb") as f:
+            f.write(b"bytes")
+        with transaction.manager:
+            game_id = self.add_page("game1", gamedeptype="game",
+                                    versions=[1.0])
+            self.dep_id = self.add_page("dep1", versions=[1.0])
+            file_obj = Files(id=1, uuid="uuid1", name="bin.zip")
+            DBSession.add(file_obj)
+            DBSession.add(GameDepBlob("aa" * 32, file_obj, 5))
+            DBSession.execute(GameDepBinary.__table__.insert(), {
+                "revision_id": 2, "file_id": 1, "operatingsystem_id": 1,
+                "architecture_id": 1})
+            DBSession.execute(GameDepDependency.__table__.insert(), {
+                "game_id": game_id, "rev_id": 2})
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.upload_path)
+        super(TestDeleteDependency, self).tearDown()
+
+    def test_releases_files(self):
+        import os
+        from pyracms.models import Files
+        from .lib.gamedeplib import GameDepLib
+        from .lib.requestcachelib import RequestCache
+        from .models import GameDepBinary, GameDepBlob
+        request = testing.DummyRequest()
+        request.gamedep_cache = RequestCache()
+        with transaction.manager:
+            GameDepLib("game", request).delete_dependency(
+                                        "game1", self.dep_id, request)
+        with transaction.manager:
+            self.assertEqual(DBSession.query(GameDepBinary).count(), 0)
+            self.assertEqual(DBSession.query(GameDepBlob).count(), 0)
+            self.assertEqual(DBSession.query(Files).count(), 0)
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TestUploadLib(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.spool_path = tempfile.mkdtemp()
+        self.config = testing.setUp(settings={
+                            "hypernucleus.upload_spool_path": self.spool_path,
+                            "hypernucleus.upload_chunk_size": "4"})
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.spool_path)
+        testing.tearDown()
+
+    def test_chunks(self):
+        import io
+        from .lib.uploadlib import UploadLib, ChunkTooLarge, ChunksMissing
+        u = UploadLib(testing.DummyRequest())
+        session = u.create({"kind": "binary"})
+        u.write_chunk(session, 1, io.BytesIO(b"5678"))
+        self.assertRaises(ChunksMissing, u.reader, session)
+        self.assertRaises(ChunkTooLarge, u.write_chunk, session, 0,
+                          io.BytesIO(b"12345"))
+        u.write_chunk(session, 0, io.BytesIO(b"1234"))
+        u.write_chunk(session, 2, io.BytesIO(b"9"))
+        self.assertEqual(u.show(session)["chunks"], [0, 1, 2])
+        reader = u.reader(session)
+        self.assertEqual(reader.read(3), b"123")
+        self.assertEqual(reader.read(), b"456789")
+        u.delete(session)
+        import os
+        self.assertEqual(os.listdir(self.spool_path), [])
+
+
+class TestZipLib(unittest.TestCase):
+    def make_zip(self, names, compression=0):
+        import io, zipfile
+        fp = io.BytesIO()
+        with zipfile.ZipFile(fp, "w", compression) as z:
+            for name, data in names:
+                z.writestr(name, data)
+        return fp
+
+    def test_index(self):
+        from .lib.ziplib import read_index, missing_members
+        index = read_index(self.make_zip([("foo/foo.py", "print(1)")]))
+        self.assertEqual([x["name"] for x in index], ["foo/foo.py"])
+        self.assertEqual(index[0]["size"], 8)
+        self.assertEqual(missing_members(index, ["foo/", "foo/foo.py",
+                                                 "foo/__init__.py"]),
+                         ["foo/__init__.py"])
+
+    def test_limits(self):
+        import io, zipfile
+        from .lib.ziplib import read_index, ZipInvalid
+        fp = self.make_zip([("a", "x" * 10000), ("b", "")],
+                           zipfile.ZIP_DEFLATED)
+        self.assertRaises(ZipInvalid, read_index, fp, max_members=1)
+        self.assertRaises(ZipInvalid, read_index, fp, max_size=100)
+        self.assertRaises(ZipInvalid, read_index, fp, max_ratio=10)
+        self.assertRaises(ZipInvalid, read_index, io.BytesIO(b"not a zip"))
+
+
+class TestCounterBuffer(unittest.TestCase):
+    def test_take_and_restore(self):
+        from .lib.counterlib import CounterBuffer
+        c = CounterBuffer()
+        c.start = lambda: None
+        c.increment("view", 1)
+        c.increment("view", 1)
+        c.increment("download", 7)
+        self.assertEqual(c.pending("view", 1), 2)
+        deltas = c.take()
+        self.assertEqual(c.pending("view", 1), 0)
+        c.increment("view", 1)
+        c.restore(deltas)
+        self.assertEqual(c.pending("view", 1), 3)
+        self.assertEqual(c.pending("download", 7), 1)
+
+
+class TestCountedDownloads(DatabaseTestCase):
+    def setUp(self):
+        import os, tempfile
+        super(TestCountedDownloads, self).setUp()
+        from pyracms.models import Files
+        from .models import GameDepBinary
+        self.upload_path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.upload_path, "abc"))
+        with open(os.path.join(self.upload_path, "abc", "bin.zip"),
+                  "wb") as f:
+            f.write(b"0123456789")
+        with transaction.manager:
+            DBSession.add(Files(id=1, uuid="abc", name="bin.zip"))
+            # Two binaries sharing the same bytes
+            for binary_id in (1, 2):
+                DBSession.execute(GameDepBinary.__table__.insert(), {
+                    "id": binary_id, "revision_id": 1, "file_id": 1,
+                    "operatingsystem_id": 1, "architecture_id": 1})
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.upload_path)
+        super(TestCountedDownloads, self).tearDown()
+
+    def get(self, name="bin.zip", query="", **headers):
+        from unittest import mock
+        from webob import Request
+        from . import views
+        request = Request.blank("/outputs/download/abc/%s%s" % (name, query),
+                                headers=headers)
+        request.registry = self.config.registry
+        request.registry.settings["hypernucleus.upload_path"] = \
+            self.upload_path
+        request.matchdict = {"uuid": "abc", "name": name}
+        with mock.patch.object(views, "counters") as counters, \
+             transaction.manager:
+            res = request.get_response(views.output_download(None, request))
+        return res.status_int, [x[0][1] for x in
+                                counters.increment.call_args_list]
+
+    def test_counted(self):
+        self.assertEqual(self.get(query="?binary=2"), (200, [2]))
+        # Unattributed downloads of a shared file go to the oldest binary
+        self.assertEqual(self.get(), (200, [1]))
+        self.assertEqual(self.get(query="?binary=9"), (200, [1]))
+        self.assertEqual(self.get(Range="bytes=4-"), (206, []))
+        self.assertEqual(self.get(name="other.zip"), (404, []))
+
+class TestDeltaLib(unittest.TestCase):
+    def roundtrip(self, old, new, block_size=64):
+        import io
+        from .lib.deltalib import signature, make_delta, apply_delta
+        delta = io.BytesIO()
+        make_delta(signature(io.BytesIO(old), block_size), block_size, new,
+                   delta.write)
+        delta.seek(0)
+        output = io.BytesIO()
+        apply_delta(io.BytesIO(old), delta, output.write)
+        self.assertEqual(output.getvalue(), new)
+        return len(delta.getvalue())
+
+    def test_delta(self):
+        import random
+        rand = random.Random(1)
+        old = bytes(rand.getrandbits(8) for x in range(20000))
+        # Inserted bytes shift every later block
+        new = old[:5000] + b"inserted" + old[5000:15000] + old[15100:]
+        self.assertTrue(self.roundtrip(old, new) < 500)
+        self.assertTrue(self.roundtrip(old, old) < 100)
+        self.roundtrip(b"", b"")
+
+    def test_too_large(self):
+        from .lib.deltalib import signature, make_delta, DeltaTooLarge
+        import io
+        self.assertRaises(DeltaTooLarge, make_delta,
+                          signature(io.BytesIO(b"a" * 1000), 64), 64,
+                          bytes(range(256)) * 4, lambda data: None)
+
+
+class TestDeltaDownloads(DatabaseTestCase):
+    def setUp(self):
+        import os, tempfile
+        super(TestDeltaDownloads, self).setUp()
+        from pyracms.models import Files
+        from .models import GameDepBinary, GameDepPage, GameDepRevision
+        self.upload_path = tempfile.mkdtemp()
+        self.settings = {"hypernucleus.upload_path": self.upload_path,
+                         "hypernucleus.delta_block_size": "64",
+                         "hypernucleus.delta_cache_path":
+                             os.path.join(self.upload_path, "deltas")}
+        contents = {"old": bytes(range(256)) * 8,
+                    "new": bytes(range(256)) * 8 + b"tail",
+                    "other": os.urandom(2048)}
+        with transaction.manager:
+            for file_id, uuid in enumerate(("old", "new", "other"), 1):
+                os.mkdir(os.path.join(self.upload_path, uuid))
+                with open(os.path.join(self.upload_path, uuid, "bin.zip"),
+                          "wb") as f:
+                    f.write(contents[uuid])
+                DBSession.add(Files(id=file_id, uuid=uuid, name="bin.zip"))
+            dep1 = self.add_page("dep1", versions=[1.0, 2.0])
+            dep2 = self.add_page("dep2", versions=[1.0])
+            revisions = DBSession.query(GameDepRevision.id).order_by(
+                                                GameDepRevision.id).all()
+            # old and new are dep1's linux binary, other is dep2's
+            for (rev_id,), file_id in zip(revisions, (1, 2, 3)):
+                DBSession.execute(GameDepBinary.__table__.insert(), {
+                    "revision_id": rev_id, "file_id": file_id,
+                    "operatingsystem_id": 1, "architecture_id": 1})
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.upload_path)
+        super(TestDeltaDownloads, self).tearDown()
+
+    def get(self, from_uuid, to_uuid):
+        from unittest import mock
+        from webob import Request
+        from . import views
+        request = Request.blank("/outputs/delta/%s/%s" % (from_uuid, to_uuid))
+        request.registry = self.config.registry
+        request.registry.settings.update(self.settings)
+        request.matchdict = {"from_uuid": from_uuid, "to_uuid": to_uuid}
+        with mock.patch.object(views, "pipeline") as pipeline, \
+             mock.patch.object(views, "route_url", return_value="/file"), \
+             transaction.manager:
+            res = views.output_delta(None, request)
+        return res, [x[0] for x in pipeline.delta.call_args_list]
+
+    def write_delta(self, from_uuid, to_uuid):
+        from .lib.downloadlib import DownloadLib
+        request = testing.DummyRequest()
+        request.registry.settings.update(self.settings)
+        with transaction.manager:
+            d = DownloadLib(request)
+            d.write_delta(d.show_uuid(from_uuid), d.show_uuid(to_uuid))
+
+    def test_generated_off_request(self):
+        import io, os
+        from .lib.deltalib import apply_delta
+        res, queued = self.get("old", "new")
+        self.assertEqual((res.status_int, res.headers["Retry-After"]),
+                         (202, "5"))
+        self.assertEqual(queued, [(1, 2)])
+        self.write_delta("old", "new")
+        res, queued = self.get("old", "new")
+        self.assertEqual((res.status_int, queued), (200, []))
+        output = []
+        with open(os.path.join(self.upload_path, "old", "bin.zip"),
+                  "rb") as old:
+            apply_delta(old, io.BytesIO(res.body), output.append)
+        self.assertEqual(b"".join(output)[-4:], b"tail")
+
+    def test_too_large_is_remembered(self):
+        import os
+        from unittest import mock
+        from .lib import downloadlib
+        with open(os.path.join(self.upload_path, "new", "bin.zip"),
+                  "wb") as f:
+            f.write(os.urandom(2048))
+        self.write_delta("old", "new")
+        with mock.patch.object(downloadlib, "make_delta") as make_delta:
+            self.write_delta("old", "new")
+        self.assertFalse(make_delta.called)
+        res, queued = self.get("old", "new")
+        self.assertEqual((res.status_int, res.location, queued),
+                         (409, "/file", []))
+
+    def test_only_same_binary(self):
+        res, queued = self.get("old", "other")
+        self.assertEqual((res.status_int, queued), (404, []))
+        res, queued = self.get("old", "old")
+        self.assertEqual((res.status_int, queued), (404, []))
+
+class TestRequestCache(unittest.TestCase):
+    def test_get(self):
+        from .lib.requestcachelib import RequestCache
+        loads = []
+        def load():
+            loads.append(1)
+            return None
+        c = RequestCache()
+        self.assertEqual(c.get(("page", "game", "Pong"), load), None)
+        self.assertEqual(c.get(("page", "game", "Pong"), load), None)
+        self.assertEqual((len(loads), c.hits, c.misses), (1, 1, 1))
+        c.clear()
+        c.get(("page", "game", "Pong"), load)
+        self.assertEqual(len(loads), 2)
+        c = RequestCache(enabled=False)
+        c.get("key", load)
+        c.get("key", load)
+        self.assertEqual(len(loads), 4)
+
+    def test_query_count_tween(self):
+        import logging
+        from sqlalchemy import create_engine, event
+        from sqlalchemy.engine import Engine
+        from .lib import requestcachelib
+        from .lib.requestcachelib import (query_count_tween_factory,
+                                          query_counter)
+        def handler(request):
+            with request.engine.connect() as connection:
+                connection.execute(text("select 1"))
+        self.addCleanup(requestcachelib.log.setLevel,
+                        requestcachelib.log.level)
+        requestcachelib.log.setLevel(logging.INFO)
+        self.assertTrue(query_count_tween_factory(handler, None) is handler)
+        self.assertFalse(event.contains(Engine, "before_cursor_execute",
+                                        query_counter))
+        requestcachelib.log.setLevel(logging.DEBUG)
+        tween = query_count_tween_factory(handler, None)
+        query_count_tween_factory(handler, None)
+        self.addCleanup(event.remove, Engine, "before_cursor_execute",
+                        query_counter)
+        request = testing.DummyRequest(engine=create_engine("sqlite://"))
+        start = query_counter.count
+        tween(request)
+        self.assertEqual(query_counter.count - start, 1)
+
+
+class TestPlatformCache(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+        from sqlalchemy import create_engine, event
+        from .models import Base, OperatingSystems
+        self.engine = create_engine('sqlite://')
+        DBSession.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        with transaction.manager:
+            DBSession.add(OperatingSystems("pi", "Platform Independent"))
+            DBSession.add(OperatingSystems("lin", "Linux"))
+        self.statements = []
+        event.listen(self.engine, "before_cursor_execute",
+                     lambda *args: self.statements.append(args[2]))
+
+    def tearDown(self):
+        DBSession.remove()
+        testing.tearDown()
+
+    def test_cached_until_commit(self):
+        from .lib.platformlib import PlatformCache, platforms
+        from .models import OperatingSystems
+        cache = PlatformCache()
+        with transaction.manager:
+            self.assertEqual([x.name for x in cache.list(OperatingSystems)],
+                             ["pi", "lin"])
+            self.statements = []
+            os_obj = cache.show(OperatingSystems, "2")
+            self.assertEqual(os_obj.display_name, "Linux")
+            self.assertTrue(os_obj in DBSession)
+            self.assertEqual(cache.show_name(OperatingSystems, "pi").id, 1)
+            self.assertEqual(cache.show(OperatingSystems, "x"), None)
+            self.assertEqual(self.statements, [])
+        with transaction.manager:
+            platforms.load(OperatingSystems)
+            DBSession.add(OperatingSystems("win", "Windows"))
+        self.assertEqual(platforms.tables, {})
+
+
+class TestChangeLib(DatabaseTestCase):
+    def test_written_on_commit(self):
+        from .lib.changelib import ChangeLib
+        from .models import GameDepChange, GameDepChangeLock, GameDepPage
+        c = ChangeLib()
+        with transaction.manager:
+            page = DBSession.query(GameDepPage).get(self.add_page("dep1"))
+            c.record("create", page)
+            c.record("update", page)
+            # Ids are only given out under the lock, at commit
+            self.assertEqual(DBSession.query(GameDepChange).count(), 0)
+        with transaction.manager:
+            self.assertEqual([(x.id, x.action, x.name) for x in c.since(0)],
+                             [(1, "create", "dep1"), (2, "update", "dep1")])
+            self.assertEqual([x.id for x in c.since(1)], [2])
+            self.assertEqual(c.since(0, 1)[0].id, 1)
+            self.assertEqual(c.latest(), 2)
+            self.assertEqual(DBSession.query(GameDepChangeLock).count(), 1)
+        transaction.begin()
+        c.record("delete", DBSession.query(GameDepPage).first())
+        transaction.abort()
+        with transaction.manager:
+            self.assertEqual(c.latest(), 2)
+            self.assertEqual(c.since(2), [])
+
+    def test_lock_row_missing(self):
+        from .lib.changelib import ChangeLib, ChangeLockMissing
+        from .models import GameDepChangeLock, GameDepPage
+        with transaction.manager:
+            DBSession.query(GameDepChangeLock).delete()
+        transaction.begin()
+        page = DBSession.query(GameDepPage).get(self.add_page("dep1"))
+        ChangeLib().record("create", page)
+        self.assertRaises(ChangeLockMissing, transaction.commit)
+        transaction.abort()
+
+
+class TestGameDepSearch(DatabaseTestCase):
+    def setUp(self):
+        super(TestGameDepSearch, self).setUp()
+        from datetime import datetime
+        from pyracms.models import User
+        from .models import (Architectures, GameDepBinary, GameDepPage,
+                             GameDepRevision, GameDepTags, OperatingSystems)
+        with transaction.manager:
+            DBSession.add(User(id=1, name="alice"))
+            DBSession.add(User(id=2, name="bob"))
+            DBSession.add(OperatingSystems("lin", "Linux"))
+            DBSession.add(OperatingSystems("win", "Windows"))
+            DBSession.add(Architectures("x86", "x86"))
+            for name in ("dep1", "dep2", "dep3", "dep4"):
+                self.add_page(name, versions=[1.0], published=name != "dep3")
+            self.add_page("game1", gamedeptype="game", versions=[1.0])
+            page = DBSession.query(GameDepPage).filter_by(name="dep2").one()
+            page.owner_id = 2
+            page.updated = datetime(2020, 1, 1)
+            page.tags.append(GameDepTags("puzzle"))
+            revision = DBSession.query(GameDepRevision).filter_by(
+                                    page_id=page.id).one()
+            revision.binary.append(GameDepBinary(None,
+                DBSession.query(OperatingSystems).filter_by(name="lin").one(),
+                DBSession.query(Architectures).filter_by(name="x86").one()))
+            DBSession.query(GameDepPage).filter(GameDepPage.name != "dep2"
+                ).update({"updated": datetime(2019, 1, 1)})
+
+    def search(self, **kwargs):
+        from .lib.gamedeplib import GameDepLib
+        with transaction.manager:
+            return [x.name for x in GameDepLib("dep").search(**kwargs)]
+
+    def test_filters(self):
+        from datetime import datetime
+        self.assertEqual(self.search(), ["dep1", "dep2", "dep3", "dep4"])
+        self.assertEqual(self.search(tag="puzzle"), ["dep2"])
+        self.assertEqual(self.search(owner="bob"), ["dep2"])
+        self.assertEqual(self.search(published_only=True),
+                         ["dep1", "dep2", "dep4"])
+        self.assertEqual(self.search(operatingsystem="lin"), ["dep2"])
+        self.assertEqual(self.search(operatingsystem="win"), [])
+        self.assertEqual(self.search(operatingsystem="lin",
+                                     architecture="x86"), ["dep2"])
+        self.assertEqual(self.search(architecture="nope"), [])
+        self.assertEqual(self.search(updated_since=datetime(2019, 6, 1)),
+                         ["dep2"])
+
+    def test_after_cursor(self):
+        self.assertEqual(self.search(limit=2), ["dep1", "dep2"])
+        self.assertEqual(self.search(after=2, limit=2), ["dep3", "dep4"])
+        self.assertEqual(self.search(after=4, limit=2), [])
+
+    def api(self, gamedeptype="dep", **params):
+        from cornice.errors import Errors
+        from .lib.requestcachelib import RequestCache
+        from .web_service_views import api_gamedep_search, validate_search
+        request = testing.DummyRequest(params=params)
+        request.matchdict = {"type": gamedeptype}
+        request.validated = {}
+        request.errors = Errors()
+        request.gamedep_cache = RequestCache()
+        validate_search(request)
+        if request.errors:
+            return request.errors
+        with transaction.manager:
+            return api_gamedep_search(request)
+
+    def test_list_api(self):
+        result = self.api(limit="3")
+        self.assertEqual([x["name"] for x in result["items"]],
+                         ["dep1", "dep2", "dep3"])
+        self.assertEqual(result["next"], 3)
+        result = self.api(after=str(result["next"]), limit="3")
+        self.assertEqual([x["name"] for x in result["items"]], ["dep4"])
+        self.assertEqual(result["next"], None)
+        result = self.api(tag="puzzle", updated_since="2019-06-01T00:00:00")
+        self.assertEqual(result["items"][0]["tags"], ["puzzle"])
+        self.assertEqual([x["name"] for x in self.api(limit="-5")["items"]],
+                         ["dep1"])
+        self.assertEqual([x["name"] for x in self.api(after="x")],
+                         ["after"])
+        self.assertEqual(self.api(gamedeptype="nope"),
+                         {"error": "not_found"})
+
+
+class TestUpgradeDB(unittest.TestCase):
+    def test_adds_missing_columns(self):
+        from sqlalchemy import create_engine, inspect
+        from .scripts.upgradedb import upgrade
+        engine = create_engine('sqlite://')
+        with engine.begin() as connection:
+            connection.execute(text(
+                "CREATE TABLE gamedeppage (id INTEGER PRIMARY KEY, "
+                "gamedeptype VARCHAR(4) NOT NULL, owner_id INTEGER "
+                "NOT NULL, name VARCHAR(128) NOT NULL, display_name "
+                "VARCHAR(128) NOT NULL, description VARCHAR(16384), "
+                "created DATETIME, thread_id INTEGER NOT NULL, "
+                "album_id INTEGER NOT NULL, view_count INTEGER)"))
+            connection.execute(text(
+                "INSERT INTO gamedeppage VALUES (1, 'dep', 1, 'dep1', "
+                "'Dep1', '', '2019-01-01 00:00:00.000000', -1, -1, 0)"))
+        messages = []
+        upgrade(engine, messages.append)
+        self.assertTrue("Added gamedeppage.updated" in messages)
+        self.assertTrue("Created gamedepchange" in messages)
+        self.assertTrue("Added the change log lock row" in messages)
+        self.assertTrue("ix_gamedeppage_updated" in
+                        [x["name"] for x in
+                         inspect(engine).get_indexes("gamedeppage")])
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute(text(
+                                "SELECT updated FROM gamedeppage")).scalar(),
+                             '2019-01-01 00:00:00.000000')
+        messages = []
+        upgrade(engine, messages.append)
+        self.assertEqual(messages, [])
+
+    def test_seed_settings(self):
+        from unittest import mock
+        from .scripts import upgradedb
+        messages = []
+        with mock.patch.object(upgradedb, "SettingsLib") as settings_lib:
+            settings_lib.return_value.has_setting.return_value = False
+            upgradedb.seed_settings(messages.append)
+            settings_lib.return_value.create.assert_called_once_with(
+                "ERROR_UPLOAD_PROCESSING", upgradedb.SETTINGS[0][1])
+            settings_lib.return_value.has_setting.return_value = True
+            upgradedb.seed_settings(messages.append)
+        self.assertEqual(messages, ["Added setting ERROR_UPLOAD_PROCESSING"])
+
+
+class TestResolverLib(DatabaseTestCase):
+    def setUp(self):
+        super(TestResolverLib, self).setUp()
+        transaction.begin()
+        self.add_page("game1", gamedeptype="game", versions=[1.0])
+
+    def tearDown(self):
+        transaction.abort()
+        super(TestResolverLib, self).tearDown()
+
+    def depend(self, name, dep_name, version, pinned=True):
+        from .models import GameDepDependency, GameDepPage, GameDepRevision
+        page = DBSession.query(GameDepPage).filter_by(name=name).one()
+        rev = DBSession.query(GameDepRevision).join(GameDepPage).filter(
+                            GameDepPage.name == dep_name,
+                            GameDepRevision.version == version).one()
+        DBSession.execute(GameDepDependency.__table__.insert(), {
+                        "game_id": page.id, "rev_id": rev.id,
+                        "pinned": pinned})
+
+    def resolve(self):
+        from unittest import mock
+        from .lib import resolverlib
+        with mock.patch.object(resolverlib, "WidgetLib"):
+            r = resolverlib.ResolverLib(testing.DummyRequest())
+        return r.resolve("game", "game1", "lin", "x86")
+
+    def test_order_and_pins(self):
+        self.add_page("liba", versions=[1.0, 2.0])
+        self.add_page("libb", versions=[1.0, 2.0])
+        self.add_page("libc", versions=[1.0])
+        self.depend("game1", "liba", 1.0, pinned=False)
+        self.depend("game1", "libb", 1.0)
+        self.depend("liba", "libb", 1.0, pinned=False)
+        self.depend("liba", "libc", 1.0, pinned=False)
+        result = self.resolve()
+        self.assertEqual([(x["name"], x["version"], x["pinned"])
+                          for x in result["plan"]],
+                         [("libb", "1.0", True), ("libc", "1.0", False),
+                          ("liba", "2.0", False), ("game1", "1.0", False)])
+        self.assertEqual(set(x["reason"] for x in result["missing"]),
+                         set(["no_binary"]))
+
+    def test_pin_problems(self):
+        from .models import GameDepPage, GameDepRevision
+        self.add_page("liba", versions=[1.0, 2.0])
+        self.add_page("libb", versions=[1.0, 2.0])
+        self.add_page("libc", versions=[1.0])
+        self.add_page("libd", versions=[1.0])
+        self.depend("game1", "liba", 1.0)
+        self.depend("game1", "libb", 2.0)
+        self.depend("liba", "libb", 1.0)
+        self.depend("game1", "libc", 1.0)
+        self.depend("libc", "libd", 1.0, pinned=False)
+        DBSession.query(GameDepRevision).filter(GameDepRevision.page_id.in_(
+            DBSession.query(GameDepPage.id).filter_by(name="libc"))).update(
+            {"published": False}, synchronize_session=False)
+        result = self.resolve()
+        self.assertEqual([x["name"] for x in result["plan"]],
+                         ["liba", "game1"])
+        missing = dict((x["name"], x) for x in result["missing"]
+                       if x["reason"] != "no_binary")
+        self.assertEqual(missing["libb"]["reason"], "pin_conflict")
+        self.assertEqual(sorted((x["version"], x["required_by"])
+                                for x in missing["libb"]["pins"]),
+                         [("1.0", "liba"), ("2.0", "game1")])
+        self.assertEqual((missing["libc"]["reason"],
+                          missing["libc"]["version"]),
+                         ("pin_unpublished", "1.0"))
+        # Only needed by a page that is not installed
+        self.assertFalse("libd" in missing)
+
+    def test_cycle(self):
+        from .lib.resolverlib import DependencyCycle
+        self.add_page("liba", versions=[1.0])
+        self.add_page("libb", versions=[1.0])
+        self.depend("game1", "liba", 1.0)
+        self.depend("liba", "libb", 1.0)
+        self.depend("libb", "liba", 1.0)
+        with self.assertRaises(DependencyCycle) as e:
+            self.resolve()
+        self.assertEqual(str(e.exception), "liba -> libb -> liba")
+
+    def test_use_latest_version_is_unpinned(self):
+        from .lib.gamedeplib import GameDepLib
+        from .models import GameDepDependency, GameDepRevision
+        liba = self.add_page("liba", versions=[1.0])
+        libb = self.add_page("libb", versions=[1.0])
+        g = GameDepLib("game")
+        g.create_dependency("game1", liba)
+        g.create_dependency("game1", libb, DBSession.query(
+                    GameDepRevision.id).filter_by(page_id=libb).scalar())
+        self.assertEqual([x.pinned for x in DBSession.query(
+                            GameDepDependency).order_by(GameDepDependency.id)],
+                         [False, True])
+
+
+class TestPipelineLib(DatabaseTestCase):
+    def setUp(self):
+        import os, tempfile
+        from unittest import mock
+        super(TestPipelineLib, self).setUp()
+        from pyracms.models import Files
+        from .lib.pipelinelib import PipelineLib
+        from .models import GameDepBinary, GameDepRevision
+        self.upload_path = tempfile.mkdtemp()
+        self.config.registry.settings["hypernucleus.upload_path"] = \
+            self.upload_path
+        with transaction.manager:
+            # Two uploads of the same bytes
+            for file_id in (1, 2):
+                uuid = "uuid%s" % file_id
+                os.mkdir(os.path.join(self.upload_path, uuid))
+                with open(os.path.join(self.upload_path, uuid, "bin.zip"),
+                          "wb") as f:
+                    f.write(b"same bytes")
+                DBSession.add(Files(id=file_id, uuid=uuid, name="bin.zip"))
+            self.add_page("dep1", versions=[1.0], published=False)
+            for file_id in (1, 2):
+                DBSession.execute(GameDepBinary.__table__.insert(), {
+                    "id": file_id, "revision_id": 1, "file_id": file_id,
+                    "operatingsystem_id": 1, "architecture_id": 1})
+        self.pipeline = PipelineLib()
+        self.pipeline.executor = mock.Mock()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.upload_path)
+        super(TestPipelineLib, self).tearDown()
+
+    def enqueue(self):
+        from pyracms.models import Files
+        from .models import GameDepBinary, GameDepRevision
+        job_ids = []
+        with transaction.manager:
+            rev = DBSession.query(GameDepRevision).get(1)
+            for file_id in (1, 2):
+                job_ids.append(self.pipeline.enqueue("binary", rev,
+                    DBSession.query(Files).get(file_id),
+                    DBSession.query(GameDepBinary).get(file_id)).id)
+            self.assertFalse(self.pipeline.executor.submit.called)
+        return job_ids
+
+    def process(self, job_id):
+        from unittest import mock
+        from .lib import bloblib
+        request = testing.DummyRequest()
+        with mock.patch.object(bloblib, "FileLib") as file_lib, \
+             transaction.manager:
+            self.pipeline.process(request, self.pipeline.show(job_id))
+            return [x[0][0].id for x in
+                    file_lib.return_value.delete.call_args_list]
+
+    def status(self):
+        from .models import GameDepJob
+        with transaction.manager:
+            return [(x.status, x.attempts) for x in
+                    DBSession.query(GameDepJob).order_by(GameDepJob.id)]
+
+    def test_enqueue(self):
+        p = self.pipeline
+        job_ids = self.enqueue()
+        self.assertEqual([x[0] for x in p.executor.submit.call_args_list],
+                         [(p.run, job_ids[0]), (p.run, job_ids[1])])
+        # Queued jobs are not submitted again by the sweeper
+        p.sweep()
+        self.assertEqual(p.executor.submit.call_count, 2)
+        self.assertEqual(self.status(), [("pending", 0), ("pending", 0)])
+
+    def test_claim_and_retry(self):
+        from datetime import datetime, timedelta
+        from .models import GameDepJob
+        p = self.pipeline
+        job_id = self.enqueue()[0]
+        self.assertTrue(p.claim(job_id))
+        self.assertFalse(p.claim(job_id))
+        def set_job(**values):
+            with transaction.manager:
+                DBSession.query(GameDepJob).filter_by(id=job_id).update(
+                                                            values)
+        # A worker that died: claimable again after the timeout
+        set_job(updated=datetime.now() - timedelta(hours=2))
+        self.assertTrue(p.claim(job_id))
+        set_job(status="failed")
+        p.queued.clear()
+        p.sweep()
+        self.assertTrue(((p.run, job_id),) in
+                        p.executor.submit.call_args_list[-2:])
+        self.assertTrue(p.claim(job_id))
+        self.assertEqual(self.status()[0], ("running", 3))
+        # Out of attempts
+        set_job(updated=datetime.now() - timedelta(hours=2))
+        self.assertFalse(p.claim(job_id))
+        p.sweep()
+        self.assertEqual(self.status()[0], ("failed", 3))
+
+    def test_dedup_and_move(self):
+        from .models import GameDepBinary, GameDepBlob
+        job_ids = self.enqueue()
+        self.assertEqual(self.process(job_ids[0]), [])
+        self.assertEqual(self.process(job_ids[1]), [2])
+        with transaction.manager:
+            self.assertEqual([x.file_id for x in DBSession.query(
+                                GameDepBinary).order_by(GameDepBinary.id)],
+                             [1, 1])
+            blob = DBSession.query(GameDepBlob).one()
+            self.assertEqual((blob.file_id, blob.refcount), (1, 2))
+        self.assertEqual(self.status(), [("done", 0), ("done", 0)])
+
+    def test_superseded(self):
+        from .models import GameDepBinary, GameDepBlob
+        job_ids = self.enqueue()
+        with transaction.manager:
+            # Replaced by another upload before the job ran
+            DBSession.query(GameDepBinary).filter_by(id=2).update(
+                                                        {"file_id": 1})
+        self.assertEqual(self.process(job_ids[1]), [])
+        with transaction.manager:
+            self.assertEqual(DBSession.query(GameDepBlob).count(), 0)
+        self.assertEqual(self.status()[1], ("done", 0))
+
+    def test_publish_waits_for_jobs(self):
+        from unittest import mock
+        from .lib import gamedeplib
+        from .lib.gamedeplib import GameDepLib, ProcessingNotFinished
+        job_ids = self.enqueue()
+        g = GameDepLib("dep")
+        with mock.patch.object(gamedeplib, "pipeline", self.pipeline):
+            with transaction.manager:
+                self.assertRaises(ProcessingNotFinished,
+                                  g.flip_published, "dep1", 1)
+            for job_id in job_ids:
+                self.process(job_id)
+            with transaction.manager:
+                g.flip_published("dep1", 1)
+                self.assertTrue(g.show("dep1", 1)[1].published)
+
+class TestCatalogImport(DatabaseTestCase):
+    def setUp(self):
+        import os, tempfile
+        super(TestCatalogImport, self).setUp()
+        from pyracms.models import User
+        from .models import Architectures, OperatingSystems
+        self.base = tempfile.mkdtemp()
+        self.upload_path = tempfile.mkdtemp()
+        self.settings = {"hypernucleus.upload_path": self.upload_path}
+        with transaction.manager:
+            DBSession.add(User(id=1, name="admin"))
+            DBSession.add(OperatingSystems("pi", "Platform Independent"))
+            DBSession.add(Architectures("pi", "Platform Independent"))
+        files = {"src1": b"game source", "bin1": b"game binary",
+                 "dep1": b"shared bytes", "dep2": b"shared bytes"}
+        for uuid, data in files.items():
+            os.mkdir(os.path.join(self.base, uuid))
+            with open(os.path.join(self.base, uuid, uuid + ".zip"),
+                      "wb") as f:
+                f.write(data)
+        def binary(uuid):
+            return {"uuid": uuid, "name": uuid + ".zip",
+                    "operating_system": "pi", "architecture": "pi"}
+        self.root = {"gamedep": [
+            {"game": {"name": "pong", "display_name": "Pong",
+                      "description": "Bats", "tags": ["arcade"],
+                      "dependencies": [{"dependency": "lib",
+                                        "version": "1.0"}],
+                      "revisions": [{"version": "2.0", "moduletype": "file",
+                                     "source_uuid": "src1",
+                                     "source_name": "src1.zip",
+                                     "binaries": [binary("bin1")]}]}},
+            {"dependency": {"name": "lib", "display_name": "Lib",
+                            "description": "", "tags": [],
+                            "dependencies": [],
+                            "revisions": [{"version": "1.0",
+                                           "moduletype": "file",
+                                           "binaries": [binary("dep1")]}]}},
+            {"dependency": {"name": "lib2", "display_name": "Lib2",
+                            "description": "", "tags": [],
+                            "dependencies": [],
+                            "revisions": [{"version": "1.0",
+                                           "moduletype": "file",
+                                           "binaries": [binary("dep2"),
+                                                        binary("dep1")]}]}},
+        ]}
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.base)
+        shutil.rmtree(self.upload_path)
+        super(TestCatalogImport, self).tearDown()
+
+    def run_import(self, batch_size=500):
+        from .scripts.importcatalog import CatalogImporter
+        with transaction.manager:
+            importer = CatalogImporter(self.settings, self.base, "admin",
+                                       batch_size, workers=2)
+        entries = importer.entries(self.root)
+        importer.import_pages(entries, log=lambda x: None)
+        importer.import_dependencies(entries, log=lambda x: None)
+
+    def blobs(self):
+        from pyracms.models import Files
+        from .models import GameDepBlob, GameDepJob
+        with transaction.manager:
+            self.assertEqual(DBSession.query(GameDepJob).count(), 0)
+            return sorted((uuid, blob.refcount) for blob, uuid in
+                          DBSession.query(GameDepBlob, Files.uuid).join(
+                              Files, GameDepBlob.file_id == Files.id))
+
+    def test_round_trip(self):
+        import os
+        from .lib.changelib import ChangeLib
+        from .lib.outputlib import OutputLib
+        self.run_import()
+        with transaction.manager:
+            root = OutputLib(testing.DummyRequest()).show_dict()
+        entries = dict((x.get("game", x.get("dependency"))["name"],
+                        x.get("game", x.get("dependency")))
+                       for x in root["gamedep"])
+        self.assertEqual(sorted(entries), ["lib", "lib2", "pong"])
+        pong = entries["pong"]
+        self.assertEqual((pong["display_name"], pong["description"],
+                          pong["tags"], pong["dependencies"]),
+                         ("Pong", "Bats", ["arcade"],
+                          [{"dependency": "lib", "version": "1.0"}]))
+        self.assertEqual([(x["version"], x["source_uuid"],
+                           [y["uuid"] for y in x["binaries"]])
+                          for x in pong["revisions"]],
+                         [("2.0", "src1", ["bin1"])])
+        # The second copy of the same bytes is stored once
+        self.assertEqual([x["uuid"] for x in
+                          entries["lib2"]["revisions"][0]["binaries"]],
+                         ["dep1", "dep1"])
+        self.assertFalse(os.path.exists(os.path.join(self.upload_path,
+                                                     "dep2")))
+        self.assertEqual(self.blobs(), [("bin1", 1), ("dep1", 3),
+                                        ("src1", 1)])
+        with transaction.manager:
+            changes = [(x.action, x.name) for x in ChangeLib().since(0)]
+        self.assertEqual(changes[-1], ("create_dependency", "pong"))
+
+    def test_resume(self):
+        import os, shutil
+        from .models import GameDepPage
+        missing = os.path.join(self.base, "dep2")
+        shutil.move(missing, missing + ".away")
+        with self.assertRaises(IOError):
+            self.run_import(batch_size=1)
+        with transaction.manager:
+            # The first batch is in, the failed one left nothing behind
+            self.assertEqual([x for x, in DBSession.query(
+                                GameDepPage.name)], ["lib"])
+        self.assertEqual(self.blobs(), [("dep1", 1)])
+        shutil.move(missing + ".away", missing)
+        self.run_import(batch_size=1)
+        with transaction.manager:
+            self.assertEqual(DBSession.query(GameDepPage).count(), 3)
+        self.assertEqual(self.blobs(), [("bin1", 1), ("dep1", 3),
+                                        ("src1", 1)])
+        self.run_import(batch_size=2)
+        self.assertEqual(self.blobs(), [("bin1", 1), ("dep1", 3),
+                                        ("src1", 1)])
+
+class TestMirrorExport(DatabaseTestCase):
+    def setUp(self):
+        import tempfile
+        super(TestMirrorExport, self).setUp()
+        from .models import Architectures, OperatingSystems
+        self.upload_path = tempfile.mkdtemp()
+        self.target = tempfile.mkdtemp()
+        self.config.registry.settings["hypernucleus.upload_path"] = \
+            self.upload_path
+        with transaction.manager:
+            DBSession.add(OperatingSystems("pi", "Platform Independent"))
+            DBSession.add(OperatingSystems("lin", "Linux"))
+            DBSession.add(Architectures("pi", "Platform Independent"))
+        for name in ("dep1", "dep2"):
+            self.add_dep(name)
+        self.logged = []
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.upload_path)
+        shutil.rmtree(self.target)
+        super(TestMirrorExport, self).tearDown()
+
+    def add_dep(self, name):
+        """
+        Add a dependency with a binary stored as uuid <name>
+        """
+        import os
+        from pyracms.models import Files
+        from .lib.changelib import ChangeLib
+        from .models import GameDepBinary, GameDepPage, GameDepRevision
+        os.mkdir(os.path.join(self.upload_path, name))
+        with open(os.path.join(self.upload_path, name, "bin.zip"),
+                  "wb") as f:
+            f.write(name.encode())
+        with transaction.manager:
+            page_id = self.add_page(name, versions=[1.0])
+            file_obj = Files(uuid=name, name="bin.zip")
+            DBSession.add(file_obj)
+            DBSession.flush()
+            DBSession.execute(GameDepBinary.__table__.insert(), {
+                "revision_id": DBSession.query(GameDepRevision.id).filter_by(
+                                    page_id=page_id).scalar(),
+                "file_id": file_obj.id, "operatingsystem_id": 1,
+                "architecture_id": 1})
+            ChangeLib().record("create", DBSession.query(GameDepPage).get(
+                                                                page_id))
+
+    def export(self):
+        from .scripts.exportmirror import MirrorExporter
+        self.logged = []
+        MirrorExporter(testing.DummyRequest(), self.target, 2,
+                       self.logged.append).export()
+
+    def read(self, *path):
+        import os
+        with open(os.path.join(self.target, *path)) as f:
+            return f.read()
+
+    def exists(self, *path):
+        import os
+        return os.path.exists(os.path.join(self.target, *path))
+
+    def test_first_export(self):
+        import os
+        # An older export wrote the json feed where its directory goes
+        os.makedirs(os.path.join(self.target, "outputs"))
+        with open(os.path.join(self.target, "outputs", "json"), "w") as f:
+            f.write("{}")
+        with open(os.path.join(self.target, ".mirror-state.json"),
+                  "w") as f:
+            json.dump({"cursor": None, "files": [],
+                       "feeds": {"outputs/json": "old"}}, f)
+        self.export()
+        root = json.loads(self.read("outputs", "json", "index.json"))
+        self.assertEqual(root, json.loads(self.read("catalog.json")))
+        self.assertEqual(sorted(x["dependency"]["name"]
+                                for x in root["gamedep"]), ["dep1", "dep2"])
+        self.assertTrue(self.exists("outputs", "xml"))
+        for platform in ("lin", "pi"):
+            self.assertEqual(json.loads(self.read("outputs", "json",
+                                                  platform, "pi")),
+                             root)
+        self.assertEqual(self.read("outputs", "download", "dep1",
+                                   "bin.zip"), "dep1")
+        document = json.loads(self.read("api", "gamedep", "dep", "item",
+                                         "dep1"))
+        self.assertEqual(document["name"], "dep1")
+        self.assertFalse("view_count" in document)
+        state = json.loads(self.read(".mirror-state.json"))
+        self.assertEqual(state["cursor"], 2)
+        self.assertFalse("outputs/json" in state["feeds"])
+
+    def test_incremental(self):
+        import os
+        from .lib.changelib import ChangeLib
+        from .models import GameDepPage
+        self.export()
+        # Unchanged items are not written again
+        with open(os.path.join(self.target, "api", "gamedep", "dep", "item",
+                               "dep2"), "w") as f:
+            f.write("kept")
+        with transaction.manager:
+            page = DBSession.query(GameDepPage).filter_by(name="dep1").one()
+            ChangeLib().record("delete", page)
+            DBSession.query(GameDepPage).filter_by(id=page.id).delete()
+            DBSession.query(GameDepPage).filter_by(name="dep2").update(
+                                                        {"view_count": 10})
+        self.add_dep("dep3")
+        self.export()
+        self.assertFalse(self.exists("api", "gamedep", "dep", "item",
+                                     "dep1"))
+        self.assertFalse(self.exists("outputs", "download", "dep1"))
+        self.assertEqual(self.read("api", "gamedep", "dep", "item", "dep2"),
+                         "kept")
+        self.assertTrue(self.exists("api", "gamedep", "dep", "item", "dep3"))
+        self.assertTrue(self.exists("outputs", "download", "dep3",
+                                    "bin.zip"))
+        root = json.loads(self.read("outputs", "json", "index.json"))
+        self.assertEqual(sorted(x["dependency"]["name"]
+                                for x in root["gamedep"]), ["dep2", "dep3"])
+        self.assertEqual(json.loads(self.read(".mirror-state.json"))[
+                                                        "cursor"], 4)
+        # Nothing changed, nothing written
+        self.export()
+        self.assertFalse([x for x in self.logged if x.startswith("Wrote ")
+                          and not x.endswith(" 0 item documents")])
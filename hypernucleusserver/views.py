@@ -1,4 +1,5 @@
 from string import capwords
+import json
 
 from deform.exception import ValidationFailure
 from deform.form import Form
@@ -7,12 +8,15 @@ from pyracms.lib.settingslib import SettingsLib
 from pyracms.lib.userlib import UserLib
 from pyracms.views import INFO, ERROR
 from pyramid.exceptions import NotFound
-from pyramid.httpexceptions import HTTPFound, HTTPForbidden
+from pyramid.httpexceptions import (HTTPFound, HTTPForbidden, HTTPBadRequest,
+                                    HTTPConflict, HTTPAccepted)
 from pyramid.security import has_permission
+from pyramid.settings import asbool
 from pyramid.url import route_url, current_route_url
 from pyramid.view import view_config
 from pyracms.models import DBSession
 import pyracms.lib.taglib as taglib
+import transaction
 
 from .deform_schemas.gamedep import (EditGameDepSchema, AddSourceSchema,
                                      AddBinarySchema, EditBinarySchema,
@@ -22,27 +26,50 @@ from .deform_schemas.gamedep import (EditGameDepSchema, AddSourceSchema,
                                      EditRevisionSchema)
 from .lib.gamedeplib import (AlreadyVoted, GAME, DEP, GameDepLib,
                              GameDepNotFound, GameDepFound, BinaryNotFound,
-                             SourceCodeNotFound)
+                             SourceCodeNotFound, ProcessingNotFinished)
+from .lib.downloadlib import DeltaNotReady, DownloadLib, StoredFileNotFound
+from .lib.counterlib import counters
+from .lib.deltalib import DeltaTooLarge
+from .lib.feedlib import iter_json, iter_xml, platform_catalog
 from .lib.outputlib import OutputLib
+from .lib.pipelinelib import pipeline
+from .lib.snapshotlib import catalog_snapshot, best_encoding
 from .models import GameDepTags
 
 u = UserLib()
 s = SettingsLib()
 
+def current_user(request):
+    """
+    Get the logged in user, looked up once per request
+    """
+    username = get_username(request)
+    return request.gamedep_cache.get(("user", username),
+                                     lambda: u.show(username))
+
 def check_owner(context, request):
     page_id = request.matchdict.get('page_id')
     gamedeptype = request.matchdict.get('type')
-    g = GameDepLib(gamedeptype)
+    g = GameDepLib(gamedeptype, request)
     try:
-        page = g.show(page_id)
+        page = g.show(page_id)[0]
         if (has_permission('gamedep_mod', context, request) or
-            page.owner == u.show(get_username(request))):
+            page.owner == current_user(request)):
             return True
         else:
             raise HTTPForbidden
     except GameDepNotFound:
         return True
 
+def required_source_files(page_id, moduletype):
+    """
+    Get the files a game's source code zip must have
+    """
+    if moduletype == "file":
+        return ["%s/%s.py" % (page_id, page_id)]
+    else:
+        return ["%s/__init__.py" % page_id]
+
 def get_pageid_revision(request):
     """
     Get page_id and revision from matchdict
@@ -52,27 +79,199 @@ def get_pageid_revision(request):
     return (page_id, revision)
 
 
+def current_snapshot(request):
+    """
+    Get the catalog snapshot, rebuilding it if the catalog changed
+    """
+    return catalog_snapshot.current(lambda: OutputLib(request).show_feeds())
+
+
+def output_feed(request, name, content_type, snapshot=None):
+    """
+    Output a serialized feed from the catalog snapshot.
+    Conditional requests are answered with 304 from the cached ETag
+    and Last-Modified, without touching the database. Compressed
+    variants are served when the client accepts them.
+    """
+    if snapshot is None:
+        snapshot = current_snapshot(request)
+    res = request.response
+    res.content_type = content_type
+    res.headers["X-Catalog-Generation"] = str(snapshot.generation)
+    res.headers["X-Catalog-Cursor"] = snapshot.feeds["cursor"].decode()
+    res.last_modified = snapshot.modified
+    res.vary = ("Accept-Encoding",)
+    res.conditional_response = True
+    encoding = best_encoding(request.headers.get("Accept-Encoding"))
+    if encoding:
+        res.content_encoding = encoding
+        res.etag = "%s-%s" % (snapshot.etags[name], encoding)
+        res.body = snapshot.encode(name, encoding)
+    else:
+        res.etag = snapshot.etags[name]
+        res.body = snapshot.feeds[name]
+    return res
+
+
+def stream_feed(request, batch_size, serialiser):
+    """
+    Yield a feed in chunks, reading batch_size pages at a time.
+    Runs after pyramid_tm has finished, so it uses its own transaction.
+    """
+    with transaction.manager:
+        root = OutputLib(request).show_dict(batch_size)
+        for chunk in serialiser(root):
+            yield chunk.encode()
+
+
+def stream_enabled(request):
+    return asbool(request.registry.settings.get(
+                                            "hypernucleus.stream_feeds"))
+
+
+def output_stream(request, serialiser, content_type):
+    """
+    Output a feed straight from the database
+    """
+    batch_size = int(request.registry.settings.get(
+                                    "hypernucleus.stream_batch_size", 500))
+    res = request.response
+    res.content_type = content_type
+    res.app_iter = stream_feed(request, batch_size, serialiser)
+    return res
+
+
 @view_config(route_name='outputs_xml')
 def output_xml(context, request):
     """
     Output serialized xml data
     """
-    olib = OutputLib(request)
-    res = request.response
-    res.content_type = "application/xml"
-    res.body = olib.show_xml()
+    if stream_enabled(request):
+        return output_stream(request, iter_xml, "application/xml")
+    return output_feed(request, "xml", "application/xml")
+
+
+@view_config(route_name='outputs_file', request_method=('GET', 'HEAD'))
+def output_file(context, request):
+    """
+    Output an uploaded binary or source code file, resumable with Range
+    """
+    d = DownloadLib(request)
+    try:
+        file_obj = d.show(request.matchdict.get('fileid'))
+    except StoredFileNotFound:
+        return NotFound(request.url)
+    return counted_file_response(request, d, file_obj)
+
+
+@view_config(route_name='outputs_download', request_method=('GET', 'HEAD'))
+def output_download(context, request):
+    """
+    Output an uploaded file by the uuid and name the catalog feeds list
+    it under, counting binary downloads
+    """
+    d = DownloadLib(request)
+    try:
+        file_obj = d.show_uuid(request.matchdict.get('uuid'))
+    except StoredFileNotFound:
+        return NotFound(request.url)
+    if file_obj.name != request.matchdict.get('name'):
+        return NotFound(request.url)
+    return counted_file_response(request, d, file_obj)
+
+
+def counted_file_response(request, d, file_obj):
+    """
+    Build the response for a file, counting a download for the binary
+    it is for, ?binary= if it is shared
+    """
+    try:
+        res = d.response(file_obj)
+    except StoredFileNotFound:
+        return NotFound(request.url)
+    # Resumed downloads are not counted again
+    if request.method == 'GET' and (request.range is None or
+                                    request.range.start == 0):
+        binary_id = d.binary_id(file_obj, request.params.get('binary'))
+        if binary_id:
+            counters.increment("download", binary_id)
     return res
 
 
+@view_config(route_name='outputs_delta', request_method=('GET', 'HEAD'))
+def output_delta(context, request):
+    """
+    Output the delta from a file the client has to a newer version of
+    the same binary, by the uuids the catalog lists them under. 202 means
+    it is being worked out, try again after Retry-After. 409 means fetch
+    the whole file.
+    """
+    d = DownloadLib(request)
+    try:
+        old_obj = d.show_uuid(request.matchdict.get('from_uuid'))
+        new_obj = d.show_uuid(request.matchdict.get('to_uuid'))
+        if not d.delta_allowed(old_obj, new_obj):
+            return NotFound(request.url)
+        return d.delta_response(old_obj, new_obj)
+    except StoredFileNotFound:
+        return NotFound(request.url)
+    except DeltaTooLarge:
+        return HTTPConflict(location=route_url("outputs_file", request,
+                                               fileid=new_obj.id))
+    except DeltaNotReady:
+        if not pipeline.delta(old_obj.id, new_obj.id):
+            return HTTPConflict(location=route_url("outputs_file", request,
+                                                   fileid=new_obj.id))
+        return HTTPAccepted(headers={"Retry-After": "5"})
+
+
 @view_config(route_name='outputs_json')
 def output_json(context, request):
     """
     Output serialized json data
     """
+    if stream_enabled(request):
+        return output_stream(request, iter_json, "application/json")
+    return output_feed(request, "json", "application/json")
+
+
+@view_config(route_name='outputs_json_platform')
+def output_json_platform(context, request):
+    """
+    Output serialized json data with only the binaries for one
+    operating system and architecture, plus platform independent ones
+    """
+    operatingsystem = request.matchdict.get('os')
+    architecture = request.matchdict.get('arch')
+    snapshot = current_snapshot(request)
+    root = snapshot.derive("root", lambda: json.loads(
+                                            snapshot.feeds["json"].decode()))
+    if (operatingsystem not in [x["name"] for x in root["operatingsystems"]]
+        or architecture not in [x["name"] for x in root["architectures"]]):
+        return NotFound(request.url)
+    name = "json/%s/%s" % (operatingsystem, architecture)
+    snapshot.feed(name, lambda: json.dumps(
+                            platform_catalog(root, operatingsystem,
+                                             architecture),
+                            sort_keys=True, indent=4).encode())
+    return output_feed(request, name, "application/json", snapshot)
+
+
+@view_config(route_name='outputs_changes')
+def output_changes(context, request):
+    """
+    Output serialized json data of the catalog changes after the
+    sequence number in the since parameter
+    """
+    try:
+        cursor = int(request.params.get("since", 0))
+        limit = min(int(request.params.get("limit", 500)), 500)
+    except ValueError:
+        raise HTTPBadRequest
     olib = OutputLib(request)
     res = request.response
     res.content_type = "application/json"
-    res.body = olib.show_json().encode()
+    res.body = olib.show_changes(cursor, max(limit, 1)).encode()
     return res
 
 
@@ -80,7 +279,7 @@ def output_json(context, request):
              renderer='gamedep/list.jinja2')
 def gamedep_list(context, request):
     gamedeptype = request.matchdict.get('type')
-    g = GameDepLib(gamedeptype)
+    g = GameDepLib(gamedeptype, request)
     gamedeptypetwo = {GAME: "game",
                       DEP: "dependenc"}.get(gamedeptype)
     return {'pages': g.list(), 'type': gamedeptype,
@@ -91,7 +290,7 @@ def gamedep_list(context, request):
 @view_config(route_name='gamedep_published', permission='gamedep_publish')
 def gamedep_published(context, request):
     gamedeptype = request.matchdict.get('type')
-    g = GameDepLib(gamedeptype)
+    g = GameDepLib(gamedeptype, request)
     page_id = request.matchdict.get('page_id')
     revision = request.matchdict.get('revision')
     check_owner(context, request)
@@ -103,6 +302,9 @@ def gamedep_published(context, request):
     except SourceCodeNotFound:
         request.session.flash(s.show_setting("ERROR_NOT_UPLOADED_SOURCE_CODE"),
                               ERROR)
+    except ProcessingNotFinished:
+        request.session.flash(s.show_setting("ERROR_UPLOAD_PROCESSING"),
+                              ERROR)
     return HTTPFound(location=route_url("gamedep_item", request,
                                         type=gamedeptype,
                                         page_id=page_id))
@@ -112,11 +314,12 @@ def gamedep_published(context, request):
              permission='gamedep_view')
 def gamedep_item(context, request):
     gamedeptype = request.matchdict.get('type')
-    g = GameDepLib(gamedeptype)
+    g = GameDepLib(gamedeptype, request)
     page_id = request.matchdict.get('page_id')
     revision = request.matchdict.get('revision')
     try:
         dbpage, dbrevision = g.show(page_id, revision, False)
+        counters.increment("view", dbpage.id)
         result = {'page_id': page_id, 'revision': revision,
                   'dbpage': dbpage, 'dbrevision': dbrevision,
                   'type': gamedeptype, "thread_enabled": False}
@@ -138,7 +341,7 @@ def gamedep_edit(context, request):
     def gamedep_edit_submit(context, request, deserialized, bind_params):
         page_id = get_pageid_revision(request)[0]
         gamedeptype = request.matchdict.get('type')
-        g = GameDepLib(gamedeptype)
+        g = GameDepLib(gamedeptype, request)
         name = deserialized.get("name")
         display_name = deserialized.get("display_name")
         description = deserialized.get("description")
@@ -149,14 +352,14 @@ def gamedep_edit(context, request):
                                   % page_id, INFO)
         else:
             g.create(name, display_name, description, tags,
-                     u.show(get_username(request)), request)
+                     current_user(request), request)
             request.session.flash(s.show_setting("INFO_CREATED")
                                   % page_id, INFO)
         return redirect(request, "gamedep_item", page_id=name,
                         type=gamedeptype)
 
     gamedeptype = request.matchdict.get('type')
-    g = GameDepLib(gamedeptype)
+    g = GameDepLib(gamedeptype, request)
     page_id = request.matchdict.get('page_id')
     t = taglib.TagLib(GameDepTags, taglib.GAMEDEP)
     try:
@@ -181,7 +384,7 @@ def gamedep_delete(context, request):
     check_owner(context, request)
     page_id = request.matchdict.get('page_id')
     gamedeptype = request.matchdict.get('type')
-    g = GameDepLib(gamedeptype)
+    g = GameDepLib(gamedeptype, request)
     if g.exists(page_id):
         g.delete(page_id, request)
         request.session.flash(s.show_setting("INFO_DELETED") % page_id, INFO)
@@ -199,18 +402,18 @@ def gamedep_add_source(context, request):
                                   bind_params):
         page_id, revision = get_pageid_revision(request)
         gamedeptype = request.matchdict.get('type')
-        g = GameDepLib(gamedeptype)
+        g = GameDepLib(gamedeptype, request)
         source = deserialized.get("source")
         g.create_source(page_id, revision, source['fp'],
                         source['mimetype'], source['filename'],
-                        request)
+                        request, members=source.get('members'))
         request.session.flash(s.show_setting("INFO_SOURCE_UPLOADED")
                               % source['filename'], INFO)
         return redirect(request, "gamedep_item", page_id=page_id,
                         type=gamedeptype)
 
     gamedeptype = request.matchdict.get('type')
-    g = GameDepLib(gamedeptype)
+    g = GameDepLib(gamedeptype, request)
     page_id = request.matchdict.get('page_id')
     revision = request.matchdict.get('revision')
     moduletype = g.show(page_id, revision)[1].moduletype
@@ -219,16 +422,10 @@ def gamedep_add_source(context, request):
     if gamedeptype != "game":
         return NotFound(request.url)
 
-    # Figure out required files/folders
-    req_file_folder = []
-    if moduletype == "file":
-        req_file_folder.append("%s/%s.py" % (page_id, page_id))
-    else:
-        req_file_folder.append("%s/__init__.py" % page_id)
-
     return rapid_deform(context, request, AddSourceSchema,
                         gamedep_add_source_submit,
-                        req_file_folder=req_file_folder)
+                        req_file_folder=required_source_files(page_id,
+                                                              moduletype))
 
 
 @view_config(route_name='gamedep_add_bin',
@@ -240,7 +437,7 @@ def gamedep_add_source(context, request):
 def gamedep_add_binary(context, request):
     check_owner(context, request)
     gamedeptype = request.matchdict.get('type')
-    g = GameDepLib(gamedeptype)
+    g = GameDepLib(gamedeptype, request)
     page_id = request.matchdict.get('page_id')
     binary_id = request.matchdict.get('binary_id')
     revision = request.matchdict.get('revision')
@@ -287,7 +484,8 @@ def gamedep_add_binary(context, request):
         if not binary_id and not edittype:
             g.create_binary(page_id, revision, operatingsystem, architecture,
                             binary['fp'], binary['mimetype'],
-                            binary['filename'], request)
+                            binary['filename'], request,
+                            members=binary.get('members'))
             request.session.flash(s.show_setting("INFO_BINARY_ADDED")
                                   % binary['filename'], INFO)
         else:
@@ -308,13 +506,13 @@ def gamedep_delete_binary(context, request):
     check_owner(context, request)
     gamedeptype = request.matchdict.get('type')
     binid = request.matchdict.get('binary_id')
-    g = GameDepLib(gamedeptype)
+    g = GameDepLib(gamedeptype, request)
     page_id = request.matchdict.get('page_id')
     revision = request.matchdict.get('revision')
     try:
         with DBSession.no_autoflush:
             bin_name = g.show_binary(binid).file_obj.name
-            g.delete_binary(page_id, revision, binid)
+            g.delete_binary(page_id, revision, binid, request)
             request.session.flash(s.show_setting("INFO_BINARY_DELETED")
                                   % bin_name, INFO)
     except GameDepNotFound:
@@ -335,7 +533,7 @@ def gamedep_add_dependency(context, request):
     def gamedep_add_dependency_submit(context, request, deserialized,
                                       bind_params):
         gamedeptype = request.matchdict.get('type')
-        g = GameDepLib(gamedeptype)
+        g = GameDepLib(gamedeptype, request)
         page_id = request.matchdict.get('page_id')
         dep_id = request.matchdict.get('depid')
         form_rev_id = deserialized.get("revision")
@@ -374,12 +572,12 @@ def gamedep_delete_dependency(context, request):
     check_owner(context, request)
     gamedeptype = request.matchdict.get('type')
     depid = request.matchdict.get('depid')
-    g = GameDepLib(gamedeptype)
+    g = GameDepLib(gamedeptype, request)
     page_id = request.matchdict.get('page_id')
     try:
         dep_name = g.show_dependency(g.show(page_id)[0],
                                      depid).page_obj.name
-        g.delete_dependency(page_id, depid)
+        g.delete_dependency(page_id, depid, request)
         request.session.flash(s.show_setting("INFO_DEPENDENCY_DELETED")
                               % dep_name, INFO)
     except GameDepNotFound:
@@ -401,7 +599,7 @@ def gamedep_edit_revision(context, request):
                                      bind_params):
         page_id, revision = get_pageid_revision(request)
         gamedeptype = request.matchdict.get('type')
-        g = GameDepLib(gamedeptype)
+        g = GameDepLib(gamedeptype, request)
         frmversion = deserialized.get("version")
         frmmodule_type = deserialized.get("moduletype")
         if bind_params['update']:
@@ -421,7 +619,7 @@ def gamedep_edit_revision(context, request):
                         type=gamedeptype)
 
     gamedeptype = request.matchdict.get('type')
-    g = GameDepLib(gamedeptype)
+    g = GameDepLib(gamedeptype, request)
     page_id = request.matchdict.get('page_id')
     revision = request.matchdict.get('revision')
     update = False
@@ -447,7 +645,7 @@ def gamedep_delete_revision(context, request):
     page_id = request.matchdict.get('page_id')
     revision = request.matchdict.get('revision')
     gamedeptype = request.matchdict.get('type')
-    g = GameDepLib(gamedeptype)
+    g = GameDepLib(gamedeptype, request)
     if g.exists(page_id):
         caption = "Version %s" % g.show(page_id, revision)[1].version
         try:
@@ -472,10 +670,10 @@ def gamedep_add_vote(context, request):
     vote_id = request.matchdict.get('vote_id')
     like = request.matchdict.get('like').lower() == "true"
     gamedeptype = request.matchdict.get('type')
-    gd_lib = GameDepLib(gamedeptype)
+    gd_lib = GameDepLib(gamedeptype, request)
     gd = gd_lib.show(vote_id, no_revision_error=False)[0]
     try:
-        gd_lib.add_vote(gd, u.show(get_username(request)), like)
+        gd_lib.add_vote(gd, current_user(request), like)
         request.session.flash(s.show_setting("INFO_VOTE"), INFO)
     except AlreadyVoted:
         request.session.flash(s.show_setting("ERROR_VOTE"), ERROR)
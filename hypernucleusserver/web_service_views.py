@@ -1,18 +1,392 @@
 from cornice.service import Service
-from hypernucleusserver.lib.gamedeplib import GameDepLib
+from datetime import datetime
+from pyracms.lib.helperlib import get_username
+from pyramid.security import has_permission
+from pyramid.settings import asbool
+import transaction
+from hypernucleusserver.lib.gamedeplib import (GameDepLib, GameDepNotFound,
+                                               InvalidGameDepType)
+from hypernucleusserver.lib.bloblib import BlobLib, BlobNotFound
+from hypernucleusserver.lib.counterlib import counters
+from hypernucleusserver.lib.depgraphlib import dependency_graph
+from hypernucleusserver.lib.pipelinelib import pipeline
+from hypernucleusserver.lib.resolverlib import ResolverLib, DependencyCycle
+from hypernucleusserver.lib.snapshotlib import catalog_snapshot
+from hypernucleusserver.lib.uploadlib import (UploadLib, UploadNotFound,
+                                              ChunkTooLarge, ChunksMissing)
+from hypernucleusserver.lib.ziplib import (ZipInvalid, missing_members,
+                                           read_index, zip_limits)
+from hypernucleusserver.views import check_owner, required_source_files
 
 auth = Service(name='gamedep', path='/api/gamedep/{type}/item/{page_id}',
                description="User login and list")
+catalog = Service(name='catalog', path='/api/catalog',
+                  description="Catalog snapshot status")
+search = Service(name='gamedep_search', path='/api/gamedep/{type}/list',
+                 description="Paginated and filtered gamedep list")
+resolve = Service(name='gamedep_resolve',
+                  path='/api/gamedep/{type}/resolve/{page_id}/{os}/{arch}',
+                  description="Install plan of a gamedep for a platform")
+graph = Service(name='gamedep_graph', path='/api/graph/{page_id}',
+                description="Dependency graph index lookups")
+blob = Service(name='gamedep_blob', path='/api/blob/{sha256}',
+               description="Check for already uploaded bytes by sha256")
+link_binary = Service(name='gamedep_link_binary',
+                      path='/api/gamedep/{type}/addbin/{page_id}' + \
+                           '/{revision}/{sha256}',
+                      description="Add a binary from already uploaded bytes")
+link_source = Service(name='gamedep_link_source',
+                      path='/api/gamedep/{type}/addsrc/{page_id}' + \
+                           '/{revision}/{sha256}',
+                      description="Add source code from already uploaded " + \
+                                  "bytes")
+upload = Service(name='gamedep_upload',
+                 path='/api/gamedep/{type}/upload/{page_id}/{revision}',
+                 description="Open a chunked upload")
+upload_session = Service(name='gamedep_upload_session',
+                         path='/api/upload/{session}',
+                         description="Chunked upload progress")
+upload_chunk = Service(name='gamedep_upload_chunk',
+                       path='/api/upload/{session}/chunk/{number}',
+                       description="Store one chunk of an upload")
+upload_finalize = Service(name='gamedep_upload_finalize',
+                          path='/api/upload/{session}/finalize',
+                          description="Add the uploaded binary or source")
+counter = Service(name='gamedep_counters',
+                  path='/api/gamedep/{type}/counters/{page_id}',
+                  description="View and download counts")
+jobs = Service(name='gamedep_jobs', path='/api/gamedep/{type}/jobs/{page_id}',
+               description="Upload processing status")
+
+UPLOAD_PERMISSIONS = {"binary": "gamedep_add_binary",
+                      "source": "gamedep_add_source"}
+
+SEARCH_LIMIT = 200
+
+def gamedep_document(dbpage):
+    """Gets the api_gamedep document of a page, also used for static
+    mirrors."""
+    result = dbpage.to_dict()
+    result["versions"] = {}
+    for rev in dbpage.revisions:
+        result["versions"][rev.version] = rev.to_dict()
+    return result
 
 @auth.get()
 def api_gamedep(request):
     """Gets all data from the gamedep's page."""
     gamedeptype = request.matchdict.get('type')
     page_id = request.matchdict.get('page_id')
-    g = GameDepLib(gamedeptype)
+    g = GameDepLib(gamedeptype, request)
     dbpage, dbrevision = g.show(page_id, None, False)
-    result = dbpage.to_dict()
-    result["versions"] = {}
-    for rev in dbpage.revisions:
-        result["versions"][rev.version] = rev.to_dict()
-    return result
\ No newline at end of file
+    return gamedep_document(dbpage)
+
+@catalog.get()
+def api_catalog(request):
+    """Gets the catalog generation and the state of the cached feeds."""
+    snapshot = catalog_snapshot.snapshot
+    return {"generation": catalog_snapshot.generation,
+            "modified": catalog_snapshot.modified.isoformat(),
+            "built_generation": snapshot.generation if snapshot else None}
+
+
+def validate_search(request, **kwargs):
+    """Checks the paging and filter parameters of a search."""
+    params = request.params
+    validated = {"tag": params.get("tag"),
+                 "operatingsystem": params.get("os"),
+                 "architecture": params.get("arch"),
+                 "owner": params.get("owner"),
+                 "published_only": asbool(params.get("published", False))}
+    for name, default in (("after", 0), ("limit", 50)):
+        try:
+            validated[name] = int(params.get(name, default))
+        except ValueError:
+            request.errors.add('querystring', name, 'Must be a number.')
+    if "limit" in validated:
+        validated["limit"] = max(1, min(validated["limit"], SEARCH_LIMIT))
+    if params.get("updated_since"):
+        try:
+            validated["updated_since"] = datetime.strptime(
+                    params["updated_since"].replace("T", " ")[:19],
+                    "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            request.errors.add('querystring', 'updated_since',
+                               'Must be YYYY-MM-DDTHH:MM:SS.')
+    request.validated.update(validated)
+
+@search.get(validators=(validate_search,))
+def api_gamedep_search(request):
+    """Gets one page of gamedeps, use next as after to get the next page.
+    Filters: tag, published, os, arch, owner and updated_since."""
+    try:
+        g = GameDepLib(request.matchdict.get('type'), request)
+    except InvalidGameDepType:
+        request.response.status = 404
+        return {"error": "not_found"}
+    pages = g.search(**request.validated)
+    items = []
+    for page in pages:
+        result = page.to_dict()
+        result["id"] = page.id
+        result["updated"] = str(page.updated)
+        result["tags"] = [x.name for x in page.tags if x.name.strip()]
+        items.append(result)
+    next_id = None
+    if len(pages) == request.validated["limit"]:
+        next_id = pages[-1].id
+    return {"items": items, "next": next_id}
+
+@resolve.get()
+def api_gamedep_resolve(request):
+    """Gets the ordered install plan of a gamedep and all of its
+    dependencies for one operating system and architecture."""
+    matchdict = request.matchdict
+    r = ResolverLib(request)
+    try:
+        return r.resolve(matchdict.get('type'), matchdict.get('page_id'),
+                         matchdict.get('os'), matchdict.get('arch'))
+    except (GameDepNotFound, InvalidGameDepType):
+        request.response.status = 404
+        return {"error": "not_found"}
+    except DependencyCycle as e:
+        request.response.status = 409
+        return {"error": "cycle", "cycle": str(e)}
+
+@graph.get()
+def api_graph(request):
+    """Gets what a gamedep depends on and what depends on it, directly
+    and transitively, plus the pages pinned to each of its revisions."""
+    page_id = dependency_graph.page_id(request.matchdict.get('page_id'))
+    if page_id is None:
+        request.response.status = 404
+        return {"error": "not_found"}
+    def names(page_ids):
+        return [dependency_graph.name(x) for x in page_ids]
+    revisions = {}
+    for rev_id in dependency_graph.revisions(page_id):
+        revisions[rev_id] = names(dependency_graph.revision_dependents(rev_id))
+    return {"name": dependency_graph.name(page_id),
+            "dependencies": names(dependency_graph.dependencies(page_id)),
+            "dependents": names(dependency_graph.dependents(page_id)),
+            "all_dependencies": names(
+                                dependency_graph.all_dependencies(page_id)),
+            "all_dependents": names(dependency_graph.all_dependents(page_id)),
+            "revisions": revisions}
+
+@blob.get()
+def api_blob(request):
+    """Gets whether bytes with a sha256 are stored, so an uploader can
+    link them instead of sending them again."""
+    try:
+        stored = BlobLib(request).show(request.matchdict.get('sha256'))
+    except BlobNotFound:
+        request.response.status = 404
+        return {"error": "not_found"}
+    return {"sha256": stored.sha256, "size": stored.size,
+            "members": BlobLib(request).members(stored.file_obj)}
+
+@link_binary.post(permission='gamedep_add_binary')
+def api_link_binary(request):
+    """Adds a binary to a revision from stored bytes, takes the os and
+    arch ids as parameters."""
+    check_owner(request.context, request)
+    matchdict = request.matchdict
+    g = GameDepLib(matchdict.get('type'), request)
+    try:
+        g.create_binary(matchdict.get('page_id'), matchdict.get('revision'),
+                        request.params.get('os'), request.params.get('arch'),
+                        None, None, None, request,
+                        sha256=matchdict.get('sha256'))
+    except (GameDepNotFound, BlobNotFound):
+        request.response.status = 404
+        return {"error": "not_found"}
+    return {"result": "ok"}
+
+@link_source.post(permission='gamedep_add_source')
+def api_link_source(request):
+    """Sets the source code of a game revision from stored bytes."""
+    check_owner(request.context, request)
+    matchdict = request.matchdict
+    if matchdict.get('type') != "game":
+        request.response.status = 404
+        return {"error": "not_found"}
+    g = GameDepLib(matchdict.get('type'), request)
+    try:
+        g.create_source(matchdict.get('page_id'), matchdict.get('revision'),
+                        None, None, None, request,
+                        sha256=matchdict.get('sha256'))
+    except (GameDepNotFound, BlobNotFound):
+        request.response.status = 404
+        return {"error": "not_found"}
+    return {"result": "ok"}
+
+def show_upload(request):
+    """Gets the upload session in the url if it belongs to the user."""
+    u = UploadLib(request)
+    try:
+        meta = u.show(request.matchdict.get('session'))
+    except UploadNotFound:
+        return u, None
+    if meta["username"] != get_username(request):
+        return u, None
+    return u, meta
+
+@upload.post()
+def api_upload_open(request):
+    """Opens a chunked upload of a binary or a game's source code.
+    Takes kind (binary or source), filename, mimetype and, for binaries,
+    the os and arch ids."""
+    matchdict = request.matchdict
+    kind = request.params.get('kind')
+    if (kind not in UPLOAD_PERMISSIONS or
+        (kind == "source" and matchdict.get('type') != "game")):
+        request.response.status = 400
+        return {"error": "invalid_kind"}
+    if not has_permission(UPLOAD_PERMISSIONS[kind], request.context,
+                          request):
+        request.response.status = 403
+        return {"error": "forbidden"}
+    check_owner(request.context, request)
+    g = GameDepLib(matchdict.get('type'), request)
+    try:
+        g.show(matchdict.get('page_id'), matchdict.get('revision'))
+    except GameDepNotFound:
+        request.response.status = 404
+        return {"error": "not_found"}
+    params = request.params
+    u = UploadLib(request)
+    session = u.create({"username": get_username(request), "kind": kind,
+                        "type": matchdict.get('type'),
+                        "page_id": matchdict.get('page_id'),
+                        "revision": matchdict.get('revision'),
+                        "filename": params.get('filename', 'upload.zip'),
+                        "mimetype": params.get('mimetype',
+                                               'application/zip'),
+                        "os": params.get('os'), "arch": params.get('arch')})
+    return {"session": session, "chunk_size": u.chunk_size}
+
+@upload_session.get()
+def api_upload_show(request):
+    """Gets the chunk numbers received so far, to resume an upload."""
+    u, meta = show_upload(request)
+    if not meta:
+        request.response.status = 404
+        return {"error": "not_found"}
+    return {"chunks": meta["chunks"], "chunk_size": u.chunk_size}
+
+@upload_session.delete()
+def api_upload_abort(request):
+    """Abandons an upload."""
+    u, meta = show_upload(request)
+    if not meta:
+        request.response.status = 404
+        return {"error": "not_found"}
+    u.delete(request.matchdict.get('session'))
+    return {"result": "ok"}
+
+@upload_chunk.put()
+def api_upload_chunk(request):
+    """Stores the request body as a numbered chunk, numbered from 0.
+    Sending a chunk again replaces it."""
+    u, meta = show_upload(request)
+    if not meta:
+        request.response.status = 404
+        return {"error": "not_found"}
+    try:
+        size = u.write_chunk(request.matchdict.get('session'),
+                             int(request.matchdict.get('number')),
+                             request.body_file)
+    except ValueError:
+        request.response.status = 400
+        return {"error": "invalid_number"}
+    except UploadNotFound:
+        request.response.status = 404
+        return {"error": "not_found"}
+    except ChunkTooLarge:
+        request.response.status = 413
+        return {"error": "too_large", "chunk_size": u.chunk_size}
+    return {"size": size}
+
+@upload_finalize.post()
+def api_upload_finalize(request):
+    """Joins the chunks and adds them as the binary or source code the
+    upload was opened for. The session is removed once that commits."""
+    u, meta = show_upload(request)
+    if not meta:
+        request.response.status = 404
+        return {"error": "not_found"}
+    session = request.matchdict.get('session')
+    try:
+        reader = u.reader(session)
+    except ChunksMissing:
+        request.response.status = 409
+        return {"error": "chunks_missing", "chunks": meta["chunks"]}
+    g = GameDepLib(meta["type"], request)
+    try:
+        if meta["kind"] == "binary":
+            g.create_binary(meta["page_id"], meta["revision"], meta["os"],
+                            meta["arch"], reader, meta["mimetype"],
+                            meta["filename"], request)
+        else:
+            rev = g.show(meta["page_id"], meta["revision"])[1]
+            members = read_index(reader, **zip_limits(
+                                            request.registry.settings))
+            missing = missing_members(members, required_source_files(
+                                        meta["page_id"], rev.moduletype))
+            if missing:
+                request.response.status = 400
+                return {"error": "invalid_zip", "missing": missing}
+            reader.seek(0)
+            g.create_source(meta["page_id"], meta["revision"], reader,
+                            meta["mimetype"], meta["filename"], request,
+                            members=members)
+    except GameDepNotFound:
+        request.response.status = 404
+        return {"error": "not_found"}
+    except ZipInvalid as e:
+        request.response.status = 400
+        return {"error": "invalid_zip", "message": str(e)}
+    finally:
+        reader.close()
+    transaction.get().addAfterCommitHook(
+                            lambda status: status and u.delete(session))
+    return {"result": "ok"}
+
+@counter.get()
+def api_counters(request):
+    """Gets the view count of a gamedep and the download count of each
+    binary by id, including increments not yet written."""
+    g = GameDepLib(request.matchdict.get('type'), request)
+    try:
+        page = g.show(request.matchdict.get('page_id'), None, False)[0]
+    except GameDepNotFound:
+        request.response.status = 404
+        return {"error": "not_found"}
+    downloads = {}
+    for rev in page.revisions:
+        for binary in rev.binary:
+            downloads[binary.id] = ((binary.download_count or 0) +
+                                    counters.pending("download", binary.id))
+    return {"views": (page.view_count or 0) +
+                     counters.pending("view", page.id),
+            "downloads": downloads}
+
+@jobs.get()
+def api_jobs(request):
+    """Gets the processing jobs of a gamedep's uploads, newest first.
+    A revision can be published once the jobs for its files are done."""
+    g = GameDepLib(request.matchdict.get('type'), request)
+    try:
+        page = g.show(request.matchdict.get('page_id'), None, False)[0]
+    except GameDepNotFound:
+        request.response.status = 404
+        return {"error": "not_found"}
+    versions = dict((rev.id, rev.version) for rev in page.revisions)
+    return {"jobs": [{"id": job.id, "kind": job.kind, "status": job.status,
+                      "version": versions[job.revision_id],
+                      "binary_id": job.binary_id, "error": job.error,
+                      "attempts": job.attempts,
+                      "created": str(job.created),
+                      "updated": str(job.updated)}
+                     for job in pipeline.list(list(versions))]}
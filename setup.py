@@ -8,7 +8,7 @@ CHANGES = open(os.path.join(here, 'CHANGES.txt')).read()
 
 requires = [
     'pyramid',
-    'SQLAlchemy',
+    'SQLAlchemy<2',
     'transaction',
     'pyramid_tm',
     'pyramid_debugtoolbar',
@@ -40,6 +40,10 @@ setup(name='hypernucleus-server',
       main = hypernucleusserver:main
       [console_scripts]
       initialize_hypernucleus-server_db = hypernucleusserver.scripts.initializedb:main
+      benchmark_hypernucleus-server_feeds = hypernucleusserver.scripts.benchmark:main
+      import_hypernucleus-server_catalog = hypernucleusserver.scripts.importcatalog:main
+      export_hypernucleus-server_mirror = hypernucleusserver.scripts.exportmirror:main
+      upgrade_hypernucleus-server_db = hypernucleusserver.scripts.upgradedb:main
       """,
       )
 